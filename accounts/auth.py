@@ -0,0 +1,98 @@
+"""
+Session user resolution backed by the cache, for WebSocket connects and
+check_auth. A reconnect storm then reads sessions and users from the cache
+(see SESSION_ENGINE and ACCOUNTS_USER_CACHE_TTL) instead of the database.
+"""
+import uuid
+from channels.auth import AuthMiddleware
+from channels.db import database_sync_to_async
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model, load_backend
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.signals import user_logged_out
+from django.core.cache import cache
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils.crypto import constant_time_compare
+
+
+def user_cache_key(session_key):
+    return f"accounts:user:{session_key}"
+
+
+def user_version_key(user_id):
+    # Changes whenever the user is saved; cached copies from before stop matching
+    return f"accounts:user-version:{user_id}"
+
+
+def session_user(session):
+    """
+    The user ``session`` is logged in as, checked like channels.auth.get_user
+    does, or AnonymousUser. The user is cached under the session key for
+    ACCOUNTS_USER_CACHE_TTL seconds or until it is saved again; the session
+    hash is verified on every call.
+    """
+    try:
+        user_id = get_user_model()._meta.pk.to_python(session[SESSION_KEY])
+        backend_path = session[BACKEND_SESSION_KEY]
+    except KeyError:
+        return AnonymousUser()
+    if backend_path not in settings.AUTHENTICATION_BACKENDS:
+        return AnonymousUser()
+    ttl = settings.ACCOUNTS_USER_CACHE_TTL
+    key = user_cache_key(session.session_key)
+    user = version = None
+    if ttl:
+        # One cache round trip for the user and its version
+        values = cache.get_many([key, user_version_key(user_id)])
+        version = values.get(user_version_key(user_id))
+        entry = values.get(key)
+        if entry is not None and entry[0] == version and entry[1].pk == user_id:
+            user = entry[1]
+    cached = user is not None
+    if not cached:
+        user = load_backend(backend_path).get_user(user_id)
+        if user is None:
+            return AnonymousUser()
+    if hasattr(user, "get_session_auth_hash"):
+        session_hash = session.get(HASH_SESSION_KEY)
+        if not (session_hash and constant_time_compare(session_hash, user.get_session_auth_hash())):
+            # A password change logs out the other sessions
+            session.flush()
+            cache.delete(key)
+            return AnonymousUser()
+    if ttl and not cached:
+        cache.set(key, (version, user), ttl)
+    return user
+
+
+@receiver(user_logged_out)
+def forget_session_user(sender, request, user, **kwargs):
+    # Runs before logout() flushes the session, so the key is still the old one
+    if request is not None and request.session.session_key:
+        cache.delete(user_cache_key(request.session.session_key))
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def expire_cached_users(sender, instance, **kwargs):
+    # Entries cached before now expire within the TTL, and so can the version
+    ttl = settings.ACCOUNTS_USER_CACHE_TTL
+    if ttl:
+        cache.set(user_version_key(instance.pk), uuid.uuid4().hex, ttl)
+
+
+class CachedAuthMiddleware(AuthMiddleware):
+    """channels' AuthMiddleware resolving the user through ``session_user``."""
+
+    async def resolve_scope(self, scope):
+        session = scope["session"]
+        if session.session_key is None:
+            # No session cookie: anonymous without a trip to the database thread
+            scope["user"]._wrapped = AnonymousUser()
+        else:
+            scope["user"]._wrapped = await database_sync_to_async(session_user)(session)
+
+
+def CachedAuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
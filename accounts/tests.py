@@ -1,3 +1,63 @@
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.test import TestCase
+from django.urls import reverse
+from .auth import CachedAuthMiddlewareStack, user_cache_key
 
-# Create your tests here.
+
+async def whoami(scope, receive, send):
+    # A socket app that reports the user the middleware resolved
+    await receive()
+    await send({"type": "websocket.accept"})
+    await send({"type": "websocket.send", "text": scope["user"].username or "anonymous"})
+
+
+class CachedSessionUserTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="member", password="secret-password")
+        self.client.force_login(self.user)
+        self.session_key = self.client.session.session_key
+
+    def check_auth(self):
+        return self.client.get(reverse("accounts:check_auth"), secure=True).json()
+
+    def test_check_auth_reads_the_user_once(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.check_auth(), {"is_authenticated": True, "username": "member"})
+        # The session comes from the cache too
+        with self.assertNumQueries(0):
+            self.assertEqual(self.check_auth()["username"], "member")
+
+    def test_logout_drops_the_cached_user(self):
+        self.check_auth()
+        self.assertIsNotNone(cache.get(user_cache_key(self.session_key)))
+        self.client.logout()
+        self.assertIsNone(cache.get(user_cache_key(self.session_key)))
+        self.assertFalse(self.check_auth()["is_authenticated"])
+
+    def test_password_change_invalidates_cached_sessions(self):
+        self.check_auth()
+        self.user.set_password("another-password")
+        self.user.save()
+        self.assertFalse(self.check_auth()["is_authenticated"])
+
+    @async_to_sync
+    async def socket_user(self, cookie=None):
+        headers = [(b"cookie", cookie)] if cookie else []
+        communicator = WebsocketCommunicator(CachedAuthMiddlewareStack(whoami), "/ws/", headers=headers)
+        await communicator.connect()
+        username = await communicator.receive_from()
+        await communicator.disconnect()
+        return username
+
+    def test_socket_connects_share_the_cache(self):
+        # Sync test: the middleware's database calls then run on this thread's connection
+        cookie = f"{settings.SESSION_COOKIE_NAME}={self.session_key}".encode()
+        self.check_auth()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.socket_user(cookie), "member")
+            self.assertEqual(self.socket_user(), "anonymous")
@@ -4,6 +4,7 @@ from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.http import JsonResponse
+from .auth import session_user
 from .models import UserProfile
 
 def register(request):
@@ -54,10 +55,12 @@ def landing_page(request):
 
 def check_auth(request):
     """Check if user is authenticated and return user info"""
-    if request.user.is_authenticated:
+    # The same cached lookup as WebSocket connects, not request.user
+    user = session_user(request.session)
+    if user.is_authenticated:
         return JsonResponse({
             'is_authenticated': True,
-            'username': request.user.username
+            'username': user.username
         })
     else:
         return JsonResponse({
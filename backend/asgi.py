@@ -18,14 +18,21 @@ django.setup()
 
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
+from accounts.auth import CachedAuthMiddlewareStack
 from chat.routing import websocket_urlpatterns
+from chat.lifecycle import lifespan
+from chat.geoip import get_geoip
+
+# Parse the GeoIP file before serving: loading it on the first connect would
+# hold the GIL and stall every socket of the process while it is read
+get_geoip()
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
+    "websocket": CachedAuthMiddlewareStack(
         URLRouter(websocket_urlpatterns)
     ),
+    "lifespan": lifespan,
 })
 
 # import os
@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 from pathlib import Path
 import os
 import environ
+from django.core.exceptions import ImproperlyConfigured
 
 # Initialize environment variables
 env = environ.Env()
@@ -108,6 +109,115 @@ else:
         }
     }
 
+# Caches are per process unless Redis is configured
+if 'REDIS_URL' in os.environ:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ['REDIS_URL'],
+        },
+    }
+
+# Sessions are read through the cache and written to the database; set
+# SESSION_ENGINE=django.contrib.sessions.backends.cache to keep them in Redis
+# only. WebSocket connects and check_auth reuse a session's user for
+# ACCOUNTS_USER_CACHE_TTL seconds (0 disables); logging out drops it.
+SESSION_ENGINE = env('SESSION_ENGINE', default='django.contrib.sessions.backends.cached_db')
+ACCOUNTS_USER_CACHE_TTL = env.int('ACCOUNTS_USER_CACHE_TTL', default=60)
+
+# Matchmaking queue: "memory" (single process), "redis" (shared by all workers)
+# or "database" (waiting ChatRoom rows claimed atomically, e.g. Postgres without Redis)
+CHAT_MATCH_QUEUE = env('CHAT_MATCH_QUEUE', default='redis' if 'REDIS_URL' in os.environ else 'memory')
+
+# Region matching: pair by country, then continent, and fall back to anyone
+# once a stranger has waited CHAT_MATCH_WIDEN_AFTER seconds. Matching waits up
+# to CHAT_LOCATION_WAIT seconds for the client's location frame when
+# CHAT_GEOIP_DATABASE has none.
+CHAT_MATCH_BY_REGION = env.bool('CHAT_MATCH_BY_REGION', default=False)
+CHAT_MATCH_WIDEN_AFTER = env.float('CHAT_MATCH_WIDEN_AFTER', default=10.0)
+CHAT_LOCATION_WAIT = env.float('CHAT_LOCATION_WAIT', default=2.0)
+
+# After "next", both strangers are kept apart for CHAT_SKIP_TIMEOUT seconds
+# of waiting; then they may meet again if nobody else has turned up
+CHAT_SKIP_TIMEOUT = env.float('CHAT_SKIP_TIMEOUT', default=10.0)
+
+# Every CHAT_HEARTBEAT_INTERVAL seconds (0 disables) each chat socket is
+# pinged and its waiting entry marked as seen; clients that answer pings and
+# stop answering are closed. Waiting entries not seen for CHAT_WAITING_TIMEOUT
+# seconds, such as those of a crashed worker, are never paired and are
+# expired every CHAT_REAPER_INTERVAL seconds
+CHAT_HEARTBEAT_INTERVAL = env.float('CHAT_HEARTBEAT_INTERVAL', default=15)
+CHAT_WAITING_TIMEOUT = env.float('CHAT_WAITING_TIMEOUT', default=45)
+CHAT_REAPER_INTERVAL = env.float('CHAT_REAPER_INTERVAL', default=30)
+
+# A paired stranger whose socket drops without a clean close keeps the room
+# for CHAT_RESUME_GRACE seconds (0 disables) and can reconnect with
+# ?resume=<token> from its "connected" frame; missed messages are replayed
+CHAT_RESUME_GRACE = env.float('CHAT_RESUME_GRACE', default=30)
+CHAT_RESUME_STORE = env('CHAT_RESUME_STORE', default='redis' if 'REDIS_URL' in os.environ else 'memory')
+
+# Paired strangers message each other with one direct channel-layer send;
+# rooms fall back to group fan-out while an admin observes them
+CHAT_DIRECT_DELIVERY = env.bool('CHAT_DIRECT_DELIVERY', default=True)
+
+# Frames for each socket wait in a queue of at most CHAT_SEND_QUEUE_SIZE; when
+# a client falls that far behind, CHAT_SLOW_CLIENT_POLICY drops the oldest
+# frame ("drop_oldest") or closes the socket with code 4008 ("disconnect").
+# daphne's send returns before the client reads, so frames are held in that
+# queue while daphne already buffers over CHAT_SEND_BUFFER_BYTES for the socket
+CHAT_SEND_QUEUE_SIZE = env.int('CHAT_SEND_QUEUE_SIZE', default=256)
+CHAT_SLOW_CLIENT_POLICY = env('CHAT_SLOW_CLIENT_POLICY', default='drop_oldest')
+CHAT_SEND_BUFFER_BYTES = env.int('CHAT_SEND_BUFFER_BYTES', default=64 * 1024)
+
+# Inbound token buckets as (frames per second, burst), for chat messages and
+# for control frames such as location updates: per connection, and per client
+# IP across connections. IP buckets are kept in process memory or in Redis,
+# shared by all workers. Behind a proxy the client IP comes from
+# CHAT_CLIENT_IP_HEADER: the entry CHAT_TRUSTED_PROXY_HOPS from its end, as
+# each trusted proxy appends the address it saw and clients control the rest
+CHAT_RATE_LIMITS = {'message': (3, 10), 'control': (1, 5)}
+CHAT_IP_RATE_LIMITS = {'message': (30, 100), 'control': (10, 50)}
+CHAT_RATE_LIMIT_BACKEND = env('CHAT_RATE_LIMIT_BACKEND', default='redis' if 'REDIS_URL' in os.environ else 'memory')
+CHAT_CLIENT_IP_HEADER = env('CHAT_CLIENT_IP_HEADER', default='X-Forwarded-For' if 'RENDER' in os.environ else '')
+CHAT_TRUSTED_PROXY_HOPS = env.int('CHAT_TRUSTED_PROXY_HOPS', default=1)
+
+# Client locations are looked up at connect from the client IP in a local
+# IP-range CSV (DB-IP "IP to City Lite" layout, optionally gzipped). While
+# it is empty the web client still asks ipapi.co and sends a location frame.
+# The last CHAT_GEOIP_CACHE_SIZE lookups are kept per process
+CHAT_GEOIP_DATABASE = env('CHAT_GEOIP_DATABASE', default='')
+CHAT_GEOIP_CACHE_SIZE = env.int('CHAT_GEOIP_CACHE_SIZE', default=10000)
+
+# Chat messages are buffered and bulk inserted once the batch fills up or the
+# flush interval (seconds) passes, whichever comes first. A batch that fails
+# to insert is retried with exponential backoff, CHAT_MESSAGE_WRITE_RETRIES
+# times, before its messages are dropped
+CHAT_MESSAGE_BATCH_SIZE = env.int('CHAT_MESSAGE_BATCH_SIZE', default=200)
+CHAT_MESSAGE_FLUSH_INTERVAL = env.float('CHAT_MESSAGE_FLUSH_INTERVAL', default=0.25)
+CHAT_MESSAGE_WRITE_RETRIES = env.int('CHAT_MESSAGE_WRITE_RETRIES', default=6)
+
+# Retention: rooms that ended more than CHAT_RETENTION_DAYS ago are archived to
+# CHAT_ARCHIVE_DIR and deleted by `manage.py archive_chats`, or every
+# CHAT_RETENTION_INTERVAL seconds in-process when set (enable on one worker only)
+CHAT_RETENTION_DAYS = env.int('CHAT_RETENTION_DAYS', default=30)
+CHAT_ARCHIVE_DIR = env('CHAT_ARCHIVE_DIR', default=str(BASE_DIR / 'archives'))
+CHAT_RETENTION_INTERVAL = env.float('CHAT_RETENTION_INTERVAL', default=0)
+
+# Live room counters for the admin dashboard, kept in Django's cache or a
+# Redis hash and recounted from the database every
+# CHAT_COUNTER_RECONCILE_INTERVAL seconds (0 disables) to correct drift
+CHAT_COUNTERS = env('CHAT_COUNTERS', default='redis' if 'REDIS_URL' in os.environ else 'cache')
+CHAT_COUNTER_RECONCILE_INTERVAL = env.float('CHAT_COUNTER_RECONCILE_INTERVAL', default=60)
+
+# The last CHAT_RECENT_MESSAGES_SIZE messages of each room are kept in a ring
+# buffer so admin history rarely touches the database: in process memory for
+# up to CHAT_RECENT_ROOMS rooms (single process only), or in Redis lists that
+# expire CHAT_RECENT_TTL seconds after a room's last message
+CHAT_RECENT_MESSAGES = env('CHAT_RECENT_MESSAGES', default='redis' if 'REDIS_URL' in os.environ else 'memory')
+CHAT_RECENT_MESSAGES_SIZE = env.int('CHAT_RECENT_MESSAGES_SIZE', default=50)
+CHAT_RECENT_ROOMS = env.int('CHAT_RECENT_ROOMS', default=10000)
+CHAT_RECENT_TTL = env.int('CHAT_RECENT_TTL', default=3600)
+
 WSGI_APPLICATION = 'backend.wsgi.application'
 
 # Database
@@ -128,6 +238,31 @@ else:
         }
     }
 
+# Database connections. With "none" every database_sync_to_async call closes
+# its connection and the next one reconnects; "persistent" keeps each thread's
+# connection for DATABASE_CONN_MAX_AGE seconds; "pool" (Postgres with
+# psycopg 3) shares at most DATABASE_POOL_MAX_SIZE connections, by default one
+# per thread that runs ORM calls. Reused connections are health checked first.
+DATABASE_POOLING = env('DATABASE_POOLING', default='persistent')
+# Threads of the executor that runs the chat app's ORM calls (chat.db); 0 runs
+# them on the single thread shared by every database_sync_to_async call
+DATABASE_THREADS = env.int('DATABASE_THREADS', default=min(32, (os.cpu_count() or 1) + 4))
+DATABASE_CONN_MAX_AGE = env.int('DATABASE_CONN_MAX_AGE', default=600)
+DATABASE_POOL_MAX_SIZE = env.int('DATABASE_POOL_MAX_SIZE', default=max(DATABASE_THREADS, 1))
+
+if DATABASE_POOLING == 'persistent':
+    DATABASES['default'].update(CONN_MAX_AGE=DATABASE_CONN_MAX_AGE, CONN_HEALTH_CHECKS=True)
+elif DATABASE_POOLING == 'pool':
+    from psycopg_pool import ConnectionPool
+    DATABASES['default'].setdefault('OPTIONS', {})['pool'] = {
+        'min_size': 1,
+        'max_size': DATABASE_POOL_MAX_SIZE,
+        'timeout': 10,
+        'check': ConnectionPool.check_connection,
+    }
+elif DATABASE_POOLING != 'none':
+    raise ImproperlyConfigured(f"Unknown DATABASE_POOLING mode {DATABASE_POOLING!r}")
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -18,7 +18,7 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
-from chat.views import health_check, admin_dashboard, admin_rooms_summary, admin_room_messages, public_chat
+from chat.views import health_check, admin_dashboard, admin_rooms_summary, admin_room_messages, admin_export_messages, public_chat
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -28,4 +28,5 @@ urlpatterns = [
     path('staff/chat/', admin_dashboard, name='admin_dashboard'),
     path('staff/chat/summary/', admin_rooms_summary, name='admin_rooms_summary'),
     path('staff/chat/rooms/<uuid:room_uuid>/messages/', admin_room_messages, name='admin_room_messages'),
+    path('staff/chat/export/', admin_export_messages, name='admin_export_messages'),
 ]
@@ -0,0 +1,343 @@
+"""
+Load generation for the chat consumers. Simulated clients either run
+in-process through channels' WebsocketCommunicator or connect to a running
+server with the ``websockets`` package; the same scenario drives both.
+"""
+import asyncio
+import os
+import resource
+import threading
+import time
+from collections import deque
+from channels.testing import WebsocketCommunicator
+from . import protocol
+
+CONNECTED = "You are now connected!"
+BENCH_PREFIX = "bench "
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = round(pct / 100 * (len(ordered) - 1))
+    return ordered[index]
+
+
+def summarize(seconds):
+    # Latency summary in milliseconds
+    if not seconds:
+        return {"count": 0, "p50": None, "p99": None, "max": None}
+    return {
+        "count": len(seconds),
+        "p50": round(percentile(seconds, 50) * 1000, 3),
+        "p99": round(percentile(seconds, 99) * 1000, 3),
+        "max": round(max(seconds) * 1000, 3),
+    }
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # ru_maxrss is a high-water mark in KiB on Linux, good enough as a fallback
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_codec(name):
+    """Client-side codec for a ``--protocols`` name: legacy, json or msgpack."""
+    if name == "legacy":
+        return protocol.LEGACY
+    subprotocol = f"chat.v{protocol.PROTOCOL_VERSION}.{name}"
+    if subprotocol not in protocol.CODECS:
+        raise ValueError(f"{subprotocol} is not available; is its package installed?")
+    return protocol.CODECS[subprotocol]
+
+
+# Frames a chat or admin socket typically carries, for codec_cost
+SAMPLE_FRAMES = [
+    {"message": "hey, where are you from?", "sender_name": "Anonymous"},
+    {"status": "waiting", "room_id": "0b6f4c5e-7d1a-4c55-9a57-2f1f3c3f9b1e"},
+    {
+        "type": "dashboard_event", "event": "paired",
+        "room": {
+            "room_id": "0b6f4c5e-7d1a-4c55-9a57-2f1f3c3f9b1e", "user1": "specific.abc!def", "user2": "specific.abc!ghi",
+            "user1_location": "IN", "user2_location": None, "active": True, "created_at": "2025-01-01T12:00:00+00:00",
+        },
+        "counts": {"total_rooms": 1200, "active_rooms": 300, "waiting_count": 12},
+    },
+    {
+        "type": "history", "before": "MjAyNS0wMS0wMVQxMjowMDowMHw=", "after": None,
+        "messages": [
+            {"sender": "specific.abc!def", "content": f"message {i}", "timestamp": "2025-01-01T12:00:00+00:00",
+             "sender_profile": True}
+            for i in range(50)
+        ],
+    },
+]
+
+
+def codec_cost(codec, rounds=2000):
+    """CPU microseconds to encode and decode, and bytes on the wire, per sample frame."""
+    frames = SAMPLE_FRAMES * rounds
+    start = time.process_time()
+    encoded = [codec.encode(frame) for frame in frames]
+    encode_seconds = time.process_time() - start
+    start = time.process_time()
+    for payload in encoded:
+        codec.decode(**payload)
+    decode_seconds = time.process_time() - start
+    size = sum(wire_size(next(iter(payload.values()))) for payload in encoded[:len(SAMPLE_FRAMES)])
+    return {
+        "encode_us": round(encode_seconds / len(frames) * 1e6, 3),
+        "decode_us": round(decode_seconds / len(frames) * 1e6, 3),
+        "bytes": round(size / len(SAMPLE_FRAMES), 1),
+    }
+
+
+def wire_size(data):
+    return len(data.encode()) if isinstance(data, str) else len(data)
+
+
+def decode(codec, data):
+    return codec.decode(text_data=data) if isinstance(data, str) else codec.decode(bytes_data=data)
+
+
+class InProcessClient:
+    def __init__(self, application, path, codec=protocol.LEGACY):
+        subprotocols = [codec.subprotocol] if codec.subprotocol else None
+        self.communicator = WebsocketCommunicator(application, path, subprotocols=subprotocols)
+        self.codec = codec
+        self.bytes_received = 0
+        self.frames = deque()
+
+    async def connect(self, timeout):
+        connected, _ = await self.communicator.connect(timeout=timeout)
+        return connected
+
+    async def send(self, data):
+        await self.communicator.send_to(**self.codec.encode(data))
+
+    async def receive(self, timeout):
+        if not self.frames:
+            data = await self.communicator.receive_from(timeout=timeout)
+            self.bytes_received += wire_size(data)
+            self.frames.append(decode(self.codec, data))
+        return self.frames.popleft()
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class SocketClient:
+    def __init__(self, url, headers=None, codec=protocol.LEGACY):
+        self.url = url
+        self.headers = headers
+        self.codec = codec
+        self.bytes_received = 0
+        self.frames = deque()
+        self.ws = None
+
+    async def connect(self, timeout):
+        import websockets
+        subprotocols = [self.codec.subprotocol] if self.codec.subprotocol else None
+        self.ws = await asyncio.wait_for(
+            websockets.connect(self.url, extra_headers=self.headers, subprotocols=subprotocols, max_queue=None),
+            timeout,
+        )
+        return True
+
+    async def send(self, data):
+        await self.ws.send(next(iter(self.codec.encode(data).values())))
+
+    async def receive(self, timeout):
+        if not self.frames:
+            data = await asyncio.wait_for(self.ws.recv(), timeout)
+            self.bytes_received += wire_size(data)
+            self.frames.append(decode(self.codec, data))
+        return self.frames.popleft()
+
+    async def close(self):
+        await self.ws.close()
+
+
+class Session:
+    def __init__(self, client, started):
+        self.client = client
+        self.started = started
+        self.connected = None
+        self.matched = None
+        self.room_id = None
+
+
+async def open_session(make_client, semaphore, timeout):
+    # The semaphore only bounds concurrent handshakes, not the wait for a partner
+    async with semaphore:
+        session = Session(make_client(), time.perf_counter())
+        await session.client.connect(timeout)
+        session.connected = time.perf_counter()
+    while True:
+        frame = await session.client.receive(timeout)
+        if frame.get("status") == "waiting":
+            session.room_id = frame.get("room_id")
+        elif frame.get("message") == CONNECTED:
+            session.matched = time.perf_counter()
+            return session
+
+
+async def open_admin(make_admin, room_id, timeout):
+    admin = make_admin()
+    await admin.connect(timeout)
+    await admin.send({"action": "subscribe_room", "room_id": room_id})
+    # Both strangers confirm they switched to group fan-out; from then on
+    # every message reaches the admin
+    history = observing = 0
+    while not history or observing < 2:
+        frame = await admin.receive(timeout)
+        history += frame.get("type") == "history"
+        observing += frame.get("status") == "observing"
+    return admin
+
+
+async def collect(client, expected, timeout):
+    latencies = []
+    while len(latencies) < expected:
+        frame = await client.receive(timeout)
+        text = frame.get("message") or ""
+        if text.startswith(BENCH_PREFIX):
+            latencies.append(time.perf_counter() - float(text[len(BENCH_PREFIX):]))
+    return latencies
+
+
+async def chat(session, messages, timeout):
+    for _ in range(messages):
+        await session.client.send({"message": f"{BENCH_PREFIX}{time.perf_counter()}"})
+    return await collect(session.client, messages, timeout)
+
+
+async def run_scenario(make_client, clients, messages=1, make_admin=None, admins=0,
+                       concurrency=200, timeout=30, measure_memory=True):
+    """
+    Connect ``clients`` strangers (rounded up to an even number so everyone
+    pairs), optionally attach admins to some rooms, then have every client
+    send ``messages`` timestamped messages and wait for its partner's.
+    """
+    clients += clients % 2
+    semaphore = asyncio.Semaphore(concurrency)
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    sessions = await asyncio.gather(*(open_session(make_client, semaphore, timeout) for _ in range(clients)))
+    handshakes_done = max(s.connected for s in sessions)
+    rss_after = rss_bytes()
+
+    admin_clients = []
+    if make_admin is not None and admins:
+        room_ids = [s.room_id for s in sessions if s.room_id][:admins]
+        admin_clients = await asyncio.gather(*(open_admin(make_admin, rid, timeout) for rid in room_ids))
+
+    bytes_before = sum(s.client.bytes_received for s in sessions)
+    cpu_start = time.process_time()
+    chat_start = time.perf_counter()
+    admin_tasks = [asyncio.ensure_future(collect(a, 2 * messages, timeout)) for a in admin_clients]
+    fanout = await asyncio.gather(*(chat(s, messages, timeout) for s in sessions))
+    admin_fanout = await asyncio.gather(*admin_tasks)
+    chat_elapsed = time.perf_counter() - chat_start
+    chat_cpu = time.process_time() - cpu_start
+    chat_bytes = sum(s.client.bytes_received for s in sessions) - bytes_before
+
+    await asyncio.gather(*(s.client.close() for s in sessions), return_exceptions=True)
+    await asyncio.gather(*(a.close() for a in admin_clients), return_exceptions=True)
+
+    return {
+        "clients": clients,
+        "messages": messages,
+        "admins": len(admin_clients),
+        "connects_per_sec": round(clients / (handshakes_done - start), 1),
+        "time_to_match_ms": summarize([s.matched - s.started for s in sessions]),
+        "fanout_ms": summarize([lat for batch in fanout for lat in batch]),
+        "admin_fanout_ms": summarize([lat for batch in admin_fanout for lat in batch]),
+        "messages_per_sec": round(clients * messages / chat_elapsed, 1),
+        # Everything this process spent per message: consumers, layer and clients alike
+        "cpu_us_per_message": round(chat_cpu / (clients * messages) * 1e6, 1),
+        "wire_bytes_per_message": round(chat_bytes / (clients * messages), 1),
+        "memory_per_connection_kb": round((rss_after - rss_before) / clients / 1024, 2) if measure_memory else None,
+    }
+
+
+def start_fake_redis():
+    """Serve fakeredis over TCP so channels_redis can run offline."""
+    from fakeredis import TcpFakeServer
+
+    class Server(TcpFakeServer):
+        # socketserver's default backlog of 5 resets connections when
+        # channels_redis opens its pools all at once
+        request_queue_size = 1024
+
+    server = Server(("127.0.0.1", 0), server_type="redis")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    return server, f"redis://{host}:{port}"
+
+
+def layer_settings(layer, redis_url=None):
+    # Settings overrides that point the channel layer and match queue at one backend
+    if layer == "memory":
+        return {
+            "CHANNEL_LAYERS": {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+            "CHAT_MATCH_QUEUE": "memory",
+        }
+    return {
+        "CHANNEL_LAYERS": {
+            "default": {
+                "BACKEND": "channels_redis.core.RedisChannelLayer",
+                # Every specific channel of a process shares one Redis key and
+                # its capacity, which a burst from thousands of clients overruns
+                "CONFIG": {"hosts": [redis_url], "capacity": 10000},
+            },
+        },
+        "CHAT_MATCH_QUEUE": "redis",
+        "CHAT_REDIS_URL": redis_url,
+    }
+
+
+METRICS = [
+    ("connects_per_sec", None),
+    ("messages_per_sec", None),
+    ("time_to_match_ms", "p50"),
+    ("time_to_match_ms", "p99"),
+    ("fanout_ms", "p50"),
+    ("fanout_ms", "p99"),
+    ("admin_fanout_ms", "p50"),
+    ("admin_fanout_ms", "p99"),
+    ("memory_per_connection_kb", None),
+    ("cpu_us_per_message", None),
+    ("wire_bytes_per_message", None),
+    ("codec", "encode_us"),
+    ("codec", "decode_us"),
+    ("codec", "bytes"),
+]
+
+
+def compare(runs, baseline_runs):
+    """Yield (run, metric, baseline, current, change %) for runs present in both."""
+    def run_key(run):
+        # Results saved before delivery modes and protocols existed used
+        # group fan-out and plain JSON
+        return run["mode"], run["layer"], run.get("delivery", "group"), run.get("protocol", "legacy")
+
+    baseline = {run_key(r): r for r in baseline_runs}
+    for run in runs:
+        old = baseline.get(run_key(run))
+        if old is None:
+            continue
+        for name, key in METRICS:
+            before, after = old.get(name), run.get(name)
+            if key is not None:
+                before = (before or {}).get(key)
+                after = (after or {}).get(key)
+            if before is None or after is None:
+                continue
+            change = (after - before) / before * 100 if before else 0.0
+            label = f"{name}.{key}" if key else name
+            yield "/".join(run_key(run)), label, before, after, change
@@ -1,141 +1,504 @@
-import json
+import asyncio
+import logging
+import time
+import uuid
 from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
-from .models import ChatRoom, Message, UserProfile
+from django.utils import timezone
+from . import dashboard, db, geoip, rooms
+from .history import latest_page, message_page, missed_messages, room_messages
+from .matchmaking import get_match_queue
+from .persistence import get_message_writer, get_room_pk
+from .protocol import ProtocolMixin
+from .ratelimit import FrameLimiter, client_ip
+from .recent import get_recent_messages
+from .resume import get_resume_store, new_token
+from .tasks import ensure_background_tasks
+from .teardown import ALL_CHATS_GROUP, close_all_chats, start_delete_all
 
+logger = logging.getLogger(__name__)
 
-class ChatConsumer(AsyncWebsocketConsumer):
+# Closes that mean the user left on purpose (1001: the browser tab closed or
+# navigated away); any other drop holds the room
+CLEAN_CLOSE_CODES = (1000, 1001, 1005)
+
+
+class ChatConsumer(ProtocolMixin, AsyncWebsocketConsumer):
     async def connect(self):
         # Unique identifier per connection
         self.user_id = self.channel_name
         self.room_name = None
-        self.user_profile = None
+        self.room_pk = None
         self.user_location = None
+        # Set when the location came from our GeoIP lookup rather than the client
+        self.located = False
         self.is_logged_in = False
+        # Who is sending is settled here, so messages need no identity lookups;
+        # the auth middleware has already loaded the user
+        user = self.scope.get("user")
+        authenticated = user is not None and user.is_authenticated
+        self.user_profile = await rooms.get_profile(user) if authenticated else None
+        if self.user_profile is not None:
+            self.anonymous = self.user_profile.is_anonymous
+            self.sender_name = "Anonymous" if self.anonymous else "User"
+        else:
+            # Signed-in users without a profile, such as ones made by createsuperuser, go by their username
+            self.anonymous = not authenticated
+            self.sender_name = user.username if authenticated else "Anonymous"
+
+        ensure_background_tasks()
+        self.match_queue = get_match_queue()
+        self.match_entry = None
+        self.match_task = None
+        self.skip_task = None
+        self.paired = False
+        # Messages go straight to the partner unless admins are watching the room
+        self.partner_channel = None
+        # Who we are paired with, and who we last left with "next"; the two are
+        # not matched again right away
+        self.partner_user = None
+        self.previous_partner = None
+        self.observers = set()
+        self.client_ip = client_ip(self.scope)
+        self.limiter = FrameLimiter(self.client_ip)
+        self.throttled = set()
+        # Clients that answer pings once must keep answering
+        self.answers_pings = False
+        self.heard_from = False
+        self.heartbeat_task = None
+        self.last_heard = timezone.now()
+        # Resuming: our token while paired, the partner's while they are away
+        self.resume_token = None
+        # Only clients that acknowledged their token will come back with it
+        self.resumable = False
+        self.away_token = None
+        self.grace_task = None
+        self.ended = False
+        self.went_quiet = False
 
-        # Try to match with an existing waiting room; otherwise create one and wait
-        waiting_room = await self.get_waiting_room()
-        if waiting_room is None:
-            room = await self.create_waiting_room(self.user_id)
-            self.room_name = str(room.room_id)
+        await self.channel_layer.group_add(ALL_CHATS_GROUP, self.channel_name)
+        await self.accept()
+        if settings.CHAT_HEARTBEAT_INTERVAL:
+            self.heartbeat_task = asyncio.create_task(self.heartbeat(settings.CHAT_HEARTBEAT_INTERVAL))
+        token = self.query_param("resume")
+        if token and settings.CHAT_RESUME_GRACE:
+            if await self.resume(token):
+                return
+            await self.send_frame({"status": "resume_failed"})
+        self.user_location = await geoip.locate(self.client_ip)
+        self.located = self.user_location is not None
+        if self.match_queue.by_region and not self.located:
+            # Region matching needs the location first; without a GeoIP match it
+            # comes from the query string or the client's first frame, otherwise
+            # we match globally
+            self.user_location = self.location_from_query()
+            if self.user_location is None:
+                self.match_task = asyncio.create_task(self.find_partner(delay=settings.CHAT_LOCATION_WAIT))
+                return
+        await self.find_partner()
+
+    async def find_partner(self, delay=0):
+        if delay:
+            await asyncio.sleep(delay)
+        if self.match_entry is not None:
+            return
+        # The room id is picked up front; the ChatRoom row is only written once paired
+        self.match_entry = {
+            "room_id": str(uuid.uuid4()),
+            "channel": self.channel_name,
+            "user": self.user_id,
+            "location": self.user_location,
+            "profile": self.user_profile.pk if self.user_profile else None,
+            "skip": self.previous_partner,
+            "since": time.time(),
+        }
+        partner = await self.match_queue.pair(self.match_entry)
+        if partner is None:
+            self.room_name = self.match_entry["room_id"]
             await self.channel_layer.group_add(self.room_name, self.channel_name)
-            await self.accept()
-            await self.send(text_data=json.dumps({"status": "waiting", "room_id": self.room_name}))
+            await self.send_frame({"status": "waiting", "room_id": self.room_name})
+            await dashboard.room_waiting(self.match_entry)
+            if self.match_queue.by_region:
+                self.match_task = asyncio.create_task(self.widen_search(settings.CHAT_MATCH_WIDEN_AFTER))
+            if self.previous_partner is not None:
+                if self.skip_task is not None:
+                    self.skip_task.cancel()
+                self.skip_task = asyncio.create_task(self.stop_skipping(settings.CHAT_SKIP_TIMEOUT))
         else:
-            room = await self.assign_user2(waiting_room, self.user_id)
-            self.room_name = str(room.room_id)
-            await self.channel_layer.group_add(self.room_name, self.channel_name)
-            await self.accept()
-            await self.channel_layer.group_send(
-                self.room_name,
-                {"type": "chat_message", "message": "You are now connected!", "sender_id": None}
-            )
+            await self.join_partner(partner)
+
+    async def widen_search(self, delay):
+        # After waiting long enough in our region, take any stranger who is waiting
+        await asyncio.sleep(delay)
+        partner = await self.match_queue.widen(self.match_entry)
+        if partner is not None:
+            # Our own waiting room is dropped in favour of the partner's
+            await self.channel_layer.group_discard(self.room_name, self.channel_name)
+            await dashboard.waiting_left(self.room_name)
+            await self.join_partner(partner)
+
+    async def stop_skipping(self, delay):
+        # Nobody new came along; the stranger we skipped beats waiting alone
+        await asyncio.sleep(delay)
+        if self.paired or self.match_entry is None:
+            return
+        self.previous_partner = None
+        partner = await self.match_queue.rematch(self.match_entry)
+        if partner is not None:
+            await self.channel_layer.group_discard(self.room_name, self.channel_name)
+            await dashboard.waiting_left(self.room_name)
+            await self.join_partner(partner)
+
+    async def join_partner(self, partner):
+        self.paired = True
+        self.room_name = partner["room_id"]
+        self.room_pk = partner.get("room_pk")
+        self.partner_channel = partner["channel"]
+        self.partner_user = partner["user"]
+        # Before the partner hears of the room, so the buffer holds it from its first message
+        await get_recent_messages().start(self.room_name)
+        await self.channel_layer.group_add(self.room_name, self.channel_name)
+        await self.channel_layer.send(partner["channel"], {
+            "type": "match_found",
+            "room_id": self.room_name,
+            "room_pk": self.room_pk,
+            "channel": self.channel_name,
+            "user": self.user_id,
+        })
+        await self.send_frame(self.connected_frame())
+        await dashboard.room_paired(partner, self.user_id, self.user_location)
+
+    def connected_frame(self):
+        # Only rooms between two strangers can be held for a resume
+        if settings.CHAT_RESUME_GRACE and self.partner_channel:
+            self.resume_token = new_token()
+            self.resumable = False
+        frame = {"message": "You are now connected!", "sender_name": None}
+        if self.resume_token:
+            frame["resume_token"] = self.resume_token
+        return frame
+
+    def query_param(self, name):
+        params = parse_qs(self.scope.get("query_string", b"").decode())
+        return params.get(name, [None])[0]
+
+    def location_from_query(self):
+        country = self.query_param("country")
+        continent = self.query_param("continent")
+        if not country and not continent:
+            return None
+        return {"country": country, "continent": continent, "method": "query"}
+
+    async def resume(self, token):
+        """Rejoin the room held under ``token`` as the same participant; False if it is gone."""
+        session = await get_resume_store().take(token)
+        if session is None:
+            return False
+        self.user_id = session["user"]
+        self.partner_user = session.get("partner")
+        self.room_name = session["room_id"]
+        self.room_pk = session["room_pk"]
+        self.user_location = session["location"]
+        self.is_logged_in = session["logged_in"]
+        self.match_entry = {"room_id": self.room_name, "channel": self.channel_name, "user": self.user_id}
+        self.paired = True
+        # Having resumed once, the client evidently keeps its tokens
+        self.resume_token = new_token()
+        self.resumable = True
+        await self.channel_layer.group_add(self.room_name, self.channel_name)
+        # The partner answers with its channel; until then messages go through the group
+        await self.channel_layer.group_send(
+            self.room_name, {"type": "partner_back", "sender_id": self.user_id, "channel": self.channel_name}
+        )
+        await self.send_frame({"status": "resumed", "room_id": self.room_name, "resume_token": self.resume_token})
+        for message in await missed_messages(self.room_name, session["away_since"]):
+            if message["sender"] != self.user_id:
+                await self.send_frame({
+                    "message": message["content"],
+                    "sender_name": "Anonymous" if message["sender_profile"] else "User",
+                    "replayed": True,
+                })
+        return True
+
+    async def hold_room(self):
+        """Keep the room for CHAT_RESUME_GRACE seconds after an unexpected drop."""
+        grace = settings.CHAT_RESUME_GRACE
+        # Clients that answer pings have provably read up to their last pong
+        away_since = self.last_heard if self.answers_pings else timezone.now()
+        await get_resume_store().hold(self.resume_token, {
+            "room_id": self.room_name,
+            "room_pk": self.room_pk,
+            "user": self.user_id,
+            "partner": self.partner_user,
+            "location": self.user_location,
+            "logged_in": self.is_logged_in,
+            "away_since": away_since.isoformat(),
+        }, grace)
+        await self.channel_layer.group_discard(self.room_name, self.channel_name)
+        await self.channel_layer.group_send(self.room_name, {
+            "type": "partner_away", "sender_id": self.user_id, "token": self.resume_token, "grace": grace,
+        })
+
+    def can_hold(self, close_code):
+        if not (self.resume_token and self.resumable) or self.ended or self.away_token is not None:
+            # Admin kills end the room, and so does a drop while the partner is away too
+            return False
+        return self.went_quiet or close_code not in CLEAN_CLOSE_CODES
+
+    async def heartbeat(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            if self.answers_pings and not self.heard_from:
+                # The client went quiet without closing; don't keep it queued
+                self.went_quiet = True
+                await self.close()
+                return
+            self.heard_from = False
+            await self.send_frame({"type": "ping"})
+            if self.match_entry is not None and not self.paired:
+                await self.match_queue.touch(self.match_entry["room_id"])
 
     async def disconnect(self, close_code):
+        if self.match_task is not None:
+            self.match_task.cancel()
+        if self.skip_task is not None:
+            self.skip_task.cancel()
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+        if self.grace_task is not None:
+            self.grace_task.cancel()
+        await self.channel_layer.group_discard(ALL_CHATS_GROUP, self.channel_name)
+        # Make sure this connection's buffered messages are written
+        await get_message_writer().flush()
         if self.room_name:
-            # Notify the room and force close the counterpart so both can requeue
-            await self.channel_layer.group_send(
-                self.room_name,
-                {"type": "chat_message", "message": "Stranger has disconnected.", "sender_id": None}
-            )
-            await self.channel_layer.group_send(self.room_name, {"type": "force_close"})
-            await self.deactivate_room(self.room_name)
+            if await self.match_queue.leave(self.room_name):
+                # Still waiting, so there is no partner or room record to clean up
+                await self.channel_layer.group_discard(self.room_name, self.channel_name)
+                await dashboard.waiting_left(self.room_name)
+                return
+            if self.paired and self.can_hold(close_code):
+                await self.hold_room()
+                return
+            # Force close the counterpart so both can requeue
+            await self.end_room({"type": "force_close"})
+
+    async def end_room(self, event):
+        """Tell the room we left, hand ``event`` to whoever stays and close the room record."""
+        if self.away_token is not None:
+            # The partner can no longer come back to this room
+            await get_resume_store().discard(self.away_token)
+        await self.channel_layer.group_send(
+            self.room_name,
+            {"type": "chat_message", "message": "Stranger has disconnected.", "sender_id": None}
+        )
+        await self.channel_layer.group_send(self.room_name, event)
+        # Both sides get here; only the one that closes the room reports it
+        if await rooms.deactivate_room(self.room_name):
+            await dashboard.room_ended(self.room_name)
+
+    async def next_partner(self):
+        """Leave the room for the next stranger without closing the socket; the partner requeues too."""
+        await self.channel_layer.group_discard(self.room_name, self.channel_name)
+        await self.end_room({"type": "partner_left", "sender_id": self.user_id, "room_id": self.room_name})
+        self.previous_partner = self.partner_user
+        self.forget_room()
+        await self.find_partner()
+
+    def forget_room(self):
+        if self.grace_task is not None:
+            self.grace_task.cancel()
+            self.grace_task = None
+        self.room_name = self.room_pk = self.match_entry = None
+        self.partner_channel = self.partner_user = self.resume_token = self.away_token = None
+        self.paired = False
+        self.observers = set()
+
+    async def receive_frame(self, data):
+        # Heartbeat answers and resume acks only set flags, and a throttled
+        # client that still answers pings must not be taken for a dead one
+        if data.get("type") in ("pong", "resumable"):
+            self.heard_from = True
+            self.last_heard = timezone.now()
+            if data["type"] == "pong":
+                self.answers_pings = True
+            else:
+                self.resumable = self.resume_token is not None and data.get("token") == self.resume_token
+            return
+        # Over-limit frames are dropped before any database or channel-layer work
+        kind = "message" if data.get("message") and data.get("type") != "location" else "control"
+        if await self.rate_limited(kind):
+            return
+        self.heard_from = True
+        self.last_heard = timezone.now()
+        if data.get("type") == "next":
+            # Only a paired socket has anyone to skip; waiting ones are already queued
+            if self.paired:
+                await self.next_partner()
+            return
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        
         # Handle location data
         if data.get("type") == "location":
-            self.user_location = data.get("location")
             self.is_logged_in = data.get("isLoggedIn", False)
-            # Update room with location data
-            if self.room_name:
-                await self.update_room_location(self.room_name, self.user_id, self.user_location)
+            if self.located:
+                # The server-side lookup stands; clients cannot move themselves
+                return
+            self.user_location = data.get("location")
+            # Update room with location data; while waiting it goes in with match_found
+            if self.paired:
+                await rooms.update_room_location(self.room_name, self.user_id, self.user_location)
+            elif self.match_entry is None and self.match_queue.by_region:
+                self.match_task.cancel()
+                await self.find_partner()
             return
         
         msg = data.get("message", "")
         if not msg:
             return
 
-        if self.room_name:
-            # Get sender name for admin display
-            sender_name = await self.get_sender_name(self.user_id, self.is_logged_in)
-            await self.save_message(self.room_name, self.user_id, msg, sender_name)
-            await self.channel_layer.group_send(
-                self.room_name,
-                {
-                    "type": "chat_message", 
-                    "message": msg, 
-                    "sender_id": self.user_id,
-                    "sender_name": sender_name
-                }
-            )
+        if self.paired:
+            await self.save_message(self.user_id, msg)
+            event = {
+                "type": "chat_message", 
+                "message": msg, 
+                "sender_id": self.user_id,
+                "sender_name": self.sender_name
+            }
+            if self.direct_delivery():
+                try:
+                    await self.channel_layer.send(self.partner_channel, event)
+                except ChannelFull:
+                    # group_send drops silently when full; do the same but say so
+                    logger.warning("Dropped a message to %s: channel full", self.partner_channel)
+            else:
+                await self.channel_layer.group_send(self.room_name, event)
+
+    async def rate_limited(self, kind):
+        wait = await self.limiter.check(kind)
+        if not wait:
+            self.throttled.discard(kind)
+            return False
+        # One notice per throttled stretch, so rejections cost no outbound frames
+        if kind not in self.throttled:
+            self.throttled.add(kind)
+            await self.send_frame({"status": "rate_limited", "kind": kind, "retry_after": round(wait, 3)})
+        return True
+
+    def direct_delivery(self):
+        # Group fan-out also echoes to the sender; only needed with observers
+        return settings.CHAT_DIRECT_DELIVERY and self.partner_channel is not None and not self.observers
 
     async def chat_message(self, event):
         # Only send the message to users who didn't send it
         if event.get("sender_id") != self.user_id:
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 "message": event["message"],
                 "sender_name": event.get("sender_name")
-            }))
+            })
+
+    async def match_found(self, event):
+        # A stranger (or an admin) picked us from the queue and recorded the room
+        self.paired = True
+        self.room_pk = event.get("room_pk")
+        # Admins claiming the room send no channel and get group delivery
+        self.partner_channel = event.get("channel")
+        self.partner_user = event.get("user")
+        if self.observers and self.partner_channel:
+            # Admins who subscribed while we waited are unknown to the partner
+            await self.channel_layer.send(
+                self.partner_channel, {"type": "room_observers", "channels": sorted(self.observers)}
+            )
+        if self.match_task is not None:
+            self.match_task.cancel()
+        if self.skip_task is not None:
+            self.skip_task.cancel()
+        if self.user_location and not self.match_entry.get("location"):
+            await rooms.update_room_location(self.room_name, self.user_id, self.user_location)
+        await self.send_frame(self.connected_frame())
 
     async def force_close(self, event):
         # Close this websocket connection when admin kills the session
+        self.ended = True
         await self.close()
 
-    @database_sync_to_async
-    def get_waiting_room(self):
-        return ChatRoom.objects.filter(active=True, user2__isnull=True).order_by("id").first()
-
-    @database_sync_to_async
-    def create_waiting_room(self, user1_id):
-        return ChatRoom.objects.create(user1=user1_id, user2=None, active=True)
-
-    @database_sync_to_async
-    def assign_user2(self, room, user2_id):
-        room.user2 = user2_id
-        room.save(update_fields=["user2"])
-        return room
-
-    @database_sync_to_async
-    def deactivate_room(self, room_id):
-        ChatRoom.objects.filter(room_id=room_id).update(active=False)
-
-    @database_sync_to_async
-    def update_room_location(self, room_id, user_id, location):
-        try:
-            room = ChatRoom.objects.get(room_id=room_id)
-            if room.user1 == user_id:
-                room.user1_location = location
-            elif room.user2 == user_id:
-                room.user2_location = location
-            room.save(update_fields=["user1_location", "user2_location"])
-        except ChatRoom.DoesNotExist:
-            pass
-
-    @database_sync_to_async
-    def get_sender_name(self, user_id, is_logged_in):
-        if is_logged_in:
-            try:
-                # Try to get username from the user_id if it's a session key
-                # This is a simplified approach - in production you'd want proper user session handling
-                return "User"  # Placeholder - would need proper user session management
-            except:
-                return "Anonymous"
-        return "Anonymous"
-
-    @database_sync_to_async
-    def save_message(self, room_id, sender, content, sender_name=None):
-        try:
-            room = ChatRoom.objects.get(room_id=room_id)
-            Message.objects.create(room=room, sender=sender, content=content)
-        except ChatRoom.DoesNotExist:
+    async def partner_left(self, event):
+        # The partner moved on; ignore it if we already left that room ourselves
+        if event["room_id"] != self.room_name:
+            return
+        await self.channel_layer.group_discard(self.room_name, self.channel_name)
+        self.previous_partner = event["sender_id"]
+        self.forget_room()
+        await self.find_partner()
+
+    async def partner_away(self, event):
+        if event["sender_id"] == self.user_id:
+            return
+        self.partner_channel = None
+        self.away_token = event["token"]
+        self.grace_task = asyncio.create_task(self.await_partner(event["token"], event["grace"]))
+        await self.send_frame({"status": "partner_away", "grace": event["grace"]})
+
+    async def await_partner(self, token, grace):
+        await asyncio.sleep(grace)
+        # Removing the hold decides the race with a resume that takes it
+        if not await get_resume_store().discard(token):
             return
+        self.away_token = None
+        self.ended = True
+        await self.send_frame({"message": "Stranger has disconnected.", "sender_name": None})
+        await self.close()
+
+    async def partner_back(self, event):
+        if event["sender_id"] == self.user_id:
+            return
+        if self.grace_task is not None:
+            self.grace_task.cancel()
+            self.grace_task = None
+        self.away_token = None
+        self.partner_channel = event["channel"]
+        self.partner_user = event["sender_id"]
+        await self.channel_layer.send(
+            event["channel"], {"type": "resume_ack", "channel": self.channel_name, "observers": sorted(self.observers)}
+        )
+        await self.send_frame({"status": "partner_back"})
+
+    async def resume_ack(self, event):
+        self.partner_channel = event["channel"]
+        self.observers.update(event["observers"])
+        for channel in event["observers"]:
+            await self.channel_layer.send(channel, {"type": "watch_started", "participant": self.user_id})
+
+    async def admin_watching(self, event):
+        if event["watching"]:
+            self.observers.add(event["channel"])
+            # Messages sent before this point went straight to the partner
+            await self.channel_layer.send(event["channel"], {"type": "watch_started", "participant": self.user_id})
+        else:
+            self.observers.discard(event["channel"])
+
+    async def room_observers(self, event):
+        self.observers.update(event["channels"])
+
+    async def teardown(self, event):
+        # Admin-wide shutdown of every chat, sent once to ALL_CHATS_GROUP
+        self.ended = True
+        await self.send_frame({"message": event["message"], "sender_name": None})
+        await self.close()
+
+    async def save_message(self, sender, content):
+        # Buffered and bulk inserted later, off the delivery path
+        if self.room_pk is None:
+            self.room_pk = await get_room_pk(self.room_name)
+            if self.room_pk is None:
+                return
+        profile_id = self.user_profile.pk if self.user_profile else None
+        message = get_message_writer().add(self.room_pk, sender, content, profile_id)
+        await get_recent_messages().add(self.room_name, message, self.anonymous)
 
 
-class AdminConsumer(AsyncWebsocketConsumer):
+class AdminConsumer(ProtocolMixin, AsyncWebsocketConsumer):
     async def connect(self):
         user = self.scope.get("user")
         if isinstance(user, AnonymousUser) or not getattr(user, "is_staff", False):
@@ -143,26 +506,57 @@ class AdminConsumer(AsyncWebsocketConsumer):
             return
         self.user = user
         self.room_name = None
+        self.room_pk = None
         await self.accept()
 
-    async def receive(self, text_data):
-        data = json.loads(text_data or "{}")
+    async def disconnect(self, close_code):
+        await get_message_writer().flush()
+        await self.channel_layer.group_discard(dashboard.DASHBOARD_GROUP, self.channel_name)
+        await self.leave_room()
+
+    async def leave_room(self):
+        if self.room_name:
+            await self.channel_layer.group_discard(self.room_name, self.channel_name)
+            await self.channel_layer.group_send(
+                self.room_name, {"type": "admin_watching", "channel": self.channel_name, "watching": False}
+            )
+            self.room_name = None
+
+    async def receive_frame(self, data):
         action = data.get("action")
-        if action == "subscribe_room":
+        if action == "subscribe_dashboard":
+            # One snapshot, then room lifecycle deltas as they happen
+            await self.channel_layer.group_add(dashboard.DASHBOARD_GROUP, self.channel_name)
+            await self.send_frame({"type": "dashboard_snapshot", **await dashboard.rooms_summary()})
+        elif action == "subscribe_room":
             room_id = data.get("room_id")
             if room_id:
-                if self.room_name:
-                    await self.channel_layer.group_discard(self.room_name, self.channel_name)
+                await self.leave_room()
                 self.room_name = room_id
+                self.room_pk = None
                 await self.channel_layer.group_add(self.room_name, self.channel_name)
-                await self.send(text_data=json.dumps({"status": "subscribed", "room_id": self.room_name}))
+                # Participants switch from direct sends to group fan-out while we watch
+                await self.channel_layer.group_send(
+                    self.room_name, {"type": "admin_watching", "channel": self.channel_name, "watching": True}
+                )
+                await self.send_frame({"status": "subscribed", "room_id": self.room_name})
                 # Optionally send history
-                history = await self.get_last_messages(room_id)
-                await self.send(text_data=json.dumps({"type": "history", "messages": history}))
+                history = await self.get_history(room_id)
+                await self.send_frame({"type": "history", **history})
+        elif action == "history":
+            # Scroll back with the ``before`` cursor of the previous page
+            room_id = data.get("room_id") or self.room_name
+            if room_id:
+                try:
+                    history = await self.get_history(room_id, before=data.get("before"))
+                except ValueError:
+                    await self.send_frame({"status": "failed", "reason": "invalid_cursor"})
+                    return
+                await self.send_frame({"type": "history", **history})
         elif action == "message":
             content = data.get("message")
             if content and self.room_name:
-                await self.save_message(self.room_name, f"admin:{self.user.username}", content)
+                await self.save_message(f"admin:{self.user.username}", content)
                 await self.channel_layer.group_send(
                     self.room_name,
                     {"type": "chat_message", "message": content, "sender_id": f"admin:{self.user.username}"}
@@ -170,35 +564,37 @@ class AdminConsumer(AsyncWebsocketConsumer):
         elif action == "kill_room":
             room_id = data.get("room_id") or self.room_name
             if room_id:
-                await self.deactivate_room(room_id)
+                if await rooms.deactivate_room(room_id):
+                    await dashboard.room_ended(room_id)
                 # Inform participants and force close their sockets
                 await self.channel_layer.group_send(
                     room_id,
                     {"type": "chat_message", "message": "Session terminated by admin.", "sender_id": None}
                 )
                 await self.channel_layer.group_send(room_id, {"type": "force_close"})
-                await self.send(text_data=json.dumps({"status": "killed", "room_id": room_id}))
+                await self.send_frame({"status": "killed", "room_id": room_id})
         elif action == "connect_to_waiting":
             # Admin claims a waiting room so that the user is connected seamlessly
             room_id = data.get("room_id")
             if room_id:
-                claimed = await self.claim_waiting_room(room_id, f"admin:{self.user.username}")
-                if claimed:
-                    # Join the group and notify participants like normal connect
-                    if self.room_name:
-                        await self.channel_layer.group_discard(self.room_name, self.channel_name)
+                entry = await get_match_queue().claim(room_id, f"admin:{self.user.username}")
+                if entry is not None:
+                    # Join the group and tell the waiting user they are connected
+                    await self.leave_room()
                     self.room_name = room_id
+                    self.room_pk = entry["room_pk"]
+                    await get_recent_messages().start(room_id)
                     await self.channel_layer.group_add(self.room_name, self.channel_name)
-                    await self.channel_layer.group_send(
-                        self.room_name,
-                        {"type": "chat_message", "message": "You are now connected!", "sender_id": None}
+                    await self.channel_layer.send(
+                        entry["channel"], {"type": "match_found", "room_id": room_id, "room_pk": self.room_pk}
                     )
+                    await dashboard.room_paired(entry, f"admin:{self.user.username}")
                     # Send history to admin after connecting
-                    history = await self.get_last_messages(room_id)
-                    await self.send(text_data=json.dumps({"status": "connected", "room_id": self.room_name}))
-                    await self.send(text_data=json.dumps({"type": "history", "messages": history}))
+                    history = await self.get_history(room_id)
+                    await self.send_frame({"status": "connected", "room_id": self.room_name})
+                    await self.send_frame({"type": "history", **history})
                 else:
-                    await self.send(text_data=json.dumps({"status": "failed", "reason": "not_waiting_or_missing"}))
+                    await self.send_frame({"status": "failed", "reason": "not_waiting_or_missing"})
         elif action == "delete_room":
             room_id = data.get("room_id") or self.room_name
             if room_id:
@@ -208,65 +604,86 @@ class AdminConsumer(AsyncWebsocketConsumer):
                     {"type": "chat_message", "message": "Room deleted by admin.", "sender_id": None}
                 )
                 await self.channel_layer.group_send(room_id, {"type": "force_close"})
-                await self.delete_room_record(room_id)
-                await self.send(text_data=json.dumps({"status": "deleted", "room_id": room_id}))
+                room = await rooms.delete_room_record(room_id)
+                await get_recent_messages().discard(room_id)
+                if room is not None:
+                    await dashboard.room_deleted(
+                        room_id,
+                        was_active=room["active"] and room["user2"] is not None,
+                        was_waiting=room["active"] and room["user2"] is None,
+                    )
+                await self.send_frame({"status": "deleted", "room_id": room_id})
         elif action == "delete_all":
-            # Notify all rooms, close sockets, then delete all
-            room_ids = await self.get_all_room_ids()
-            for rid in room_ids:
-                rid_str = str(rid)
-                await self.channel_layer.group_send(
-                    rid_str,
-                    {"type": "chat_message", "message": "All rooms are being deleted by admin.", "sender_id": None}
-                )
-                await self.channel_layer.group_send(rid_str, {"type": "force_close"})
-            await self.delete_all_rooms()
-            await self.send(text_data=json.dumps({"status": "deleted_all"}))
+            # One broadcast closes every chat; rows are deleted in chunks in the background
+            if not start_delete_all(progress=self.report_teardown, done=self.finish_teardown):
+                await self.send_frame({"status": "failed", "reason": "delete_all_running"})
+                return
+            await close_all_chats("All rooms are being deleted by admin.")
+            await self.send_frame({"status": "deleting_all"})
+        elif action == "kill_all":
+            await close_all_chats("Session terminated by admin.")
+            ended = await rooms.deactivate_all_rooms()
+            await dashboard.refresh()
+            await self.send_frame({"status": "killed_all", "rooms": ended})
+
+    async def report_teardown(self, stats):
+        # Through the channel layer: the job outlives this socket if the admin leaves
+        await self.channel_layer.send(self.channel_name, {"type": "teardown_progress", **stats})
+
+    async def finish_teardown(self, stats):
+        await get_recent_messages().clear()
+        await dashboard.refresh()
+        await self.channel_layer.send(self.channel_name, {"type": "teardown_done", "stats": stats})
+
+    async def teardown_progress(self, event):
+        await self.send_frame({
+            "status": "deleting_all", "rooms": event["rooms"], "messages": event["messages"],
+        })
+
+    async def teardown_done(self, event):
+        if event["stats"] is None:
+            await self.send_frame({"status": "failed", "reason": "delete_all_failed"})
+        else:
+            await self.send_frame({"status": "deleted_all", **event["stats"]})
 
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps({"message": event.get("message")}))
-
-    @database_sync_to_async
-    def get_last_messages(self, room_id, limit=50):
-        try:
-            room = ChatRoom.objects.get(room_id=room_id)
-        except ChatRoom.DoesNotExist:
-            return []
-        qs = room.messages.order_by("-timestamp").values("sender", "content", "timestamp")[:limit]
-        # Return in chronological order
-        items = list(qs)[::-1]
-        for item in items:
-            item["timestamp"] = item["timestamp"].isoformat()
-        return items
-
-    @database_sync_to_async
-    def save_message(self, room_id, sender, content):
-        try:
-            room = ChatRoom.objects.get(room_id=room_id)
-            Message.objects.create(room=room, sender=sender, content=content)
-        except ChatRoom.DoesNotExist:
-            return
+        await self.send_frame({"message": event.get("message")})
 
-    @database_sync_to_async
-    def delete_room_record(self, room_id):
-        ChatRoom.objects.filter(room_id=room_id).delete()
+    async def admin_watching(self, event):
+        # Our own and other admins' watch notices reach the room group too
+        pass
 
-    @database_sync_to_async
-    def get_all_room_ids(self):
-        return list(ChatRoom.objects.values_list("room_id", flat=True))
+    async def partner_away(self, event):
+        await self.send_frame({"status": "participant_away", "participant": event["sender_id"], "grace": event["grace"]})
 
-    @database_sync_to_async
-    def delete_all_rooms(self):
-        ChatRoom.objects.all().delete()
+    async def partner_back(self, event):
+        await self.send_frame({"status": "participant_back", "participant": event["sender_id"]})
 
-    @database_sync_to_async
-    def claim_waiting_room(self, room_id: str, admin_label: str) -> bool:
-        try:
-            room = ChatRoom.objects.get(room_id=room_id)
-        except ChatRoom.DoesNotExist:
-            return False
-        if not room.active or room.user2:
-            return False
-        room.user2 = admin_label
-        room.save(update_fields=["user2"])
-        return True
+    async def partner_left(self, event):
+        await self.send_frame({"status": "participant_left", "participant": event["sender_id"]})
+
+    async def watch_started(self, event):
+        # A participant now copies its messages to the room group
+        await self.send_frame({"status": "observing", "participant": event["participant"]})
+
+    async def dashboard_event(self, event):
+        await self.send_frame(event)
+
+    async def dashboard_snapshot(self, event):
+        await self.send_frame(event)
+
+    async def get_history(self, room_id, before=None, limit=50):
+        # The latest page usually comes straight from the recent-message buffer
+        if before is None:
+            page = await latest_page(room_id, limit)
+            if page is not None:
+                return page
+        return await db.run(message_page, room_messages(room_id), before=before, limit=limit)
+
+    async def save_message(self, sender, content):
+        if self.room_pk is None:
+            self.room_pk = await get_room_pk(self.room_name)
+            if self.room_pk is None:
+                return
+        message = get_message_writer().add(self.room_pk, sender, content)
+        await get_recent_messages().add(self.room_name, message)
@@ -0,0 +1,143 @@
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from .db import run
+from .matchmaking import get_match_queue
+from .models import ChatRoom
+from .redis_client import get_redis
+
+COUNTERS = ("total_rooms", "active_rooms", "waiting_count")
+
+
+class CacheCounters:
+    """
+    Room counters in Django's cache. ``incr`` is atomic on the Redis and
+    memcached backends; with the default local-memory cache the counts are
+    per process.
+    """
+
+    prefix = "chat:counters:"
+
+    def key(self, name):
+        return self.prefix + name
+
+    async def read(self):
+        values = await cache.aget_many([self.key(name) for name in COUNTERS])
+        if len(values) < len(COUNTERS):
+            return None
+        return {name: values[self.key(name)] for name in COUNTERS}
+
+    async def apply(self, changes):
+        for name, change in changes.items():
+            if not change:
+                continue
+            try:
+                await cache.aincr(self.key(name), change)
+            except ValueError:
+                # Evicted or never set; the caller reconciles from the database
+                return None
+        return await self.read()
+
+    async def store(self, values):
+        await cache.aset_many({self.key(name): values[name] for name in COUNTERS}, timeout=None)
+
+
+# Apply every change or none: a missing hash means the counters need a reconcile
+APPLY = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+for i = 1, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+return redis.call('HMGET', KEYS[1], 'total_rooms', 'active_rooms', 'waiting_count')
+"""
+
+
+class RedisCounters:
+    """Room counters in one Redis hash shared by all workers."""
+
+    def __init__(self, key="chat:counters"):
+        self.key = key
+
+    def decode(self, values):
+        if not values or None in values:
+            return None
+        return dict(zip(COUNTERS, map(int, values)))
+
+    async def read(self):
+        return self.decode(await get_redis().hmget(self.key, *COUNTERS))
+
+    async def apply(self, changes):
+        args = [item for name, change in changes.items() if change for item in (name, change)]
+        return self.decode(await get_redis().eval(APPLY, 1, self.key, *args))
+
+    async def store(self, values):
+        await get_redis().hset(self.key, mapping={name: values[name] for name in COUNTERS})
+
+
+COUNTER_BACKENDS = {
+    "cache": CacheCounters,
+    "redis": RedisCounters,
+}
+
+_counters = {}
+
+
+def get_counters():
+    backend = settings.CHAT_COUNTERS
+    counters = _counters.get(backend)
+    if counters is None:
+        if backend not in COUNTER_BACKENDS:
+            raise ImproperlyConfigured(f"Unknown CHAT_COUNTERS backend {backend!r}")
+        counters = _counters[backend] = COUNTER_BACKENDS[backend]()
+    return counters
+
+
+def database_counts():
+    return {
+        "total_rooms": ChatRoom.objects.count(),
+        "active_rooms": ChatRoom.objects.filter(active=True, user2__isnull=False).count(),
+    }
+
+
+def _background_counts():
+    try:
+        return database_counts()
+    finally:
+        connection.close()
+
+
+async def reconcile(background=False):
+    """
+    Recount rooms from the database and the match queue and overwrite the
+    counters. Changes applied while the recount runs can be lost; the next
+    reconcile corrects them. ``background`` keeps the COUNTs off the shared
+    database thread.
+    """
+    if background:
+        values = await database_sync_to_async(_background_counts, thread_sensitive=False)()
+    else:
+        values = await run(database_counts)
+    queue = get_match_queue()
+    values["waiting_count"] = await queue.size()
+    # Waiting users live in the matchmaking queue until they are paired
+    if not queue.records_waiting:
+        values["total_rooms"] += values["waiting_count"]
+    await get_counters().store(values)
+    return values
+
+
+async def read_counters():
+    return await get_counters().read() or await reconcile()
+
+
+async def apply_changes(changes):
+    """Apply counter ``changes`` and return the new values, reconciling if they were lost."""
+    return await get_counters().apply(changes) or await reconcile()
+
+
+async def reconcile_in_background():
+    await reconcile(background=True)
@@ -0,0 +1,106 @@
+from datetime import datetime, timezone
+from channels.layers import get_channel_layer
+from . import db, outbox, ratelimit
+from .counters import apply_changes, read_counters, reconcile
+from .db import db_call
+from .matchmaking import get_match_queue
+from .models import ChatRoom
+
+# Admin sockets subscribed to live room updates
+DASHBOARD_GROUP = "admin-dashboard"
+RECENT_LIMIT = 50
+
+
+async def rooms_summary():
+    """
+    The dashboard snapshot: counters plus the latest active and waiting
+    rooms, plus outbound queue, rate limit and database executor figures
+    of the process serving the request.
+    """
+    summary = await read_counters()
+    summary["recent_active"] = await recent_active()
+    summary["recent_waiting"] = [waiting_room(entry) for entry in await get_match_queue().waiting(RECENT_LIMIT)]
+    summary["outbound"] = outbox.metrics()
+    summary["rate_limits"] = ratelimit.metrics()
+    summary["database"] = db.metrics()
+    return summary
+
+
+@db_call
+def recent_active():
+    rooms = ChatRoom.objects.filter(active=True, user2__isnull=False).order_by("-created_at")
+    return [active_room(room) for room in rooms[:RECENT_LIMIT]]
+
+
+def active_room(room):
+    return {
+        "id": room.id,
+        "room_id": str(room.room_id),
+        "user1": room.user1,
+        "user2": room.user2,
+        "user1_location": room.user1_location,
+        "user2_location": room.user2_location,
+        "active": room.active,
+        "created_at": room.created_at.isoformat(),
+        "updated_at": room.updated_at.isoformat()
+    }
+
+
+def waiting_room(entry):
+    return {
+        "room_id": entry["room_id"],
+        "user1": entry["user"],
+        "user2": None,
+        "user1_location": entry.get("location"),
+        "user2_location": None,
+        "active": True,
+        "created_at": datetime.fromtimestamp(entry["since"], tz=timezone.utc).isoformat(),
+    }
+
+
+def paired_room(waiting, user2, location=None):
+    """Dashboard row for a waiting entry that has just been claimed by ``user2``."""
+    return dict(waiting_room(waiting), user2=user2, user2_location=location)
+
+
+async def publish(event, room, total=0, active=0, waiting=0):
+    """
+    Apply a room lifecycle ``event`` to the live counters and push it to
+    subscribed admin sockets with the new counts, so dashboards stay in
+    step without re-querying.
+    """
+    counts = await apply_changes({"total_rooms": total, "active_rooms": active, "waiting_count": waiting})
+    await get_channel_layer().group_send(DASHBOARD_GROUP, {
+        "type": "dashboard_event",
+        "event": event,
+        "room": room,
+        "counts": counts,
+    })
+
+
+async def room_waiting(entry):
+    await publish("waiting", waiting_room(entry), total=1, waiting=1)
+
+
+async def room_paired(waiting, user2, location=None):
+    await publish("paired", paired_room(waiting, user2, location), active=1, waiting=-1)
+
+
+async def waiting_left(room_id):
+    # A waiting row stays behind (closed) when the queue records waiting rooms
+    total = 0 if get_match_queue().records_waiting else -1
+    await publish("ended", {"room_id": room_id}, total=total, waiting=-1)
+
+
+async def room_ended(room_id):
+    await publish("ended", {"room_id": room_id}, active=-1)
+
+
+async def room_deleted(room_id, was_active=False, was_waiting=False):
+    await publish("deleted", {"room_id": room_id}, total=-1, active=-int(was_active), waiting=-int(was_waiting))
+
+
+async def refresh():
+    """Recount and send every subscriber a fresh snapshot, after bulk changes."""
+    await reconcile()
+    await get_channel_layer().group_send(DASHBOARD_GROUP, {"type": "dashboard_snapshot", **await rooms_summary()})
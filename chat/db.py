@@ -0,0 +1,88 @@
+"""
+The thread that chat code runs ORM calls on.
+
+Django's async ORM methods (``aget``, ``acreate``, ...) are sync_to_async
+wrappers around the sync ones, on the single thread-sensitive thread that
+every database_sync_to_async call of the process shares. Chat rooms and
+messages instead go through ``db_call``, which runs them on an executor of
+their own with DATABASE_THREADS threads. With ``0`` they share the
+thread-sensitive thread as before, which tests need because their
+transaction is only visible on that thread's connection.
+
+``metrics()`` reports calls in flight and how long calls waited for a
+thread, to size DATABASE_THREADS (and DATABASE_POOL_MAX_SIZE with it) for
+each daphne process.
+"""
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+_executor = None
+_counts = {"calls": 0, "in_flight": 0, "max_in_flight": 0, "wait": 0.0, "max_wait": 0.0, "run": 0.0}
+
+
+def metrics():
+    """Database calls of this process: in flight now and at most, and their average/worst queue wait."""
+    calls = _counts["calls"]
+    return {
+        "threads": settings.DATABASE_THREADS,
+        "calls": calls,
+        "in_flight": _counts["in_flight"],
+        "max_in_flight": _counts["max_in_flight"],
+        "wait_ms": round(_counts["wait"] / calls * 1000, 3) if calls else 0,
+        "max_wait_ms": round(_counts["max_wait"] * 1000, 3),
+        "run_ms": round(_counts["run"] / calls * 1000, 3) if calls else 0,
+    }
+
+
+def reset_metrics():
+    # Calls still running stay counted as in flight
+    _counts.update(calls=0, max_in_flight=_counts["in_flight"], wait=0.0, max_wait=0.0, run=0.0)
+
+
+def get_executor():
+    global _executor
+    threads = settings.DATABASE_THREADS
+    if _executor is None or _executor._max_workers != threads:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        _executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="chat-db")
+    return _executor
+
+
+async def run(func, *args, **kwargs):
+    """``func(*args, **kwargs)`` on the database executor, closing stale connections around it."""
+    started = []
+
+    def call():
+        started.append(time.perf_counter())
+        return func(*args, **kwargs)
+
+    if settings.DATABASE_THREADS:
+        runner = database_sync_to_async(call, thread_sensitive=False, executor=get_executor())
+    else:
+        runner = database_sync_to_async(call)
+    # Counted on the event loop, so no lock is needed
+    queued = time.perf_counter()
+    _counts["in_flight"] += 1
+    _counts["max_in_flight"] = max(_counts["max_in_flight"], _counts["in_flight"])
+    try:
+        return await runner()
+    finally:
+        _counts["in_flight"] -= 1
+        if started:
+            wait = started[0] - queued
+            _counts["calls"] += 1
+            _counts["wait"] += wait
+            _counts["max_wait"] = max(_counts["max_wait"], wait)
+            _counts["run"] += time.perf_counter() - started[0]
+
+
+def db_call(func):
+    """Decorator form of ``run`` for functions and consumer methods."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+    return wrapper
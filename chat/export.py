@@ -0,0 +1,115 @@
+import csv
+import io
+import json
+import uuid
+import zlib
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.dateparse import parse_datetime
+from .models import Message
+
+# Output column -> Message lookup
+EXPORT_FIELDS = {
+    "room_id": "room__room_id",
+    "sender": "sender",
+    "content": "content",
+    "timestamp": "timestamp",
+}
+CONTENT_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+CHUNK_SIZE = 2000
+# Encoded rows are buffered up to this many bytes before being handed on
+FLUSH_BYTES = 64 * 1024
+
+
+def parse_filters(room=None, sender=None, since=None, until=None):
+    """Validate raw filter strings; raises ValueError for a bad room or datetime."""
+    filters = {"room": uuid.UUID(room) if room else None, "sender": sender or None}
+    for name, value in (("since", since), ("until", until)):
+        if value:
+            parsed = parse_datetime(value)
+            if parsed is None:
+                raise ValueError(f"{name} must be an ISO 8601 datetime")
+            filters[name] = parsed
+        else:
+            filters[name] = None
+    return filters
+
+
+def export_queryset(room=None, sender=None, since=None, until=None):
+    messages = Message.objects.all()
+    if room:
+        messages = messages.filter(room__room_id=room)
+    if sender:
+        messages = messages.filter(sender=sender)
+    if since:
+        messages = messages.filter(timestamp__gte=since)
+    if until:
+        messages = messages.filter(timestamp__lt=until)
+    # Conversations stay together and read in order
+    # values() rather than values_list(): only the former streams through aiterator()
+    return messages.order_by("room_id", "timestamp", "pk").values(*EXPORT_FIELDS.values())
+
+
+class TranscriptEncoder:
+    """
+    Turns message rows into NDJSON or CSV bytes, optionally gzipped. Rows
+    are buffered up to FLUSH_BYTES so a stream yields a few large chunks
+    rather than one per message.
+    """
+
+    def __init__(self, fmt="ndjson", compress=False):
+        if fmt not in CONTENT_TYPES:
+            raise ValueError(f"format must be one of {', '.join(CONTENT_TYPES)}")
+        self.fmt = fmt
+        self.compressor = zlib.compressobj(wbits=31) if compress else None
+        self._text = io.StringIO()
+        self._csv = csv.writer(self._text) if fmt == "csv" else None
+        if self._csv:
+            self._csv.writerow(EXPORT_FIELDS)
+
+    @property
+    def content_type(self):
+        return "application/gzip" if self.compressor else CONTENT_TYPES[self.fmt]
+
+    @property
+    def extension(self):
+        return f"{self.fmt}.gz" if self.compressor else self.fmt
+
+    def encode(self, row):
+        row = [row[lookup] for lookup in EXPORT_FIELDS.values()]
+        if self._csv:
+            self._csv.writerow(value.isoformat() if hasattr(value, "isoformat") else value for value in row)
+        else:
+            self._text.write(json.dumps(dict(zip(EXPORT_FIELDS, row)), cls=DjangoJSONEncoder) + "\n")
+        if self._text.tell() >= FLUSH_BYTES:
+            return self._drain()
+        return b""
+
+    def end(self):
+        data = self._drain()
+        if self.compressor:
+            data += self.compressor.flush()
+        return data
+
+    def _drain(self):
+        data = self._text.getvalue().encode("utf-8")
+        self._text.seek(0)
+        self._text.truncate()
+        return self.compressor.compress(data) if self.compressor else data
+
+
+def stream_export(queryset, encoder):
+    for row in queryset.iterator(chunk_size=CHUNK_SIZE):
+        data = encoder.encode(row)
+        if data:
+            yield data
+    yield encoder.end()
+
+
+async def astream_export(queryset, encoder):
+    # Async twin for StreamingHttpResponse under ASGI, which would otherwise
+    # read a synchronous iterator to the end before sending anything
+    async for row in queryset.aiterator(chunk_size=CHUNK_SIZE):
+        data = encoder.encode(row)
+        if data:
+            yield data
+    yield encoder.end()
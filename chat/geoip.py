@@ -0,0 +1,131 @@
+"""
+Offline IP geolocation. Client locations come from a local IP-range CSV in
+the layout of DB-IP's "IP to City Lite" (start, end, continent, country,
+region, city, latitude, longitude; optionally gzipped), so connects need no
+network round trip and clients cannot pick their own country.
+"""
+import asyncio
+import csv
+import gzip
+import ipaddress
+import threading
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from django.conf import settings
+
+
+def parse_ip(address):
+    """(version, integer) of an IPv4 or IPv6 address; ValueError if it is neither."""
+    ip = ipaddress.ip_address(address.strip())
+    return ip.version, int(ip)
+
+
+class GeoIPDatabase:
+    """
+    IP ranges as sorted start/end arrays per address family, each pointing at
+    one of the distinct locations; a lookup is a binary search, and the last
+    ``cache_size`` answers are kept in an LRU.
+    """
+
+    def __init__(self, ranges, cache_size=10_000):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self.locations = []
+        index = {}
+        # IPv4 fits 32-bit arrays; IPv6 needs Python ints
+        self.v4 = (array("I"), array("I"), array("I"))
+        self.v6 = ([], [], array("I"))
+        for version, start, end, location in sorted(ranges, key=lambda r: r[:2]):
+            key = tuple(location.items())
+            if key not in index:
+                index[key] = len(self.locations)
+                self.locations.append(location)
+            starts, ends, found = self.v4 if version == 4 else self.v6
+            starts.append(start)
+            ends.append(end)
+            found.append(index[key])
+
+    @classmethod
+    def load(cls, path, cache_size=10_000):
+        opener = gzip.open if str(path).endswith(".gz") else open
+        with opener(path, "rt", newline="", encoding="utf-8") as f:
+            return cls(cls.parse(csv.reader(f)), cache_size)
+
+    @staticmethod
+    def parse(rows):
+        for row in rows:
+            if len(row) < 8:
+                continue
+            try:
+                (version, start), (end_version, end) = parse_ip(row[0]), parse_ip(row[1])
+                latitude, longitude = float(row[6]), float(row[7])
+            except ValueError:
+                # Header lines and malformed rows
+                continue
+            if version != end_version or end < start:
+                continue
+            yield version, start, end, {
+                "continent": row[2] or None,
+                "country": row[3] or None,
+                "city": row[5] or None,
+                "latitude": latitude,
+                "longitude": longitude,
+            }
+
+    def __len__(self):
+        return len(self.v4[0]) + len(self.v6[0])
+
+    def lookup(self, address):
+        """The location of ``address`` as a new dict, or None if it is unknown or not an IP."""
+        location = self._cache.get(address)
+        if location is not None or address in self._cache:
+            self._cache.move_to_end(address)
+        else:
+            location = self._search(address)
+            self._cache[address] = location
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return None if location is None else dict(location, method="ip_based")
+
+    def _search(self, address):
+        try:
+            version, ip = parse_ip(address)
+        except ValueError:
+            return None
+        starts, ends, found = self.v4 if version == 4 else self.v6
+        i = bisect_right(starts, ip) - 1
+        if i < 0 or ip > ends[i]:
+            return None
+        return self.locations[found[i]]
+
+
+_databases = {}
+_loading = threading.Lock()
+
+
+def get_geoip():
+    """The CHAT_GEOIP_DATABASE file, loaded once per process; None when unset."""
+    path = settings.CHAT_GEOIP_DATABASE
+    if not path:
+        return None
+    database = _databases.get(path)
+    if database is None:
+        with _loading:
+            database = _databases.get(path)
+            if database is None:
+                database = _databases[path] = GeoIPDatabase.load(path, settings.CHAT_GEOIP_CACHE_SIZE)
+    return database
+
+
+async def locate(address):
+    """
+    The location of a client IP, or None. backend.asgi loads the file at
+    startup; elsewhere the first call loads it off the event loop.
+    """
+    if not address or not settings.CHAT_GEOIP_DATABASE:
+        return None
+    database = _databases.get(settings.CHAT_GEOIP_DATABASE)
+    if database is None:
+        database = await asyncio.to_thread(get_geoip)
+    return database.lookup(address)
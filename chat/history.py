@@ -0,0 +1,151 @@
+import base64
+from datetime import datetime
+from django.db.models import Q
+from .db import run
+from .models import Message
+from .persistence import get_message_writer
+from .recent import get_recent_messages
+
+MESSAGE_FIELDS = ("pk", "sender", "content", "timestamp", "sender_profile__is_anonymous")
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(message):
+    raw = f"{message['timestamp'].isoformat()}|{message['pk']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def time_cursor(timestamp):
+    """A cursor seeking strictly before or after the ISO timestamp ``timestamp``."""
+    return base64.urlsafe_b64encode(f"{timestamp}|".encode()).decode()
+
+
+def buffered_cursor(messages, index):
+    """
+    The cursor at ``messages[index]`` of a page from the recent-message
+    buffer. Buffered messages have no id yet, so instead of one it records
+    how many messages of the page share that timestamp; seeking past the
+    cursor skips that many rows at the timestamp and keeps the rest.
+    """
+    timestamp = messages[index]["timestamp"]
+    served = sum(1 for message in messages if message["timestamp"] == timestamp)
+    return base64.urlsafe_b64encode(f"{timestamp}||{served}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Return ``(timestamp, pk, served)``. pk is None for cursors without an
+    id, and served (the rows at the timestamp already shown) is None unless
+    the cursor came from a buffered page. Raises ValueError for a malformed
+    cursor.
+    """
+    try:
+        timestamp, pk, *served = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        if len(served) > 1:
+            raise ValueError("too many fields")
+        served = int(served[0]) if served else None
+        return datetime.fromisoformat(timestamp), int(pk) if pk else None, served
+    except (AttributeError, TypeError, ValueError) as exc:
+        raise ValueError("invalid cursor") from exc
+
+
+def seek(timestamp, pk, served, older):
+    if served is not None:
+        # Rows at the timestamp stay in; skip_served drops the ones already shown
+        return Q(timestamp__lte=timestamp) if older else Q(timestamp__gte=timestamp)
+    if pk is None:
+        return Q(timestamp__lt=timestamp) if older else Q(timestamp__gt=timestamp)
+    if older:
+        return Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, pk__lt=pk)
+    return Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, pk__gt=pk)
+
+
+def skip_served(rows, timestamp, served):
+    """Drop the first ``served`` of ``rows`` that sit at ``timestamp``; a buffered page already showed them."""
+    skipped = 0
+    while skipped < min(served or 0, len(rows)) and rows[skipped]["timestamp"] == timestamp:
+        skipped += 1
+    return rows[skipped:]
+
+
+def message_page(messages, before=None, after=None, limit=50):
+    """
+    One page of ``messages`` (a Message queryset already filtered to a room)
+    in chronological order, seeking on ``(timestamp, pk)`` instead of using
+    OFFSET or COUNT so every page costs one indexed query.
+
+    Without cursors the page holds the latest messages. ``before`` pages
+    back from a cursor and ``after`` forward from it. The result carries the
+    cursors for the neighbouring pages; ``before`` is None once the start of
+    the room is reached.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    messages = messages.values(*MESSAGE_FIELDS)
+    if after:
+        timestamp, pk, served = decode_cursor(after)
+        rows = messages.filter(seek(timestamp, pk, served, older=False)).order_by("timestamp", "pk")
+        rows = skip_served(list(rows[:limit + (served or 0)]), timestamp, served)[:limit]
+        has_older = True
+    else:
+        timestamp = served = None
+        if before:
+            timestamp, pk, served = decode_cursor(before)
+            messages = messages.filter(seek(timestamp, pk, served, older=True))
+        # One extra row tells whether an older page exists
+        rows = list(messages.order_by("-timestamp", "-pk")[:limit + 1 + (served or 0)])
+        rows = skip_served(rows, timestamp, served)[:limit + 1]
+        has_older = len(rows) > limit
+        rows = rows[:limit][::-1]
+    return {
+        "messages": [serialize(row) for row in rows],
+        "before": encode_cursor(rows[0]) if rows and has_older else None,
+        "after": encode_cursor(rows[-1]) if rows else after,
+    }
+
+
+def serialize(row):
+    anonymous = row["sender_profile__is_anonymous"]
+    return {
+        "sender": row["sender"],
+        "content": row["content"],
+        "timestamp": row["timestamp"].isoformat(),
+        "sender_profile": True if anonymous is None else anonymous,
+    }
+
+
+def room_messages(room_id):
+    return Message.objects.filter(room__room_id=room_id)
+
+
+async def latest_page(room_id, limit=50):
+    """
+    The latest page of a room from the recent-message buffer, shaped like
+    ``message_page``, or None when the buffer cannot fill it.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    messages = await get_recent_messages().get(room_id, limit)
+    if messages is None:
+        return None
+    return {
+        "messages": messages,
+        # A short page only comes from a buffer holding the whole room
+        "before": buffered_cursor(messages, 0) if len(messages) == limit else None,
+        "after": buffered_cursor(messages, -1) if messages else None,
+    }
+
+
+async def missed_messages(room_id, after):
+    """
+    Messages of a room sent after the ISO timestamp ``after``, oldest first,
+    from the recent-message buffer when it covers them and the database
+    otherwise.
+    """
+    messages = await get_recent_messages().since(room_id, after)
+    if messages is not None:
+        return messages
+    # Buffered rows of this worker have to be in the table before we read it
+    await get_message_writer().flush()
+    page = await run(
+        message_page, room_messages(room_id), after=time_cursor(after), limit=MAX_PAGE_SIZE
+    )
+    return page["messages"]
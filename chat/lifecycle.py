@@ -0,0 +1,49 @@
+import asyncio
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+_shutdown_hooks = []
+_daphne_hooked = False
+
+
+def on_shutdown(hook):
+    """Register an async callable to run once when the server stops."""
+    if hook not in _shutdown_hooks:
+        _shutdown_hooks.append(hook)
+    _hook_into_daphne()
+
+
+async def run_shutdown_hooks():
+    for hook in list(_shutdown_hooks):
+        try:
+            await hook()
+        except Exception:
+            logger.exception("Shutdown hook %r failed", hook)
+
+
+async def lifespan(scope, receive, send):
+    """ASGI lifespan handler for servers that send lifespan events (uvicorn)."""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await run_shutdown_hooks()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+def _hook_into_daphne():
+    # Daphne has no lifespan support but runs on twisted's asyncio reactor,
+    # so run the hooks from a "before shutdown" trigger on that loop
+    global _daphne_hooked
+    if _daphne_hooked or "twisted.internet.reactor" not in sys.modules:
+        return
+    from twisted.internet import defer, reactor
+    reactor.addSystemEventTrigger(
+        "before", "shutdown",
+        lambda: defer.Deferred.fromFuture(asyncio.ensure_future(run_shutdown_hooks())),
+    )
+    _daphne_hooked = True
@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chat.retention import archive_ended_rooms
+
+
+class Command(BaseCommand):
+    help = (
+        "Archive ended chat rooms and their messages to gzipped JSONL files, "
+        "one per chunk, then delete them from the database in bounded batches."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=settings.CHAT_RETENTION_DAYS,
+                            help="Only rooms that ended more than this many days ago")
+        parser.add_argument("--archive-dir", default=str(settings.CHAT_ARCHIVE_DIR))
+        parser.add_argument("--chunk-size", type=int, default=500, help="Rooms read per chunk")
+        parser.add_argument("--delete-batch", type=int, default=1000, help="Rows per DELETE statement")
+        parser.add_argument("--dry-run", action="store_true", help="Only count what would be archived")
+
+    def handle(self, *args, **options):
+        stats = archive_ended_rooms(
+            options["days"],
+            options["archive_dir"],
+            chunk_size=options["chunk_size"],
+            delete_batch=options["delete_batch"],
+            dry_run=options["dry_run"],
+            log=self.stdout.write,
+        )
+        if options["dry_run"]:
+            self.stdout.write(f"Would archive {stats['rooms']} rooms and {stats['messages']} messages")
+        elif stats["files"]:
+            self.stdout.write(self.style.SUCCESS(
+                f"Archived {stats['rooms']} rooms and {stats['messages']} messages "
+                f"to {len(stats['files'])} files in {options['archive_dir']}"
+            ))
+        else:
+            self.stdout.write("Nothing to archive")
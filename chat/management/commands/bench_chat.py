@@ -0,0 +1,175 @@
+import asyncio
+import itertools
+import json
+import platform
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from channels.layers import channel_layers
+from chat import bench, db, outbox
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive ChatConsumer and AdminConsumer with simulated clients and report "
+        "connects/sec, time-to-match, message fan-out latency and memory per "
+        "connection. Runs in-process against a throwaway test database (one run "
+        "per channel layer), or against a running server with --url."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=1000)
+        parser.add_argument("--messages", type=int, default=5, help="Messages sent by each client")
+        parser.add_argument("--admins", type=int, default=10, help="Admin observers, one per room (in-process only)")
+        parser.add_argument("--concurrency", type=int, default=200, help="Concurrent handshakes")
+        parser.add_argument("--timeout", type=float, default=30.0)
+        parser.add_argument("--layers", nargs="+", choices=["memory", "redis"], default=["memory", "redis"])
+        parser.add_argument("--delivery", nargs="+", choices=["direct", "group"], default=["direct"],
+                            help="Message delivery modes to run; 'group' fans out to the room group (in-process only)")
+        parser.add_argument("--protocols", nargs="+", choices=["legacy", "json", "msgpack"], default=["legacy"],
+                            help="Wire protocols to run; legacy asks for no subprotocol")
+        parser.add_argument("--redis-url", help="Real Redis for the redis layer; defaults to an in-process fakeredis server")
+        parser.add_argument("--url", help="ws:// URL of a running chat endpoint, e.g. ws://127.0.0.1:8000/ws/chat/")
+        parser.add_argument("--output", default="bench_results.json", help="Where to save results as JSON")
+        parser.add_argument("--compare", help="Earlier results file to compare against")
+
+    def handle(self, *args, **options):
+        scenario = {
+            "clients": options["clients"],
+            "messages": options["messages"],
+            "concurrency": options["concurrency"],
+            "timeout": options["timeout"],
+        }
+        try:
+            codecs = {name: bench.get_codec(name) for name in options["protocols"]}
+        except ValueError as exc:
+            raise CommandError(exc)
+        if options["url"]:
+            runs = [self.run_socket(options["url"], name, codec, scenario) for name, codec in codecs.items()]
+        else:
+            runs = self.run_in_process(
+                options["layers"], options["delivery"], codecs, options["redis_url"], options["admins"], scenario
+            )
+
+        for run in runs:
+            self.report(run)
+        results = {
+            "created": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "runs": runs,
+        }
+        Path(options["output"]).write_text(json.dumps(results, indent=2))
+        self.stdout.write(f"Saved results to {options['output']}")
+
+        if options["compare"]:
+            baseline = json.loads(Path(options["compare"]).read_text())
+            for run, metric, before, after, change in bench.compare(runs, baseline["runs"]):
+                self.stdout.write(f"{run:<20} {metric:<28} {before:>12} -> {after:<12} ({change:+.1f}%)")
+
+    def run_socket(self, url, name, codec, scenario):
+        run = asyncio.run(bench.run_scenario(
+            lambda: bench.SocketClient(url, codec=codec), measure_memory=False, **scenario
+        ))
+        return {
+            "mode": "socket", "layer": "server", "delivery": "server", "protocol": name, "url": url,
+            "codec": bench.codec_cost(codec), **run,
+        }
+
+    def run_in_process(self, layers, deliveries, codecs, redis_url, admins, scenario):
+        from django.contrib.auth.models import User
+        from backend.asgi import application
+        from chat.consumers import AdminConsumer
+
+        admin_consumer = AdminConsumer.as_asgi()
+
+        runs = []
+        fake_server = None
+        with tempfile.TemporaryDirectory() as tmp, self.test_database(tmp):
+            staff = User.objects.create(username="bench-admin", is_staff=True)
+
+            async def admin_app(scope, receive, send):
+                return await admin_consumer(dict(scope, user=staff), receive, send)
+
+            for layer in layers:
+                if layer == "redis" and not redis_url:
+                    if fake_server is None:
+                        fake_server, fake_url = bench.start_fake_redis()
+                    url = fake_url
+                else:
+                    url = redis_url
+                for delivery, (name, codec) in itertools.product(deliveries, codecs.items()):
+                    # Simulated clients send as fast as they can; rate limits would cap the run
+                    overrides = dict(
+                        bench.layer_settings(layer, url),
+                        CHAT_DIRECT_DELIVERY=delivery == "direct", CHAT_RATE_LIMITS={}, CHAT_IP_RATE_LIMITS={},
+                    )
+                    with override_settings(**overrides):
+                        channel_layers.backends.clear()
+                        outbox.reset_metrics()
+                        db.reset_metrics()
+                        run = asyncio.run(bench.run_scenario(
+                            lambda: bench.InProcessClient(application, "/ws/chat/", codec),
+                            make_admin=lambda: bench.InProcessClient(admin_app, "/ws/admin/", codec),
+                            admins=admins,
+                            **scenario,
+                        ))
+                    runs.append({
+                        "mode": "inprocess", "layer": layer, "delivery": delivery, "protocol": name,
+                        "fake_redis": layer == "redis" and not redis_url, "codec": bench.codec_cost(codec), "outbound": outbox.metrics(), "database": db.metrics(), **run,
+                    })
+            channel_layers.backends.clear()
+        if fake_server is not None:
+            fake_server.shutdown()
+        return runs
+
+    def test_database(self, tmp):
+        # A file-backed SQLite test database behaves like the real one under
+        # concurrent writers; shared-cache in-memory SQLite fails with table locks
+        if connection.vendor == "sqlite":
+            settings.DATABASES["default"].setdefault("TEST", {})["NAME"] = str(Path(tmp) / "bench.sqlite3")
+        return TestDatabase()
+
+    def report(self, run):
+        self.stdout.write(
+            f"== {run['mode']} / {run['layer']} / {run['delivery']} / {run['protocol']}: "
+            f"{run['clients']} clients, {run['messages']} messages each"
+        )
+        self.stdout.write(f"  connects/sec          {run['connects_per_sec']}")
+        self.stdout.write(f"  messages/sec          {run['messages_per_sec']}")
+        for name in ("time_to_match_ms", "fanout_ms", "admin_fanout_ms"):
+            stats = run[name]
+            self.stdout.write(f"  {name:<21} p50={stats['p50']} p99={stats['p99']} max={stats['max']} (n={stats['count']})")
+        self.stdout.write(f"  memory/connection KiB {run['memory_per_connection_kb']}")
+        self.stdout.write(f"  CPU/message us        {run['cpu_us_per_message']}")
+        self.stdout.write(f"  wire bytes/message    {run['wire_bytes_per_message']}")
+        if run.get("outbound"):
+            outbound = run["outbound"]
+            self.stdout.write(
+                f"  outbound queue        max={outbound['max_queued']} dropped={outbound['dropped']} "
+                f"slow_disconnects={outbound['slow_disconnects']} stalls={outbound.get('stalls', 0)}"
+            )
+        if run.get("database"):
+            database = run["database"]
+            self.stdout.write(
+                f"  database calls        {database['calls']} threads={database['threads']} "
+                f"max_in_flight={database['max_in_flight']} wait_ms={database['wait_ms']} "
+                f"max_wait_ms={database['max_wait_ms']} run_ms={database['run_ms']}"
+            )
+        codec = run["codec"]
+        self.stdout.write(
+            f"  codec/frame           encode={codec['encode_us']}us decode={codec['decode_us']}us bytes={codec['bytes']}"
+        )
+
+
+class TestDatabase:
+    def __enter__(self):
+        self.old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        return self
+
+    def __exit__(self, *exc_info):
+        connection.creation.destroy_test_db(self.old_name, verbosity=0)
+        return False
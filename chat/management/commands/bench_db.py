@@ -0,0 +1,128 @@
+import asyncio
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.db.backends.signals import connection_created
+from chat.models import ChatRoom
+
+MODES = ("none", "persistent", "pool")
+
+
+def room_pk(room_id):
+    # The lookup every first message of a room makes (persistence.get_room_pk)
+    return ChatRoom.objects.filter(room_id=room_id).values_list("pk", flat=True).first()
+
+
+class Command(BaseCommand):
+    help = (
+        "Per-query latency and connection churn of database_sync_to_async calls "
+        "under each DATABASES pooling mode (see DATABASE_POOLING). Only reads. "
+        "The pool mode needs Postgres."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+        parser.add_argument("--queries", type=int, default=2000)
+        parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16])
+        parser.add_argument(
+            "--threads", type=int, default=1,
+            help="Threads running the queries; 1 is how consumers' thread-sensitive calls run",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"database: {connection.vendor} threads: {options['threads']}")
+        original = dict(connections.settings[DEFAULT_DB_ALIAS])
+        try:
+            for mode in options["modes"]:
+                if mode == "pool" and connection.vendor != "postgresql":
+                    self.stdout.write("mode=pool skipped: needs Postgres")
+                    continue
+                for concurrency in options["concurrency"]:
+                    self.configure(mode, options["threads"], original)
+                    result = asyncio.run(self.run(options["queries"], concurrency, options["threads"]))
+                    self.stdout.write(
+                        "mode={mode:<10} concurrency={concurrency:<3} queries={queries:<6} "
+                        "p50={p50:.3f}ms p95={p95:.3f}ms mean={mean:.3f}ms throughput={throughput:.0f}/s "
+                        "connects={connects}{pool}".format(mode=mode, **result)
+                    )
+        finally:
+            self.configure("none", options["threads"], original)
+            connections.settings[DEFAULT_DB_ALIAS].clear()
+            connections.settings[DEFAULT_DB_ALIAS].update(original)
+
+    def configure(self, mode, threads, original):
+        # Wrappers share this dict, so new connections pick the mode up
+        close_pool = getattr(connection, "close_pool", None)
+        if close_pool is not None:
+            close_pool()
+        connections.close_all()
+        db = connections.settings[DEFAULT_DB_ALIAS]
+        options = {key: value for key, value in original.get("OPTIONS", {}).items() if key != "pool"}
+        db.update(CONN_MAX_AGE=0, CONN_HEALTH_CHECKS=False, OPTIONS=options)
+        if mode == "persistent":
+            db.update(CONN_MAX_AGE=settings.DATABASE_CONN_MAX_AGE, CONN_HEALTH_CHECKS=True)
+        elif mode == "pool":
+            from psycopg_pool import ConnectionPool
+            options["pool"] = {
+                "min_size": 1, "max_size": threads, "timeout": 10, "check": ConnectionPool.check_connection,
+            }
+
+    async def run(self, queries, concurrency, threads):
+        executor = ThreadPoolExecutor(max_workers=threads)
+        query = database_sync_to_async(room_pk, thread_sensitive=False, executor=executor)
+        latencies = []
+        connects = [0]
+
+        def count(sender, **kwargs):
+            connects[0] += 1
+
+        async def worker(count):
+            for _ in range(count):
+                start = time.perf_counter()
+                await query(uuid.uuid4())
+                latencies.append(time.perf_counter() - start)
+
+        connection_created.connect(count)
+        try:
+            start = time.perf_counter()
+            await asyncio.gather(*(worker(queries // concurrency) for _ in range(concurrency)))
+            elapsed = time.perf_counter() - start
+            pool = await asyncio.get_running_loop().run_in_executor(executor, self.pool_stats)
+            await self.close_thread_connections(executor, threads)
+        finally:
+            connection_created.disconnect(count)
+            executor.shutdown()
+        latencies.sort()
+        return {
+            "concurrency": concurrency,
+            "queries": len(latencies),
+            "p50": statistics.median(latencies) * 1000,
+            "p95": latencies[int(len(latencies) * 0.95)] * 1000,
+            "mean": statistics.fmean(latencies) * 1000,
+            "throughput": len(latencies) / elapsed,
+            # Connection setups; with a pool they are checkouts, and pool_opened the real connects
+            "connects": connects[0],
+            "pool": f" pool_opened={pool['connections_num']}" if pool else "",
+        }
+
+    def pool_stats(self):
+        if "pool" not in connection.settings_dict["OPTIONS"]:
+            return None
+        return connection.pool.get_stats()
+
+    async def close_thread_connections(self, executor, threads):
+        # Connections are per thread; the barrier puts one close on each worker
+        barrier = threading.Barrier(threads)
+
+        def close():
+            barrier.wait()
+            connections.close_all()
+
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(executor, close) for _ in range(threads)))
@@ -0,0 +1,71 @@
+import threading
+import time
+import uuid
+from django.core.management.base import BaseCommand
+from django.db import connection
+from chat.models import ChatRoom
+
+
+class Command(BaseCommand):
+    help = (
+        "Contention benchmark for the database pairing path: N threads connect "
+        "concurrently and pair through ChatRoom.objects.claim_waiting. "
+        "Only rooms created by the benchmark are touched and they are deleted afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+        parser.add_argument("--connects", type=int, default=200, help="Connects per worker")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"database: {connection.vendor}")
+        for workers in options["workers"]:
+            result = self.run(workers, options["connects"])
+            self.stdout.write(
+                "workers={workers:<3} connects={connects:<6} pairs={pairs:<6} "
+                "elapsed={elapsed:.2f}s throughput={throughput:.0f}/s "
+                "double_booked={double_booked} errors={errors}".format(**result)
+            )
+
+    def run(self, workers, connects):
+        prefix = f"bench:{uuid.uuid4().hex[:8]}:"
+        rooms = ChatRoom.objects.filter(user1__startswith=prefix)
+        barrier = threading.Barrier(workers)
+        claimed = [0] * workers
+        errors = [0] * workers
+
+        def worker(index):
+            barrier.wait()
+            try:
+                for n in range(connects):
+                    user = f"{prefix}{index}:{n}"
+                    try:
+                        if rooms.claim_waiting(user) is not None:
+                            claimed[index] += 1
+                        else:
+                            ChatRoom.objects.create(user1=user, user2=None, active=True)
+                    except Exception:
+                        errors[index] += 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        pairs = rooms.filter(user2__isnull=False).count()
+        rooms.delete()
+        return {
+            "workers": workers,
+            "connects": workers * connects,
+            "pairs": pairs,
+            "elapsed": elapsed,
+            "throughput": workers * connects / elapsed,
+            # More successful claims than paired rows means two workers took the same room
+            "double_booked": sum(claimed) - pairs,
+            "errors": sum(errors),
+        }
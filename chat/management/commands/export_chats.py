@@ -0,0 +1,39 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from chat.export import CONTENT_TYPES, TranscriptEncoder, export_queryset, parse_filters, stream_export
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream chat transcripts as NDJSON or CSV, optionally gzipped, to a file "
+        "or stdout. Messages are read in chunks, so memory stays flat for any export size."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--room", help="Room UUID")
+        parser.add_argument("--sender")
+        parser.add_argument("--since", help="ISO 8601 datetime, inclusive")
+        parser.add_argument("--until", help="ISO 8601 datetime, exclusive")
+        parser.add_argument("--format", choices=list(CONTENT_TYPES), default="ndjson")
+        parser.add_argument("--gzip", action="store_true")
+        parser.add_argument("--output", default="-", help="File path, or - for stdout")
+
+    def handle(self, *args, **options):
+        try:
+            filters = parse_filters(
+                room=options["room"], sender=options["sender"],
+                since=options["since"], until=options["until"],
+            )
+        except ValueError as exc:
+            raise CommandError(exc)
+        encoder = TranscriptEncoder(options["format"], compress=options["gzip"])
+        chunks = stream_export(export_queryset(**filters), encoder)
+        if options["output"] == "-":
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+            return
+        with open(options["output"], "wb") as output:
+            for chunk in chunks:
+                output.write(chunk)
+        self.stderr.write(f"Wrote {options['output']}")
@@ -0,0 +1,564 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from itertools import islice
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from .db import db_call
+from .models import ChatRoom
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+
+@db_call
+def record_room(first, second):
+    """Write the ChatRoom row once a pairing has been decided."""
+    return ChatRoom.objects.create(
+        room_id=first["room_id"],
+        user1=first["user"],
+        user2=second["user"],
+        user1_location=first.get("location"),
+        user2_location=second.get("location"),
+        user1_profile_id=first.get("profile"),
+        user2_profile_id=second.get("profile"),
+        active=True,
+    )
+
+
+def live_after():
+    """Epoch seconds before which a waiting entry's last heartbeat marks it as dead."""
+    if not settings.CHAT_HEARTBEAT_INTERVAL:
+        # Nothing refreshes entries without heartbeats, so none can be judged dead
+        return 0
+    return time.time() - settings.CHAT_WAITING_TIMEOUT
+
+
+def compatible(entry, other):
+    # Strangers who just skipped each other are not paired again right away
+    return other["user"] != entry.get("skip") and other.get("skip") != entry["user"]
+
+
+def region_of(location):
+    # (country, continent) from a client location payload, either may be None
+    if not isinstance(location, dict):
+        return None, None
+    country = location.get("country") or None
+    continent = location.get("continent") or None
+    return (
+        str(country).upper() if country else None,
+        str(continent).upper() if continent else None,
+    )
+
+
+class BaseMatchQueue:
+    """
+    Waiting pool for strangers. Entries are dicts with at least ``room_id``,
+    ``channel``, ``user`` and ``since``; the room id is chosen up front so a
+    waiting user can already be addressed by admins before a ChatRoom row
+    exists. An optional ``skip`` names the user an entry just left, and the
+    two are not paired with each other until the entry gives that up with
+    ``rematch``. Subclasses only provide an atomic ``pop_or_push`` and ``take``,
+    plus ``touch`` and ``reap`` for the heartbeats that keep entries alive.
+    """
+
+    # Whether waiting entries already have a ChatRoom row
+    records_waiting = False
+    # Whether entries are bucketed by the client's location
+    by_region = False
+
+    async def pop_or_push(self, entry):
+        raise NotImplementedError
+
+    async def take(self, room_id):
+        raise NotImplementedError
+
+    async def waiting(self, limit=50):
+        raise NotImplementedError
+
+    async def size(self):
+        raise NotImplementedError
+
+    async def touch(self, room_id):
+        # Record a heartbeat of a waiting entry
+        raise NotImplementedError
+
+    async def reap(self, cutoff):
+        # Drop entries without a heartbeat since ``cutoff`` (epoch seconds); returns how many
+        raise NotImplementedError
+
+    async def pop_any(self, entry):
+        # Only region queues hold back partners, so plain queues never widen
+        return None
+
+    async def pair(self, entry):
+        # Returns the partner's entry (and records the room) or None if queued
+        partner = await self.pop_or_push(entry)
+        if partner is not None:
+            partner["room_pk"] = (await record_room(partner, entry)).pk
+        return partner
+
+    async def widen(self, entry):
+        # A waiting entry gives up on its region and takes anyone still waiting
+        partner = await self.pop_any(entry)
+        if partner is not None:
+            partner["room_pk"] = (await record_room(partner, entry)).pk
+        return partner
+
+    async def rematch(self, entry):
+        # A waiting entry stops skipping and looks again; None if it waits on or was paired meanwhile
+        if await self.take(entry["room_id"]) is None:
+            return None
+        entry["skip"] = None
+        return await self.pair(entry)
+
+    async def claim(self, room_id, user):
+        # Admin takes over a waiting user as their partner
+        entry = await self.take(room_id)
+        if entry is not None:
+            entry["room_pk"] = (await record_room(entry, {"user": user})).pk
+        return entry
+
+    async def leave(self, room_id):
+        # True if the entry was still waiting, False if it was already paired
+        return await self.take(room_id) is not None
+
+
+class InMemoryMatchQueue(BaseMatchQueue):
+    """
+    Per-process FIFO; every operation runs without awaiting, and is O(1)
+    unless the head is a stranger the arrival just skipped.
+    """
+
+    def __init__(self):
+        self._waiting = OrderedDict()
+
+    async def pop_or_push(self, entry):
+        partner = next((other for other in self._waiting.values() if compatible(entry, other)), None)
+        if partner is not None:
+            return self._waiting.pop(partner["room_id"])
+        self._waiting[entry["room_id"]] = entry
+        return None
+
+    async def take(self, room_id):
+        return self._waiting.pop(room_id, None)
+
+    async def waiting(self, limit=50):
+        return list(islice(reversed(self._waiting.values()), limit))
+
+    async def size(self):
+        return len(self._waiting)
+
+    async def touch(self, room_id):
+        entry = self._waiting.get(room_id)
+        if entry is not None:
+            entry["seen"] = time.time()
+
+    async def reap(self, cutoff):
+        stale = [room_id for room_id, entry in self._waiting.items() if entry.get("seen", entry["since"]) < cutoff]
+        for room_id in stale:
+            await self.take(room_id)
+        return len(stale)
+
+
+class RegionMatchQueue(BaseMatchQueue):
+    """
+    In-process queue with per-country and per-continent buckets. An arrival
+    takes the oldest stranger from its country, then its continent, then
+    the head of the global FIFO once that stranger has waited longer than
+    CHAT_MATCH_WIDEN_AFTER. Each step is a dict lookup and an O(1) pop.
+    """
+
+    by_region = True
+
+    def __init__(self):
+        self._waiting = OrderedDict()
+        self._buckets = {}
+
+    def _keys(self, entry):
+        country, continent = region_of(entry.get("location"))
+        return [key for key in (f"country:{country}" if country else None,
+                                f"continent:{continent}" if continent else None) if key]
+
+    def _push(self, entry):
+        self._waiting[entry["room_id"]] = entry
+        for key in self._keys(entry):
+            self._buckets.setdefault(key, OrderedDict())[entry["room_id"]] = entry
+
+    def _first(self, entries, entry):
+        return next((other for other in entries.values() if compatible(entry, other)), None)
+
+    def _remove(self, room_id):
+        entry = self._waiting.pop(room_id, None)
+        if entry is None:
+            return None
+        for key in self._keys(entry):
+            bucket = self._buckets[key]
+            del bucket[room_id]
+            if not bucket:
+                del self._buckets[key]
+        return entry
+
+    async def pop_or_push(self, entry):
+        for key in self._keys(entry):
+            partner = self._first(self._buckets.get(key, {}), entry)
+            if partner is not None:
+                return self._remove(partner["room_id"])
+        head = self._first(self._waiting, entry)
+        if head is not None:
+            if not self._keys(entry) or time.time() - head["since"] >= settings.CHAT_MATCH_WIDEN_AFTER:
+                return self._remove(head["room_id"])
+        self._push(entry)
+        return None
+
+    async def pop_any(self, entry):
+        if entry["room_id"] not in self._waiting:
+            return None
+        partner = next((
+            other for room_id, other in self._waiting.items()
+            if room_id != entry["room_id"] and compatible(entry, other)
+        ), None)
+        if partner is None:
+            return None
+        self._remove(entry["room_id"])
+        return self._remove(partner["room_id"])
+
+    async def take(self, room_id):
+        return self._remove(room_id)
+
+    async def waiting(self, limit=50):
+        return list(islice(reversed(self._waiting.values()), limit))
+
+    async def size(self):
+        return len(self._waiting)
+
+    touch = InMemoryMatchQueue.touch
+    reap = InMemoryMatchQueue.reap
+
+
+# Entries not seen since the cutoff (ARGV) belong to dead consumers: drop
+# them instead of pairing with them. Entries without a heartbeat yet count
+# from their arrival.
+#
+# ``find`` returns the first live entry of a list, other than ``exclude``,
+# that the arrival (``user``, skipping ``skip``) may be paired with, and its
+# id. Dead and stale ids it meets are dropped from the list; entries of
+# strangers who just skipped each other stay where they are.
+LIVE = """
+local function live(entries, seen, rid, cutoff)
+    local entry = redis.call('HGET', entries, rid)
+    if not entry then
+        return false
+    end
+    local at = tonumber(redis.call('ZSCORE', seen, rid)) or cjson.decode(entry)['since']
+    if at < cutoff then
+        redis.call('HDEL', entries, rid)
+        redis.call('ZREM', seen, rid)
+        return false
+    end
+    return entry
+end
+
+local function find(list, entries, seen, cutoff, user, skip, exclude)
+    local start = 0
+    while true do
+        local rids = redis.call('LRANGE', list, start, start + 15)
+        if #rids == 0 then
+            return false
+        end
+        local kept = 0
+        for _, rid in ipairs(rids) do
+            local entry = rid ~= exclude and live(entries, seen, rid, cutoff)
+            if entry then
+                local other = cjson.decode(entry)
+                if other['user'] ~= skip and other['skip'] ~= user then
+                    return entry, rid
+                end
+                kept = kept + 1
+            elseif rid == exclude then
+                kept = kept + 1
+            else
+                redis.call('LREM', list, 1, rid)
+            end
+        end
+        start = start + kept
+    end
+end
+
+local function take(list, entries, seen, rid)
+    redis.call('LREM', list, 1, rid)
+    redis.call('HDEL', entries, rid)
+    redis.call('ZREM', seen, rid)
+end
+"""
+
+# The list keeps FIFO order and the hash holds the live entries. Removal only
+# deletes from the hash; stale ids left in the list are dropped by ``find``.
+# The sorted set holds each entry's last heartbeat.
+POP_OR_PUSH = LIVE + """
+local entry, rid = find(KEYS[1], KEYS[2], KEYS[3], tonumber(ARGV[4]), ARGV[5], ARGV[6], '')
+if entry then
+    take(KEYS[1], KEYS[2], KEYS[3], rid)
+    return entry
+end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[3], ARGV[3], ARGV[1])
+redis.call('RPUSH', KEYS[1], ARGV[1])
+return false
+"""
+
+TAKE = """
+local entry = redis.call('HGET', KEYS[1], ARGV[1])
+if entry then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    redis.call('ZREM', KEYS[2], ARGV[1])
+end
+return entry
+"""
+
+REAP = """
+local rids = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', '(' .. ARGV[1])
+local reaped = 0
+for i = 1, #rids, 1000 do
+    reaped = reaped + redis.call('HDEL', KEYS[1], unpack(rids, i, math.min(i + 999, #rids)))
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', '(' .. ARGV[1])
+return reaped
+"""
+
+
+class RedisMatchQueue(BaseMatchQueue):
+    """Queue shared by every worker through the channel layer's Redis."""
+
+    def __init__(self, prefix="chat:match"):
+        self.queue_key = f"{prefix}:queue"
+        self.entries_key = f"{prefix}:entries"
+        self.seen_key = f"{prefix}:seen"
+
+    async def pop_or_push(self, entry):
+        redis = get_redis()
+        result = await redis.eval(
+            POP_OR_PUSH, 3, self.queue_key, self.entries_key, self.seen_key,
+            entry["room_id"], json.dumps(entry), time.time(), live_after(), entry["user"], entry.get("skip") or "",
+        )
+        return json.loads(result) if result else None
+
+    async def take(self, room_id):
+        result = await get_redis().eval(TAKE, 2, self.entries_key, self.seen_key, room_id)
+        return json.loads(result) if result else None
+
+    async def waiting(self, limit=50):
+        redis = get_redis()
+        room_ids = await redis.lrange(self.queue_key, -limit, -1)
+        if not room_ids:
+            return []
+        values = await redis.hmget(self.entries_key, room_ids[::-1])
+        return [json.loads(v) for v in values if v]
+
+    async def size(self):
+        return await get_redis().hlen(self.entries_key)
+
+    async def touch(self, room_id):
+        # XX: an entry paired meanwhile is not brought back
+        await get_redis().zadd(self.seen_key, {room_id: time.time()}, xx=True)
+
+    async def reap(self, cutoff):
+        return await get_redis().eval(REAP, 2, self.entries_key, self.seen_key, cutoff)
+
+
+# KEYS: entries hash, heartbeats, global list, then the arrival's
+# country/continent lists. Bucket lists hold stale ids of entries paired
+# through another list; like the global list they are skipped lazily.
+REGION_POP_OR_PUSH = LIVE + """
+local cutoff = tonumber(ARGV[5])
+for i = 4, #KEYS do
+    local entry, rid = find(KEYS[i], KEYS[1], KEYS[2], cutoff, ARGV[6], ARGV[7], '')
+    if entry then
+        take(KEYS[i], KEYS[1], KEYS[2], rid)
+        return entry
+    end
+end
+local entry, rid = find(KEYS[3], KEYS[1], KEYS[2], cutoff, ARGV[6], ARGV[7], '')
+if entry and (#KEYS == 3 or tonumber(ARGV[3]) - cjson.decode(entry)['since'] >= tonumber(ARGV[4])) then
+    take(KEYS[3], KEYS[1], KEYS[2], rid)
+    return entry
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+for i = 3, #KEYS do
+    redis.call('RPUSH', KEYS[i], ARGV[1])
+end
+return false
+"""
+
+POP_ANY = LIVE + """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+    return false
+end
+local entry, rid = find(KEYS[3], KEYS[1], KEYS[2], tonumber(ARGV[2]), ARGV[3], ARGV[4], ARGV[1])
+if not entry then
+    return false
+end
+take(KEYS[3], KEYS[1], KEYS[2], rid)
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+return entry
+"""
+
+
+class RedisRegionMatchQueue(RedisMatchQueue):
+    """Region buckets as Redis lists, shared by every worker."""
+
+    by_region = True
+
+    def __init__(self, prefix="chat:region"):
+        super().__init__(prefix)
+        self.prefix = prefix
+
+    def _bucket_keys(self, entry):
+        country, continent = region_of(entry.get("location"))
+        keys = []
+        if country:
+            keys.append(f"{self.prefix}:country:{country}")
+        if continent:
+            keys.append(f"{self.prefix}:continent:{continent}")
+        return keys
+
+    async def pop_or_push(self, entry):
+        keys = [self.entries_key, self.seen_key, self.queue_key] + self._bucket_keys(entry)
+        result = await get_redis().eval(
+            REGION_POP_OR_PUSH, len(keys), *keys,
+            entry["room_id"], json.dumps(entry), time.time(), settings.CHAT_MATCH_WIDEN_AFTER, live_after(),
+            entry["user"], entry.get("skip") or "",
+        )
+        return json.loads(result) if result else None
+
+    async def pop_any(self, entry):
+        result = await get_redis().eval(
+            POP_ANY, 3, self.entries_key, self.seen_key, self.queue_key, entry["room_id"], live_after(),
+            entry["user"], entry.get("skip") or "",
+        )
+        return json.loads(result) if result else None
+
+
+def epoch_datetime(seconds):
+    return datetime.fromtimestamp(seconds, tz=timezone.utc)
+
+
+def room_entry(room):
+    # user1 of a waiting row is the waiting consumer's channel name
+    return {
+        "room_pk": room.pk,
+        "room_id": str(room.room_id),
+        "channel": room.user1,
+        "user": room.user1,
+        "location": room.user1_location,
+        "profile": room.user1_profile_id,
+        "skip": room.user1_skip,
+        "since": room.created_at.timestamp(),
+    }
+
+
+class DatabaseMatchQueue(BaseMatchQueue):
+    """
+    Waiting rows in the ChatRoom table, for multi-worker deployments without
+    a shared Redis. Pairing and admin claims go through the atomic
+    ``ChatRoom.objects.claim_waiting`` so the row is written by the claim itself.
+    """
+
+    records_waiting = True
+
+    @db_call
+    def pair(self, entry):
+        room = ChatRoom.objects.claim_waiting(
+            entry["user"], location=entry.get("location"), seen_after=epoch_datetime(live_after()),
+            profile_id=entry.get("profile"), skip=entry.get("skip"),
+        )
+        if room is not None:
+            return room_entry(room)
+        ChatRoom.objects.create(
+            room_id=entry["room_id"], user1=entry["user"], user2=None, user1_skip=entry.get("skip"),
+            user1_location=entry.get("location"), user1_profile_id=entry.get("profile"), active=True,
+        )
+        return None
+
+    @db_call
+    def rematch(self, entry):
+        # Our row is closed while we look, so nobody claims it as we claim another
+        if not ChatRoom.objects.release_waiting(entry["room_id"]):
+            return None
+        entry["skip"] = None
+        room = ChatRoom.objects.claim_waiting(
+            entry["user"], location=entry.get("location"), seen_after=epoch_datetime(live_after()),
+            profile_id=entry.get("profile"),
+        )
+        if room is not None:
+            return room_entry(room)
+        ChatRoom.objects.filter(room_id=entry["room_id"]).update(
+            active=True, user1_skip=None, updated_at=datetime.now(timezone.utc),
+        )
+        return None
+
+    @db_call
+    def claim(self, room_id, user):
+        room = ChatRoom.objects.claim_waiting(user, room_id=room_id)
+        return room_entry(room) if room is not None else None
+
+    @db_call
+    def leave(self, room_id):
+        return ChatRoom.objects.release_waiting(room_id)
+
+    @db_call
+    def waiting(self, limit=50):
+        return [room_entry(room) for room in ChatRoom.objects.waiting().order_by("-created_at")[:limit]]
+
+    @db_call
+    def size(self):
+        return ChatRoom.objects.waiting().count()
+
+    # A waiting row's updated_at is its last heartbeat
+    @db_call
+    def touch(self, room_id):
+        ChatRoom.objects.waiting().filter(room_id=room_id).update(updated_at=datetime.now(timezone.utc))
+
+    @db_call
+    def reap(self, cutoff):
+        return ChatRoom.objects.waiting().filter(updated_at__lt=epoch_datetime(cutoff)).end()
+
+
+MATCH_QUEUES = {
+    "database": DatabaseMatchQueue,
+    "memory": InMemoryMatchQueue,
+    "redis": RedisMatchQueue,
+}
+REGION_MATCH_QUEUES = {
+    "memory": RegionMatchQueue,
+    "redis": RedisRegionMatchQueue,
+}
+
+_queues = {}
+
+
+def get_match_queue():
+    key = (settings.CHAT_MATCH_QUEUE, settings.CHAT_MATCH_BY_REGION)
+    queue = _queues.get(key)
+    if queue is None:
+        backends = REGION_MATCH_QUEUES if settings.CHAT_MATCH_BY_REGION else MATCH_QUEUES
+        if settings.CHAT_MATCH_QUEUE not in backends:
+            raise ImproperlyConfigured(
+                f"CHAT_MATCH_QUEUE={settings.CHAT_MATCH_QUEUE!r} does not support CHAT_MATCH_BY_REGION"
+            )
+        queue = _queues[key] = backends[settings.CHAT_MATCH_QUEUE]()
+    return queue
+
+
+async def reap_waiting():
+    """Expire waiting entries whose consumers stopped sending heartbeats, in one bulk call."""
+    reaped = await get_match_queue().reap(live_after())
+    if reaped:
+        from . import dashboard
+        logger.info("Reaped %d stale waiting entries", reaped)
+        await dashboard.refresh()
+    return reaped
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.5 on 2026-10-18 14:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        ('chat', '0006_message_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(condition=models.Q(('active', True), ('user2__isnull', True)), fields=['id'], name='chat_room_waiting_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(condition=models.Q(('active', True), ('user2__isnull', False)), fields=['-created_at'], name='chat_room_active_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', '-timestamp'], name='chat_msg_room_recent_idx'),
+        ),
+    ]
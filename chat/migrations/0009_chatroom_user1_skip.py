@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 16:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_message_history_seek_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='user1_skip',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
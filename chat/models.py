@@ -1,9 +1,63 @@
 
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models import Subquery
 from django.contrib.auth.models import User
+from django.utils import timezone
 from accounts.models import UserProfile
 import uuid
 
+class ChatRoomQuerySet(models.QuerySet):
+    def waiting(self):
+        return self.filter(active=True, user2__isnull=True)
+
+    def claim_waiting(self, user, room_id=None, location=None, seen_after=None, profile_id=None, skip=None):
+        """
+        Atomically take the oldest waiting room (or the given one) by setting
+        user2, and return it. Returns None if nothing could be claimed, so
+        concurrent workers never double-book a room or retry in a loop.
+        ``seen_after`` skips rooms whose last heartbeat is older, and rooms of
+        ``skip`` or of users skipping ``user`` are passed over.
+        """
+        fields = {"user2": user}
+        if location is not None:
+            fields["user2_location"] = location
+        if profile_id is not None:
+            fields["user2_profile_id"] = profile_id
+        waiting = self.waiting()
+        if room_id is not None:
+            waiting = waiting.filter(room_id=room_id)
+        if seen_after is not None:
+            waiting = waiting.filter(updated_at__gte=seen_after)
+        if skip is not None:
+            waiting = waiting.exclude(user1=skip)
+        waiting = waiting.exclude(user1_skip=user)
+        if connections[self.db].features.has_select_for_update_skip_locked:
+            # Postgres: rows locked by another worker's claim are skipped, not waited on
+            with transaction.atomic(using=self.db):
+                room = waiting.select_for_update(skip_locked=True).order_by("id").first()
+                if room is None:
+                    return None
+                for name, value in fields.items():
+                    setattr(room, name, value)
+                room.save(update_fields=[*fields, "updated_at"])
+                return room
+        # SQLite serializes writers, so a single conditional UPDATE is the claim
+        candidate = waiting.order_by("id").values("pk")[:1]
+        if not self.filter(pk=Subquery(candidate), user2__isnull=True).update(**fields):
+            return None
+        if room_id is not None:
+            return self.get(room_id=room_id)
+        return self.filter(active=True, user2=user).order_by("-id").first()
+
+    def end(self):
+        # update() skips auto_now; an inactive room's updated_at is when it ended
+        return self.update(active=False, updated_at=timezone.now())
+
+    def release_waiting(self, room_id):
+        # True if the room was still waiting and is now closed
+        return bool(self.waiting().filter(room_id=room_id).end())
+
+
 class ChatRoom(models.Model):
     room_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
     user1 = models.CharField(max_length=255, blank=True, null=True)
@@ -12,13 +66,39 @@ class ChatRoom(models.Model):
     user2_profile = models.ForeignKey(UserProfile, on_delete=models.SET_NULL, null=True, blank=True, related_name="rooms_as_user2")
     user1_location = models.JSONField(null=True, blank=True)  # Store location data
     user2_location = models.JSONField(null=True, blank=True)  # Store location data
+    user1_skip = models.CharField(max_length=255, blank=True, null=True)  # Previous partner user1 just left
     active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ChatRoomQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Matching: oldest waiting room first
+            models.Index(
+                fields=["id"],
+                condition=models.Q(active=True, user2__isnull=True),
+                name="chat_room_waiting_idx",
+            ),
+            # Admin summary: most recent paired rooms
+            models.Index(
+                fields=["-created_at"],
+                condition=models.Q(active=True, user2__isnull=False),
+                name="chat_room_active_recent_idx",
+            ),
+        ]
+
 class Message(models.Model):
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name="messages")
     sender = models.CharField(max_length=255)
     sender_profile = models.ForeignKey(UserProfile, on_delete=models.SET_NULL, null=True, blank=True)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the message is sent; rows can be written later in batches
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # History: keyset pages of a room on (timestamp, id)
+            models.Index(fields=["room", "-timestamp", "-id"], name="chat_msg_room_seek_idx"),
+        ]
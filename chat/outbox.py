@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import weakref
+from collections import deque
+from functools import partial
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("drop_oldest", "disconnect")
+# Application close code (4000-4999) for a client that cannot keep up
+SLOW_CLIENT_CLOSE_CODE = 4008
+# Seconds between checks of a full server write buffer
+DRAIN_INTERVAL = 0.05
+
+_outboxes = weakref.WeakSet()
+_counts = {"dropped": 0, "slow_disconnects": 0, "stalls": 0, "max_queued": 0}
+
+
+def metrics():
+    """Outbound queue figures for this process."""
+    queued = [len(outbox.frames) for outbox in _outboxes]
+    return {"connections": len(queued), "queued": sum(queued), "deepest": max(queued, default=0), **_counts}
+
+
+def reset_metrics():
+    for name in _counts:
+        _counts[name] = 0
+
+
+def server_backlog(send):
+    """
+    A function returning the bytes the ASGI server holds unsent for the
+    socket behind ``send``, or None when the server does not expose them.
+
+    daphne's ``send`` is ``partial(Server.handle_reply, protocol)``: it hands
+    the frame to the Twisted transport and returns without waiting for the
+    client, so a slow reader's backlog builds up in the transport's write
+    buffer rather than in the Outbox.
+    """
+    protocol = send.args[0] if isinstance(send, partial) and send.args else None
+    if not hasattr(protocol, "transport"):
+        return None
+
+    def backlog():
+        transport = protocol.transport
+        # Wrappers such as TLS keep the socket's transport underneath
+        while transport is not None and not hasattr(transport, "dataBuffer"):
+            transport = getattr(transport, "transport", None)
+        if transport is None:
+            return 0
+        return len(transport.dataBuffer) - transport.offset + transport._tempDataLen
+
+    return backlog
+
+
+class Outbox:
+    """
+    Frames waiting to go out on one socket, written by a task of their own
+    so consumers keep reading the channel layer while a slow client drains.
+    Servers whose ``send`` returns before the client reads pass a
+    ``backlog`` function (see ``server_backlog``); writing pauses while it
+    reports more than ``max_buffered`` bytes, so frames wait here instead.
+    At most ``max_size`` frames wait; past that the ``policy`` drops the
+    oldest frame or disconnects the client.
+    """
+
+    def __init__(self, send, close, codec, max_size, policy, backlog=None, max_buffered=0):
+        if policy not in POLICIES:
+            raise ImproperlyConfigured(f"Unknown CHAT_SLOW_CLIENT_POLICY {policy!r}")
+        self.send = send
+        self.close_socket = close
+        self.codec = codec
+        self.max_size = max_size
+        self.policy = policy
+        self.backlog = backlog
+        self.max_buffered = max_buffered
+        self.frames = deque()
+        self.closing = None
+        self._ready = asyncio.Event()
+        self._task = None
+        _outboxes.add(self)
+
+    @classmethod
+    def from_settings(cls, send, close, codec, backlog=None):
+        return cls(
+            send, close, codec, settings.CHAT_SEND_QUEUE_SIZE, settings.CHAT_SLOW_CLIENT_POLICY,
+            backlog=backlog, max_buffered=settings.CHAT_SEND_BUFFER_BYTES,
+        )
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        self.frames.clear()
+        _outboxes.discard(self)
+
+    def put(self, frame):
+        if self.closing is not None:
+            return
+        if len(self.frames) >= self.max_size:
+            if self.policy == "disconnect":
+                _counts["slow_disconnects"] += 1
+                logger.warning("Disconnecting a client with %d frames queued", len(self.frames))
+                self.frames.clear()
+                self.close(SLOW_CLIENT_CLOSE_CODE, "slow client")
+                return
+            self.frames.popleft()
+            _counts["dropped"] += 1
+        self.frames.append(frame)
+        _counts["max_queued"] = max(_counts["max_queued"], len(self.frames))
+        self._ready.set()
+
+    def close(self, code=None, reason=None):
+        """Close the socket once the frames queued so far are written."""
+        if self.closing is None:
+            self.closing = (code, reason)
+            self._ready.set()
+
+    async def run(self):
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+                while self.frames:
+                    await self.drain()
+                    if not self.frames:
+                        break
+                    await self.send(**self.codec.encode(self.frames.popleft()))
+                if self.closing is not None:
+                    await self.close_socket(*self.closing)
+                    return
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Writing to a socket failed")
+        finally:
+            _outboxes.discard(self)
+
+    async def drain(self):
+        """Wait until the server's write buffer is back under ``max_buffered``, or we are closing."""
+        if self.backlog is None or self.backlog() <= self.max_buffered:
+            return
+        _counts["stalls"] += 1
+        while self.closing is None and self.backlog() > self.max_buffered:
+            await asyncio.sleep(DRAIN_INTERVAL)
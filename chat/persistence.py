@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import weakref
+from django.conf import settings
+from django.db import IntegrityError
+from django.utils import timezone
+from .db import db_call, run
+from .lifecycle import on_shutdown
+from .models import ChatRoom, Message
+
+logger = logging.getLogger(__name__)
+
+# Longest wait, in seconds, before retrying a failed batch
+MAX_RETRY_DELAY = 30
+
+
+@db_call
+def get_room_pk(room_id):
+    return ChatRoom.objects.filter(room_id=room_id).values_list("pk", flat=True).first()
+
+
+def write_messages(batch):
+    try:
+        Message.objects.bulk_create(batch)
+    except IntegrityError:
+        # A room was deleted while its messages were buffered; keep the rest
+        live = set(ChatRoom.objects.filter(pk__in={m.room_id for m in batch}).values_list("pk", flat=True))
+        Message.objects.bulk_create([m for m in batch if m.room_id in live])
+
+
+class MessageWriter:
+    """
+    Write-behind buffer for chat messages. ``add`` only appends to a list,
+    so delivery never waits on the database; buffered rows are inserted with
+    one bulk_create once CHAT_MESSAGE_BATCH_SIZE is reached or
+    CHAT_MESSAGE_FLUSH_INTERVAL seconds after the first buffered message.
+    A batch that fails goes back to the front of the buffer and is retried
+    with exponential backoff; after ``max_retries`` failed retries in a row
+    its messages are logged and dropped.
+    """
+
+    def __init__(self, batch_size, flush_interval, max_retries=6):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._pending = []
+        self._timer = None
+        self._failures = 0
+        self._lock = asyncio.Lock()
+
+    def add(self, room_pk, sender, content, sender_profile_id=None):
+        # The timestamp is taken now, not when the batch reaches the database
+        message = Message(
+            room_id=room_pk,
+            sender=sender,
+            content=content,
+            sender_profile_id=sender_profile_id,
+            timestamp=timezone.now(),
+        )
+        self._pending.append(message)
+        if len(self._pending) >= self.batch_size and not self._failures:
+            self._schedule(0)
+        elif self._timer is None:
+            self._schedule(self.flush_interval)
+        return message
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        loop = asyncio.get_running_loop()
+        self._timer = loop.call_later(delay, lambda: asyncio.ensure_future(self.flush()))
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # One batch at a time keeps rows in send order
+        async with self._lock:
+            batch, self._pending = self._pending, []
+            if not batch:
+                return
+            try:
+                await run(write_messages, batch)
+            except Exception:
+                self._failures += 1
+                if self._failures > self.max_retries:
+                    self._failures = 0
+                    logger.exception("Dropping %d buffered chat messages after repeated failures", len(batch))
+                    return
+                logger.warning("Failed to write %d buffered chat messages, retrying", len(batch), exc_info=True)
+                # Ahead of anything buffered since, so rows stay in send order
+                self._pending[:0] = batch
+                self._schedule(min(self.flush_interval * 2 ** self._failures, MAX_RETRY_DELAY))
+            else:
+                self._failures = 0
+
+
+# One writer per event loop, like the Redis clients
+_writers = weakref.WeakKeyDictionary()
+
+
+def get_message_writer():
+    loop = asyncio.get_running_loop()
+    writer = _writers.get(loop)
+    if writer is None:
+        writer = _writers[loop] = MessageWriter(
+            settings.CHAT_MESSAGE_BATCH_SIZE, settings.CHAT_MESSAGE_FLUSH_INTERVAL,
+            settings.CHAT_MESSAGE_WRITE_RETRIES,
+        )
+        on_shutdown(writer.flush)
+    return writer
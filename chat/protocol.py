@@ -0,0 +1,139 @@
+"""
+Wire formats of the chat and admin sockets. Clients pick one through the
+WebSocket subprotocol; clients that ask for none get the original JSON text
+frames.
+
+Frames are the same dicts in every encoding. The version in the subprotocol
+name covers their shape: a change to the keys clients read ships as a new
+version and the older codecs stay for clients that have not upgraded.
+
+- v1: one frame per WebSocket message
+
+JSON goes through orjson, for legacy clients too; it is what keeps encoding
+cheap. MessagePack frames are smaller on the wire but cost more CPU than
+orjson to encode and decode.
+"""
+import orjson
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from .outbox import Outbox, server_backlog
+
+PROTOCOL_VERSION = 1
+
+
+class JSONCodec:
+    """JSON text frames."""
+
+    def __init__(self, subprotocol=None):
+        self.subprotocol = subprotocol
+
+    def dumps(self, frame):
+        return orjson.dumps(frame).decode()
+
+    def encode(self, frame):
+        return {"text_data": self.dumps(frame)}
+
+    def decode(self, text_data=None, bytes_data=None):
+        """The frame as a dict; ValueError for anything else."""
+        raw = text_data if text_data is not None else bytes_data
+        if not raw:
+            raise ValueError("Empty frame")
+        frame = orjson.loads(raw)
+        if not isinstance(frame, dict):
+            raise ValueError("Frames must be objects")
+        return frame
+
+
+class MessagePackCodec:
+    """MessagePack binary frames: fewer bytes than JSON, more CPU than orjson."""
+
+    def __init__(self, subprotocol):
+        self.subprotocol = subprotocol
+
+    def encode(self, frame):
+        return {"bytes_data": msgpack.packb(frame)}
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            raise ValueError("MessagePack frames are binary")
+        try:
+            frame = msgpack.unpackb(bytes_data)
+        except Exception as exc:
+            raise ValueError(str(exc)) from exc
+        if not isinstance(frame, dict):
+            raise ValueError("Frames must be objects")
+        return frame
+
+
+LEGACY = JSONCodec()
+JSON_SUBPROTOCOL = f"chat.v{PROTOCOL_VERSION}.json"
+MSGPACK_SUBPROTOCOL = f"chat.v{PROTOCOL_VERSION}.msgpack"
+
+CODECS = {}
+for version in range(1, PROTOCOL_VERSION + 1):
+    CODECS[f"chat.v{version}.json"] = JSONCodec(f"chat.v{version}.json")
+    if msgpack is not None:
+        CODECS[f"chat.v{version}.msgpack"] = MessagePackCodec(f"chat.v{version}.msgpack")
+
+
+def negotiate(subprotocols):
+    """The codec for the first offered subprotocol we speak, in the client's order."""
+    for subprotocol in subprotocols or ():
+        codec = CODECS.get(subprotocol)
+        if codec is not None:
+            return codec
+    return LEGACY
+
+
+class ProtocolMixin:
+    """
+    Frame handling for a websocket consumer: ``accept`` negotiates the codec,
+    ``send_frame`` queues frames on the connection's Outbox and decoded
+    frames arrive at ``receive_frame``. Frames that do not decode are
+    dropped. ``close`` waits for the frames queued before it.
+    """
+
+    codec = LEGACY
+    outbox = None
+
+    async def accept(self, subprotocol=None):
+        self.codec = negotiate(self.scope.get("subprotocols"))
+        await super().accept(subprotocol or self.codec.subprotocol)
+        self.outbox = Outbox.from_settings(self.send, self.close_now, self.codec, server_backlog(self.base_send))
+        self.outbox.start()
+
+    async def send_frame(self, frame):
+        self.outbox.put(frame)
+
+    async def close(self, code=None, reason=None):
+        if self.outbox is None:
+            await self.close_now(code, reason)
+        else:
+            self.outbox.close(code, reason)
+
+    async def close_now(self, code=None, reason=None):
+        message = {"type": "websocket.close"}
+        if code is not None:
+            message["code"] = code
+        if reason:
+            message["reason"] = reason
+        await self.base_send(message)
+
+    async def websocket_disconnect(self, message):
+        if self.outbox is not None:
+            self.outbox.stop()
+        await super().websocket_disconnect(message)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            frame = self.codec.decode(text_data, bytes_data)
+        except ValueError:
+            return
+        await self.receive_frame(frame)
+
+    async def receive_frame(self, frame):
+        raise NotImplementedError
@@ -0,0 +1,165 @@
+import time
+from collections import Counter, OrderedDict
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from .redis_client import get_redis
+
+# Budgets: chat messages, and everything else a client sends (location etc.)
+KINDS = ("message", "control")
+
+_checked = Counter()
+_rejected = Counter()
+
+
+def metrics():
+    """Frames checked and rejected in this process, by kind and by the bucket that rejected them."""
+    return {"checked": dict(_checked), "rejected": dict(_rejected)}
+
+
+def reset_metrics():
+    _checked.clear()
+    _rejected.clear()
+
+
+class TokenBucket:
+    """``rate`` tokens per second up to ``burst``; each frame takes one."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """0 if a token was taken, else the seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class MemoryIPLimiter:
+    """Per-IP buckets in process memory; the least recently seen IPs are forgotten first."""
+
+    def __init__(self, limits, max_keys=100_000):
+        self.limits = limits
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    async def take(self, ip, kind):
+        key = (ip, kind)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(*self.limits[kind])
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.take()
+
+    async def clear(self):
+        self._buckets.clear()
+
+
+# The same bucket as TokenBucket, in a hash that expires once it would be full again
+TAKE = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', ARGV[3])
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisIPLimiter:
+    """Per-IP buckets in Redis, shared by every worker."""
+
+    def __init__(self, limits, prefix="chat:ratelimit"):
+        self.limits = limits
+        self.prefix = prefix
+
+    async def take(self, ip, kind):
+        rate, burst = self.limits[kind]
+        key = f"{self.prefix}:{kind}:{ip}"
+        return float(await get_redis().eval(TAKE, 1, key, rate, burst, time.time()))
+
+    async def clear(self):
+        redis = get_redis()
+        async for key in redis.scan_iter(match=f"{self.prefix}:*", count=1000):
+            await redis.delete(key)
+
+
+_limiters = {}
+
+
+def get_ip_limiter():
+    backend = settings.CHAT_RATE_LIMIT_BACKEND
+    limiter = _limiters.get(backend)
+    if limiter is None:
+        if backend == "memory":
+            limiter = MemoryIPLimiter(settings.CHAT_IP_RATE_LIMITS)
+        elif backend == "redis":
+            limiter = RedisIPLimiter(settings.CHAT_IP_RATE_LIMITS)
+        else:
+            raise ImproperlyConfigured(f"Unknown CHAT_RATE_LIMIT_BACKEND {backend!r}")
+        _limiters[backend] = limiter
+    return limiter
+
+
+def client_ip(scope):
+    """
+    The client's address, from CHAT_CLIENT_IP_HEADER when behind a proxy.
+    Clients can put anything at the start of that header, so the address
+    is the one CHAT_TRUSTED_PROXY_HOPS entries from its end, where our own
+    proxies appended it.
+    """
+    header = settings.CHAT_CLIENT_IP_HEADER
+    if header:
+        name = header.lower().encode()
+        # Repeated headers count as one list, in order
+        values = [value.decode("latin-1") for key, value in scope.get("headers", ()) if key == name]
+        addresses = [address.strip() for address in ",".join(values).split(",") if address.strip()]
+        hops = settings.CHAT_TRUSTED_PROXY_HOPS
+        if hops and len(addresses) >= hops:
+            return addresses[-hops]
+    client = scope.get("client")
+    return client[0] if client else None
+
+
+class FrameLimiter:
+    """
+    The rate limits of one socket: its own buckets, checked first because
+    they cost nothing, then the buckets shared by every socket from its IP.
+    """
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.buckets = {kind: TokenBucket(*limit) for kind, limit in settings.CHAT_RATE_LIMITS.items()}
+
+    async def check(self, kind):
+        """0 if the frame may go through, else the seconds to wait."""
+        _checked[kind] += 1
+        bucket = self.buckets.get(kind)
+        wait = bucket.take() if bucket is not None else 0
+        if wait:
+            _rejected[f"connection.{kind}"] += 1
+            return wait
+        if self.ip and kind in settings.CHAT_IP_RATE_LIMITS:
+            wait = await get_ip_limiter().take(self.ip, kind)
+            if wait:
+                _rejected[f"ip.{kind}"] += 1
+        return wait
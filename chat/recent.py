@@ -0,0 +1,168 @@
+import json
+from collections import OrderedDict, deque
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from .redis_client import get_redis
+
+
+def buffered(message, anonymous=True):
+    """A Message as it appears in history pages."""
+    return {
+        "sender": message.sender,
+        "content": message.content,
+        "timestamp": message.timestamp.isoformat(),
+        "sender_profile": anonymous,
+    }
+
+
+def whole_room(messages, size, complete):
+    # A buffer started with its room holds all of it until the first message is dropped
+    return complete and len(messages) < size
+
+
+def latest(messages, limit, size, complete):
+    """
+    The last ``limit`` buffered ``messages``, or None when the buffer has
+    fewer and older ones may be missing from it.
+    """
+    if len(messages) >= limit or whole_room(messages, size, complete):
+        return messages[-limit:]
+    return None
+
+
+def newer(messages, after, size, complete):
+    """
+    The buffered ``messages`` sent after the ISO timestamp ``after``, or None
+    when the buffer starts after it and older ones may be missing from it.
+    """
+    if not whole_room(messages, size, complete) and (not messages or messages[0]["timestamp"] > after):
+        return None
+    return [message for message in messages if message["timestamp"] > after]
+
+
+class MemoryRecentMessages:
+    """
+    The last ``size`` messages of up to ``max_rooms`` rooms in process
+    memory; the least recently written room is evicted first. Buffers
+    created by ``start`` hold the whole room until they fill up; ones created
+    by ``add`` (after an eviction or restart) may have missed its start.
+    """
+
+    def __init__(self, size, max_rooms):
+        self.size = size
+        self.max_rooms = max_rooms
+        self._rooms = OrderedDict()
+        self._complete = set()
+
+    def _buffer(self, room_id):
+        messages = self._rooms.get(room_id)
+        if messages is None:
+            messages = self._rooms[room_id] = deque(maxlen=self.size)
+            if len(self._rooms) > self.max_rooms:
+                evicted, _ = self._rooms.popitem(last=False)
+                self._complete.discard(evicted)
+        else:
+            self._rooms.move_to_end(room_id)
+        return messages
+
+    async def start(self, room_id):
+        # Called when a room is paired, before its first message
+        if room_id not in self._rooms:
+            self._buffer(room_id)
+            self._complete.add(room_id)
+
+    async def add(self, room_id, message, anonymous=True):
+        self._buffer(room_id).append(buffered(message, anonymous))
+
+    async def get(self, room_id, limit):
+        messages = self._rooms.get(room_id)
+        if messages is None:
+            return None
+        return latest(list(messages), limit, self.size, room_id in self._complete)
+
+    async def since(self, room_id, after):
+        messages = self._rooms.get(room_id)
+        if messages is None:
+            return None
+        return newer(list(messages), after, self.size, room_id in self._complete)
+
+    async def discard(self, room_id):
+        self._rooms.pop(room_id, None)
+        self._complete.discard(room_id)
+
+    async def clear(self):
+        self._rooms.clear()
+        self._complete.clear()
+
+
+class RedisRecentMessages:
+    """
+    One capped Redis list per room, expiring ``ttl`` seconds after the last
+    message. A marker key set by ``start`` records that the list has held
+    the room since its first message.
+    """
+
+    def __init__(self, size, ttl, prefix="chat:recent"):
+        self.size = size
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def key(self, room_id):
+        return f"{self.prefix}:{room_id}"
+
+    def complete_key(self, room_id):
+        return f"{self.prefix}:{room_id}:complete"
+
+    async def start(self, room_id):
+        await get_redis().set(self.complete_key(room_id), 1, ex=self.ttl)
+
+    async def add(self, room_id, message, anonymous=True):
+        key = self.key(room_id)
+        async with get_redis().pipeline(transaction=False) as pipe:
+            pipe.rpush(key, json.dumps(buffered(message, anonymous)))
+            pipe.ltrim(key, -self.size, -1)
+            pipe.expire(key, self.ttl)
+            pipe.expire(self.complete_key(room_id), self.ttl)
+            await pipe.execute()
+
+    async def read(self, room_id):
+        # (buffered messages, whether the list holds the whole room); lists are at most ``size`` long
+        async with get_redis().pipeline(transaction=False) as pipe:
+            pipe.lrange(self.key(room_id), 0, -1)
+            pipe.exists(self.complete_key(room_id))
+            messages, complete = await pipe.execute()
+        return [json.loads(message) for message in messages], bool(complete)
+
+    async def get(self, room_id, limit):
+        messages, complete = await self.read(room_id)
+        return latest(messages, limit, self.size, complete)
+
+    async def since(self, room_id, after):
+        messages, complete = await self.read(room_id)
+        return newer(messages, after, self.size, complete)
+
+    async def discard(self, room_id):
+        await get_redis().delete(self.key(room_id), self.complete_key(room_id))
+
+    async def clear(self):
+        redis = get_redis()
+        async for key in redis.scan_iter(match=f"{self.prefix}:*", count=1000):
+            await redis.delete(key)
+
+
+_buffers = {}
+
+
+def get_recent_messages():
+    backend = settings.CHAT_RECENT_MESSAGES
+    buffer = _buffers.get(backend)
+    if buffer is None:
+        size = settings.CHAT_RECENT_MESSAGES_SIZE
+        if backend == "memory":
+            buffer = MemoryRecentMessages(size, settings.CHAT_RECENT_ROOMS)
+        elif backend == "redis":
+            buffer = RedisRecentMessages(size, settings.CHAT_RECENT_TTL)
+        else:
+            raise ImproperlyConfigured(f"Unknown CHAT_RECENT_MESSAGES backend {backend!r}")
+        _buffers[backend] = buffer
+    return buffer
@@ -0,0 +1,32 @@
+import asyncio
+import weakref
+from django.conf import settings
+
+# One client per event loop; redis.asyncio connections can't be shared across loops
+_clients = weakref.WeakKeyDictionary()
+
+
+def redis_url():
+    """Redis URL for chat state, defaulting to the channel layer's first host."""
+    url = getattr(settings, "CHAT_REDIS_URL", None)
+    if url:
+        return url
+    hosts = settings.CHANNEL_LAYERS.get("default", {}).get("CONFIG", {}).get("hosts") or []
+    if not hosts:
+        return "redis://localhost:6379"
+    host = hosts[0]
+    if isinstance(host, dict):
+        return host.get("address", "redis://localhost:6379")
+    if isinstance(host, (list, tuple)):
+        return "redis://%s:%s" % tuple(host)
+    return host
+
+
+def get_redis():
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        import redis.asyncio as aioredis
+        client = aioredis.Redis.from_url(redis_url(), decode_responses=True)
+        _clients[loop] = client
+    return client
@@ -0,0 +1,86 @@
+import json
+import secrets
+import time
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from .redis_client import get_redis
+
+
+def new_token():
+    return secrets.token_urlsafe(24)
+
+
+# Holds outlive the grace period so the partner's timer still finds them to
+# discard; only take() enforces the grace itself
+RETAIN_FACTOR = 2
+
+
+class MemoryResumeStore:
+    """Held rooms in process memory; a client can only resume on the same worker."""
+
+    def __init__(self):
+        self._held = {}
+
+    async def hold(self, token, session, grace):
+        now = time.monotonic()
+        # Expired holds are dropped as new ones arrive
+        for stale in [t for t, (expires, _) in self._held.items() if expires + grace * (RETAIN_FACTOR - 1) <= now]:
+            del self._held[stale]
+        self._held[token] = (now + grace, session)
+
+    async def take(self, token):
+        expires, session = self._held.pop(token, (0, None))
+        return session if expires > time.monotonic() else None
+
+    async def discard(self, token):
+        # True if the hold was still there, so the caller ends the room
+        return self._held.pop(token, None) is not None
+
+    async def clear(self):
+        self._held.clear()
+
+
+class RedisResumeStore:
+    """Held rooms as Redis keys that expire with the grace period, for every worker."""
+
+    def __init__(self, prefix="chat:resume"):
+        self.prefix = prefix
+
+    def key(self, token):
+        return f"{self.prefix}:{token}"
+
+    async def hold(self, token, session, grace):
+        session = {**session, "expires": time.time() + grace}
+        await get_redis().set(self.key(token), json.dumps(session), px=int(grace * RETAIN_FACTOR * 1000))
+
+    async def take(self, token):
+        session = await get_redis().getdel(self.key(token))
+        if not session:
+            return None
+        session = json.loads(session)
+        return session if session.pop("expires") > time.time() else None
+
+    async def discard(self, token):
+        return bool(await get_redis().delete(self.key(token)))
+
+    async def clear(self):
+        redis = get_redis()
+        async for key in redis.scan_iter(match=f"{self.prefix}:*", count=1000):
+            await redis.delete(key)
+
+
+_stores = {}
+
+
+def get_resume_store():
+    backend = settings.CHAT_RESUME_STORE
+    store = _stores.get(backend)
+    if store is None:
+        if backend == "memory":
+            store = MemoryResumeStore()
+        elif backend == "redis":
+            store = RedisResumeStore()
+        else:
+            raise ImproperlyConfigured(f"Unknown CHAT_RESUME_STORE backend {backend!r}")
+        _stores[backend] = store
+    return store
@@ -0,0 +1,125 @@
+import gzip
+import json
+import os
+from contextlib import contextmanager
+from datetime import timedelta
+from pathlib import Path
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import ChatRoom, Message
+
+ROOM_FIELDS = (
+    "pk", "room_id", "user1", "user2", "user1_profile_id", "user2_profile_id",
+    "user1_location", "user2_location", "created_at", "updated_at",
+)
+MESSAGE_FIELDS = ("pk", "room_id", "sender", "sender_profile_id", "content", "timestamp")
+
+
+def ended_rooms(cutoff):
+    # updated_at of an inactive room is when it ended (ChatRoomQuerySet.end)
+    return ChatRoom.objects.filter(active=False, updated_at__lt=cutoff)
+
+
+@contextmanager
+def durable_gzip(path):
+    """
+    Gzipped text stream that is complete on disk once the block exits: it is
+    written to ``<path>.part``, closed so the gzip trailer is out, fsynced
+    and only then renamed to ``path``. A crash leaves at most a .part file.
+    """
+    partial = path.with_name(path.name + ".part")
+    with open(partial, "wb") as raw:
+        with gzip.open(raw, "wt", encoding="utf-8") as archive:
+            yield archive
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(partial, path)
+    if os.name == "posix":
+        # The rename itself must survive a crash too
+        directory = os.open(path.parent, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+
+def archive_ended_rooms(days, archive_dir, chunk_size=500, delete_batch=1000, dry_run=False, log=None):
+    """
+    Stream rooms that ended more than ``days`` ago and their messages to
+    gzipped JSONL files, then delete them. Rooms are read in primary-key
+    order ``chunk_size`` at a time and messages through a server-side
+    iterator, so memory stays bounded. Each chunk gets its own file, which is
+    closed and fsynced before the chunk's rows are deleted in batches of
+    ``delete_batch``.
+
+    Every line is a JSON object with ``type`` "room" or "message".
+    """
+    cutoff = timezone.now() - timedelta(days=days)
+    stats = {"rooms": 0, "messages": 0, "files": []}
+    rooms = ended_rooms(cutoff).order_by("pk").values(*ROOM_FIELDS)
+    chunk = list(rooms[:chunk_size])
+    if not chunk or dry_run:
+        if dry_run:
+            stats["rooms"] = ended_rooms(cutoff).count()
+            stats["messages"] = Message.objects.filter(room__in=ended_rooms(cutoff)).count()
+        return stats
+
+    archive_dir = Path(archive_dir)
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    stamp = f"{timezone.now():%Y%m%d-%H%M%S}"
+    while chunk:
+        room_pks = [room["pk"] for room in chunk]
+        path = archive_dir / f"chat-archive-{stamp}-{len(stats['files']) + 1:04d}.jsonl.gz"
+        # The chunk must be durably on disk before its rows go away
+        with durable_gzip(path) as archive:
+            for room in chunk:
+                archive.write(json.dumps({"type": "room", **room}, cls=DjangoJSONEncoder) + "\n")
+            messages = (
+                Message.objects.filter(room_id__in=room_pks)
+                .order_by("room_id", "pk")
+                .values(*MESSAGE_FIELDS)
+                .iterator(chunk_size=2000)
+            )
+            for message in messages:
+                archive.write(json.dumps({"type": "message", **message}, cls=DjangoJSONEncoder) + "\n")
+                stats["messages"] += 1
+        stats["files"].append(str(path))
+        delete_rooms(room_pks, delete_batch)
+        stats["rooms"] += len(chunk)
+        if log:
+            log(f"archived {stats['rooms']} rooms, {stats['messages']} messages")
+        chunk = list(rooms.filter(pk__gt=room_pks[-1])[:chunk_size])
+    return stats
+
+
+def delete_rooms(room_pks, batch_size):
+    """
+    Delete rooms and their messages in statements of at most ``batch_size``
+    rows and return the number of messages deleted. Messages go first and
+    both use raw deletes, so Django never collects the cascade in Python.
+    """
+    deleted = 0
+    with transaction.atomic():
+        messages = Message.objects.filter(room_id__in=room_pks)
+        while True:
+            batch = list(messages.values_list("pk", flat=True)[:batch_size])
+            if not batch:
+                break
+            deleted += Message.objects.filter(pk__in=batch)._raw_delete(Message.objects.db)
+        for start in range(0, len(room_pks), batch_size):
+            ChatRoom.objects.filter(pk__in=room_pks[start:start + batch_size])._raw_delete(ChatRoom.objects.db)
+    return deleted
+
+
+def run_retention():
+    try:
+        return archive_ended_rooms(settings.CHAT_RETENTION_DAYS, settings.CHAT_ARCHIVE_DIR)
+    finally:
+        connection.close()
+
+
+# Off the shared database thread: a long archive run must not stall consumers
+run_retention_async = database_sync_to_async(run_retention, thread_sensitive=False)
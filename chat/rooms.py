@@ -0,0 +1,40 @@
+"""
+Room and participant queries of the chat and admin consumers, each one
+database call on the executor of ``db``.
+"""
+from accounts.models import UserProfile
+from .db import db_call
+from .models import ChatRoom
+
+
+@db_call
+def get_profile(user):
+    return UserProfile.objects.filter(user=user).first()
+
+
+@db_call
+def deactivate_room(room_id):
+    # Paired rooms only; waiting ones are released through the match queue
+    return ChatRoom.objects.filter(room_id=room_id, active=True, user2__isnull=False).end()
+
+
+@db_call
+def deactivate_all_rooms():
+    return ChatRoom.objects.filter(active=True, user2__isnull=False).end()
+
+
+@db_call
+def update_room_location(room_id, user_id, location):
+    # Conditional UPDATEs instead of a read-modify-write of the row
+    rooms = ChatRoom.objects.filter(room_id=room_id)
+    if not rooms.filter(user1=user_id).update(user1_location=location):
+        rooms.filter(user2=user_id).update(user2_location=location)
+
+
+@db_call
+def delete_room_record(room_id):
+    """The room's state before deletion, or None if it did not exist."""
+    room = ChatRoom.objects.filter(room_id=room_id).values("active", "user2").first()
+    if room is not None:
+        ChatRoom.objects.filter(room_id=room_id).delete()
+    return room
@@ -0,0 +1,50 @@
+import asyncio
+import logging
+import weakref
+from django.conf import settings
+from .lifecycle import on_shutdown
+
+logger = logging.getLogger(__name__)
+
+# loop -> {name: task}, so each server process runs a job at most once
+_running = weakref.WeakKeyDictionary()
+
+
+def start_periodic(name, interval, func):
+    """Run the async ``func`` every ``interval`` seconds on the running loop."""
+    loop = asyncio.get_running_loop()
+    tasks = _running.setdefault(loop, {})
+    if name in tasks:
+        return
+    tasks[name] = loop.create_task(_every(name, interval, func))
+    on_shutdown(_cancel_all)
+
+
+async def _cancel_all():
+    for tasks in list(_running.values()):
+        for task in tasks.values():
+            task.cancel()
+
+
+async def _every(name, interval, func):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await func()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Periodic task %s failed", name)
+
+
+def ensure_background_tasks():
+    """Start the periodic jobs enabled in settings; called from consumer connects."""
+    if settings.CHAT_RETENTION_INTERVAL:
+        from .retention import run_retention_async
+        start_periodic("retention", settings.CHAT_RETENTION_INTERVAL, run_retention_async)
+    if settings.CHAT_COUNTER_RECONCILE_INTERVAL:
+        from .counters import reconcile_in_background
+        start_periodic("counters", settings.CHAT_COUNTER_RECONCILE_INTERVAL, reconcile_in_background)
+    if settings.CHAT_HEARTBEAT_INTERVAL and settings.CHAT_REAPER_INTERVAL:
+        from .matchmaking import reap_waiting
+        start_periodic("reaper", settings.CHAT_REAPER_INTERVAL, reap_waiting)
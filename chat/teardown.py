@@ -0,0 +1,78 @@
+import asyncio
+import logging
+from channels.layers import get_channel_layer
+from django.db.models import Max
+from .db import db_call
+from .models import ChatRoom
+from .retention import delete_rooms
+
+logger = logging.getLogger(__name__)
+
+# Every ChatConsumer joins this group, so one send reaches all connections
+ALL_CHATS_GROUP = "chat-all"
+CHUNK_SIZE = 500
+DELETE_BATCH = 5000
+
+# The running delete-all job of this process, if any
+_teardown = None
+
+
+async def close_all_chats(message):
+    """Tell every connected stranger ``message`` and close their sockets."""
+    await get_channel_layer().group_send(ALL_CHATS_GROUP, {"type": "teardown", "message": message})
+
+
+@db_call
+def last_room_pk():
+    return ChatRoom.objects.aggregate(last=Max("pk"))["last"]
+
+
+@db_call
+def delete_chunk(after_pk, last_pk, chunk_size=CHUNK_SIZE):
+    room_pks = list(
+        ChatRoom.objects.filter(pk__gt=after_pk, pk__lte=last_pk)
+        .order_by("pk").values_list("pk", flat=True)[:chunk_size]
+    )
+    if not room_pks:
+        return None, 0, 0
+    return room_pks[-1], len(room_pks), delete_rooms(room_pks, DELETE_BATCH)
+
+
+async def delete_all_rooms(progress=None, chunk_size=CHUNK_SIZE):
+    """
+    Delete every room that exists when the job starts, ``chunk_size`` rooms
+    per database call so consumers keep their turn on the database thread.
+    Rooms created meanwhile are left alone. ``progress`` is awaited with the
+    running totals after each chunk.
+    """
+    stats = {"rooms": 0, "messages": 0}
+    last_pk = await last_room_pk()
+    after_pk = 0
+    while last_pk is not None:
+        after_pk, rooms, messages = await delete_chunk(after_pk, last_pk, chunk_size)
+        if after_pk is None:
+            break
+        stats["rooms"] += rooms
+        stats["messages"] += messages
+        if progress:
+            await progress(stats)
+    return stats
+
+
+def start_delete_all(progress=None, done=None):
+    """Run ``delete_all_rooms`` in the background; False if one is already running."""
+    global _teardown
+    if _teardown is not None and not _teardown.done():
+        return False
+
+    async def run():
+        try:
+            stats = await delete_all_rooms(progress)
+        except Exception:
+            logger.exception("Deleting all rooms failed")
+            stats = None
+        if done:
+            await done(stats)
+
+    _teardown = asyncio.get_running_loop().create_task(run())
+    return True
@@ -1,3 +1,1266 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import importlib
+import io
+import json
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from datetime import timedelta
+from functools import partial
+from pathlib import Path
+from unittest import mock, skipUnless
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from daphne.server import Server
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from twisted.internet.abstract import FileDescriptor
+from twisted.internet.testing import MemoryReactor
+from . import counters, db, geoip, matchmaking, outbox, protocol, ratelimit, recent, resume, rooms
+from .consumers import AdminConsumer, ChatConsumer
+from .models import ChatRoom, Message, UserProfile
+from .persistence import MessageWriter, get_message_writer
+from .recent import get_recent_messages
 
-# Create your tests here.
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+# A TestCase's transaction is only visible on the connection of the
+# thread-sensitive thread, so the chat app's ORM calls stay on that thread
+@override_settings(DATABASE_THREADS=0)
+class ChatTestCase(TestCase):
+    pass
+
+
+class QueryBudgetMixin:
+    """
+    Consumers run their database calls through thread-sensitive
+    database_sync_to_async, which async tests execute on the main thread's
+    connection. Queries are counted with an execute wrapper installed on
+    that connection.
+    """
+
+    def checkBudget(self, queries, budget):
+        listing = "\n".join(queries)
+        self.assertLessEqual(len(queries), budget, f"{len(queries)} queries, budget {budget}:\n{listing}")
+
+    def recordQueries(self):
+        queries = []
+
+        def record(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        return queries, lambda: connection.execute_wrapper(record)
+
+    @contextmanager
+    def assertQueryBudget(self, budget):
+        queries, wrapper = self.recordQueries()
+        with wrapper():
+            yield queries
+        self.checkBudget(queries, budget)
+
+    @asynccontextmanager
+    async def assertAsyncQueryBudget(self, budget):
+        # The wrapper must be built on the database thread, whose connection
+        # is not the one the event loop's context sees
+        queries, wrapper = self.recordQueries()
+        wrapper = await sync_to_async(wrapper)()
+        await sync_to_async(wrapper.__enter__)()
+        try:
+            yield queries
+        finally:
+            await sync_to_async(wrapper.__exit__)(None, None, None)
+        self.checkBudget(queries, budget)
+
+
+def reset_chat_state():
+    # Queues and counters outlive a test's transaction; start each test from zero
+    matchmaking._queues.clear()
+    recent._buffers.clear()
+    resume._stores.clear()
+    cache.clear()
+    async_to_sync(counters.reconcile)()
+
+
+async def receive_history(admin):
+    # Skips the subscribe acknowledgements, which may arrive in any order
+    while True:
+        frame = await admin.receive_json_from()
+        if frame.get("type") == "history":
+            return frame
+
+
+def chat_client(subprotocols=None, query="", user=None, headers=None):
+    consumer = ChatConsumer.as_asgi()
+    if user is None:
+        return WebsocketCommunicator(consumer, f"/ws/chat/{query}", headers=headers, subprotocols=subprotocols)
+
+    async def app(scope, receive, send):
+        return await consumer(dict(scope, user=user), receive, send)
+
+    return WebsocketCommunicator(app, f"/ws/chat/{query}", headers=headers, subprotocols=subprotocols)
+
+
+def admin_client(user):
+    consumer = AdminConsumer.as_asgi()
+
+    async def app(scope, receive, send):
+        return await consumer(dict(scope, user=user), receive, send)
+
+    return WebsocketCommunicator(app, "/ws/admin/")
+
+
+# Bursts of test messages would trip the per-connection buckets
+@override_settings(CHAT_MATCH_QUEUE="memory", CHAT_MATCH_BY_REGION=False, CHAT_RATE_LIMITS={})
+class ChatQueryBudgetTests(QueryBudgetMixin, ChatTestCase):
+    def setUp(self):
+        reset_chat_state()
+
+    async def pair(self, first=None):
+        first, second = first or chat_client(), chat_client()
+        await first.connect()
+        waiting = await first.receive_json_from()
+        await second.connect()
+        await second.receive_json_from()
+        await first.receive_json_from()
+        return first, second, waiting["room_id"]
+
+    async def test_waiting_connect_has_no_queries(self):
+        client = chat_client()
+        async with self.assertAsyncQueryBudget(0):
+            await client.connect()
+            self.assertEqual((await client.receive_json_from())["status"], "waiting")
+        await client.disconnect()
+
+    async def test_pairing_connect_writes_one_room(self):
+        first = chat_client()
+        await first.connect()
+        await first.receive_json_from()
+        second = chat_client()
+        async with self.assertAsyncQueryBudget(1):
+            await second.connect()
+            await second.receive_json_from()
+            await first.receive_json_from()
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_messages_skip_the_database_until_flushed(self):
+        first, second, _ = await self.pair()
+        async with self.assertAsyncQueryBudget(0):
+            for n in range(20):
+                await first.send_json_to({"message": f"hello {n}"})
+                await second.receive_json_from()
+        # One bulk INSERT for the whole batch
+        async with self.assertAsyncQueryBudget(1):
+            await get_message_writer().flush()
+        self.assertEqual(await Message.objects.acount(), 20)
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_signed_in_identity_is_resolved_once(self):
+        user = await User.objects.acreate(username="member")
+        profile = await UserProfile.objects.acreate(user=user, is_anonymous=False)
+        first = chat_client(user=user)
+        # The profile lookup is the only query of a waiting connect
+        async with self.assertAsyncQueryBudget(1):
+            await first.connect()
+            waiting = await first.receive_json_from()
+        second = chat_client()
+        await second.connect()
+        await second.receive_json_from()
+        await first.receive_json_from()
+        async with self.assertAsyncQueryBudget(0):
+            await first.send_json_to({"message": "signed in"})
+            self.assertEqual((await second.receive_json_from())["sender_name"], "User")
+            await second.send_json_to({"message": "anonymous"})
+            self.assertEqual((await first.receive_json_from())["sender_name"], "Anonymous")
+        await get_message_writer().flush()
+        room = await ChatRoom.objects.aget(room_id=waiting["room_id"])
+        self.assertEqual((room.user1_profile_id, room.user2_profile_id), (profile.pk, None))
+        senders = [m.sender_profile_id async for m in Message.objects.order_by("id")]
+        self.assertEqual(senders, [profile.pk, None])
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_signed_in_user_without_a_profile_goes_by_username(self):
+        admin = await User.objects.acreate(username="root", is_staff=True, is_superuser=True)
+        first, second, _ = await self.pair(first=chat_client(user=admin))
+        await first.send_json_to({"message": "hi"})
+        self.assertEqual((await second.receive_json_from())["sender_name"], "root")
+        await get_message_writer().flush()
+        message = await Message.objects.aget()
+        self.assertIsNone(message.sender_profile_id)
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_database_queue_pairing(self):
+        with override_settings(CHAT_MATCH_QUEUE="database"):
+            first = chat_client()
+            async with self.assertAsyncQueryBudget(2):
+                await first.connect()
+                await first.receive_json_from()
+            second = chat_client()
+            # Claim and fetch; Postgres adds the SKIP LOCKED transaction's savepoint
+            async with self.assertAsyncQueryBudget(4):
+                await second.connect()
+                await second.receive_json_from()
+                await first.receive_json_from()
+            self.assertEqual(await ChatRoom.objects.waiting().acount(), 0)
+            await first.disconnect()
+            await second.disconnect()
+
+    async def test_admin_subscribe(self):
+        staff = await User.objects.acreate(username="staff", is_staff=True)
+        first, second, room_id = await self.pair()
+        # As after a restart, when the buffer no longer holds the room
+        await get_recent_messages().clear()
+        admin = admin_client(staff)
+        await admin.connect()
+        # History joins the room and sender profiles in one query
+        async with self.assertAsyncQueryBudget(1):
+            await admin.send_json_to({"action": "subscribe_room", "room_id": room_id})
+            await receive_history(admin)
+        await admin.disconnect()
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_admin_history_of_a_short_room_from_recent_buffer(self):
+        staff = await User.objects.acreate(username="staff", is_staff=True)
+        first, second, room_id = await self.pair()
+        for n in range(3):
+            await first.send_json_to({"message": f"m{n}"})
+            await second.receive_json_from()
+        admin = admin_client(staff)
+        await admin.connect()
+        # The buffer has held the room since pairing, so three messages are all of it
+        async with self.assertAsyncQueryBudget(0):
+            await admin.send_json_to({"action": "subscribe_room", "room_id": room_id})
+            latest = await receive_history(admin)
+        self.assertEqual([m["content"] for m in latest["messages"]], ["m0", "m1", "m2"])
+        self.assertIsNone(latest["before"])
+        await admin.disconnect()
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_admin_history_from_recent_buffer(self):
+        staff = await User.objects.acreate(username="staff", is_staff=True)
+        first, second, room_id = await self.pair()
+        for n in range(60):
+            await first.send_json_to({"message": f"m{n}"})
+            await second.receive_json_from()
+        await get_message_writer().flush()
+        admin = admin_client(staff)
+        await admin.connect()
+        async with self.assertAsyncQueryBudget(0):
+            await admin.send_json_to({"action": "subscribe_room", "room_id": room_id})
+            latest = await receive_history(admin)
+        self.assertEqual([m["content"] for m in latest["messages"]], [f"m{n}" for n in range(10, 60)])
+        # Older pages come from the database
+        await admin.send_json_to({"action": "history", "room_id": room_id, "before": latest["before"]})
+        older = await receive_history(admin)
+        self.assertEqual([m["content"] for m in older["messages"]], [f"m{n}" for n in range(10)])
+        self.assertIsNone(older["before"])
+        await admin.disconnect()
+        await first.disconnect()
+        await second.disconnect()
+
+
+def match_entry(name, country=None, continent=None, waited=0, skip=None):
+    location = {"country": country, "continent": continent} if country or continent else None
+    return {
+        "room_id": str(uuid.uuid4()), "channel": name, "user": name,
+        "location": location, "skip": skip, "since": time.time() - waited,
+    }
+
+
+@contextmanager
+def fake_redis():
+    # Lua scripts included; each use starts from an empty server
+    client = fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True)
+    with mock.patch("chat.matchmaking.get_redis", return_value=client):
+        yield
+
+
+@override_settings(CHAT_MATCH_WIDEN_AFTER=10)
+class MatchQueueTests(ChatTestCase):
+    def setUp(self):
+        reset_chat_state()
+
+    async def check_pairs_in_arrival_order(self, queue):
+        first, second, third = match_entry("first"), match_entry("second"), match_entry("third")
+        self.assertIsNone(await queue.pair(first))
+        partner = await queue.pair(second)
+        self.assertEqual(partner["room_id"], first["room_id"])
+        room = await ChatRoom.objects.aget(pk=partner["room_pk"])
+        self.assertEqual((room.user1, room.user2, room.active), ("first", "second", True))
+        self.assertIsNone(await queue.pair(third))
+        self.assertEqual(await queue.size(), 1)
+        self.assertTrue(await queue.leave(third["room_id"]))
+        self.assertEqual(await queue.size(), 0)
+
+    async def check_skipped_strangers_are_kept_apart(self, queue):
+        # After "next" both sides skip each other, whichever arrives first
+        self.assertIsNone(await queue.pair(match_entry("left", skip="stayed")))
+        self.assertIsNone(await queue.pair(match_entry("stayed", skip="left")))
+        self.assertEqual((await queue.pair(match_entry("third")))["user"], "left")
+        self.assertEqual((await queue.pair(match_entry("fourth")))["user"], "stayed")
+        self.assertEqual(await queue.size(), 0)
+        # With nobody else around they meet once both stop skipping
+        left, stayed = match_entry("left", skip="stayed"), match_entry("stayed", skip="left")
+        self.assertIsNone(await queue.pair(left))
+        self.assertIsNone(await queue.pair(stayed))
+        self.assertIsNone(await queue.rematch(left))
+        self.assertEqual(await queue.size(), 2)
+        self.assertEqual((await queue.rematch(stayed))["user"], "left")
+        self.assertEqual(await queue.size(), 0)
+
+    async def test_memory_queue(self):
+        await self.check_pairs_in_arrival_order(matchmaking.InMemoryMatchQueue())
+        await self.check_skipped_strangers_are_kept_apart(matchmaking.InMemoryMatchQueue())
+
+    @skipUnless(fakeredis, "fakeredis is not installed")
+    async def test_redis_queue(self):
+        with fake_redis():
+            await self.check_pairs_in_arrival_order(matchmaking.RedisMatchQueue())
+        with fake_redis():
+            await self.check_skipped_strangers_are_kept_apart(matchmaking.RedisMatchQueue())
+
+    async def test_database_queue_claims_the_waiting_row(self):
+        await self.check_pairs_in_arrival_order(matchmaking.DatabaseMatchQueue())
+        await self.check_skipped_strangers_are_kept_apart(matchmaking.DatabaseMatchQueue())
+        # The leaver's row, and the one given up to join a rematched stranger,
+        # are closed rather than left waiting
+        self.assertEqual(await ChatRoom.objects.waiting().acount(), 0)
+        self.assertEqual(await ChatRoom.objects.filter(active=False).acount(), 2)
+
+    async def check_country_before_continent(self, queue):
+        japan = match_entry("japan", "JP", "AS")
+        india = match_entry("india", "IN")
+        self.assertIsNone(await queue.pair(japan))
+        self.assertIsNone(await queue.pair(india))
+        # Japan waited longer and shares the continent, but India shares the country
+        self.assertEqual((await queue.pair(match_entry("mumbai", "IN", "AS")))["user"], "india")
+        self.assertEqual((await queue.pair(match_entry("seoul", "KR", "AS")))["user"], "japan")
+
+    async def check_widening(self, queue):
+        # A stranger from elsewhere is taken once the head has waited long enough
+        self.assertIsNone(await queue.pair(match_entry("cairo", "EG", "AF", waited=60)))
+        self.assertEqual((await queue.pair(match_entry("quito", "EC", "SA")))["user"], "cairo")
+        # but not before
+        paris, lima = match_entry("paris", "FR", "EU"), match_entry("lima", "PE", "SA")
+        self.assertIsNone(await queue.pair(paris))
+        self.assertIsNone(await queue.pair(lima))
+        # widen() pairs a waiting entry with anyone else who waits
+        self.assertEqual((await queue.widen(lima))["user"], "paris")
+        self.assertEqual(await queue.size(), 0)
+
+    async def test_region_queue(self):
+        await self.check_country_before_continent(matchmaking.RegionMatchQueue())
+        await self.check_widening(matchmaking.RegionMatchQueue())
+        await self.check_skipped_strangers_are_kept_apart(matchmaking.RegionMatchQueue())
+
+    @skipUnless(fakeredis, "fakeredis is not installed")
+    async def test_redis_region_queue(self):
+        with fake_redis():
+            await self.check_country_before_continent(matchmaking.RedisRegionMatchQueue())
+        with fake_redis():
+            await self.check_widening(matchmaking.RedisRegionMatchQueue())
+        with fake_redis():
+            await self.check_skipped_strangers_are_kept_apart(matchmaking.RedisRegionMatchQueue())
+
+
+@override_settings(
+    CHAT_MATCH_QUEUE="memory", CHAT_MATCH_BY_REGION=True, CHAT_MATCH_WIDEN_AFTER=0.2, CHAT_LOCATION_WAIT=5,
+)
+class RegionMatchTests(ChatTestCase):
+    def setUp(self):
+        reset_chat_state()
+
+    async def test_matching_waits_for_the_location_frame(self):
+        first = chat_client()
+        await first.connect()
+        self.assertTrue(await first.receive_nothing(0.2))
+        await first.send_json_to({"type": "location", "location": {"country": "IN", "continent": "AS"}})
+        waiting = await first.receive_json_from()
+        self.assertEqual(waiting["status"], "waiting")
+        second = chat_client(query="?country=IN&continent=AS")
+        await second.connect()
+        self.assertEqual((await second.receive_json_from())["message"], "You are now connected!")
+        self.assertEqual((await first.receive_json_from())["message"], "You are now connected!")
+        room = await ChatRoom.objects.aget(room_id=waiting["room_id"])
+        self.assertEqual((room.user1_location["country"], room.user2_location["country"]), ("IN", "IN"))
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_search_widens_after_the_timeout(self):
+        first = chat_client(query="?country=FR&continent=EU")
+        second = chat_client(query="?country=PE&continent=SA")
+        await first.connect()
+        await second.connect()
+        # Both wait in their own region until widen_search takes the other
+        for client in (first, second):
+            self.assertEqual((await client.receive_json_from())["status"], "waiting")
+        for client in (first, second):
+            self.assertEqual((await client.receive_json_from(1))["message"], "You are now connected!")
+        self.assertEqual(await ChatRoom.objects.filter(active=True, user2__isnull=False).acount(), 1)
+        await first.disconnect()
+        await second.disconnect()
+
+
+@override_settings(CHAT_MATCH_QUEUE="memory", CHAT_MATCH_BY_REGION=False)
+class DirectDeliveryTests(ChatTestCase):
+    def setUp(self):
+        reset_chat_state()
+
+    async def test_direct_until_an_admin_watches(self):
+        staff = await User.objects.acreate(username="staff", is_staff=True)
+        first, second = chat_client(), chat_client()
+        await first.connect()
+        waiting = await first.receive_json_from()
+        await second.connect()
+        await second.receive_json_from()
+        await first.receive_json_from()
+        layer = get_channel_layer()
+        with mock.patch.object(layer, "group_send", wraps=layer.group_send) as group_send:
+            await first.send_json_to({"message": "direct"})
+            self.assertEqual((await second.receive_json_from())["message"], "direct")
+            room_sends = [c for c in group_send.await_args_list if c.args[0] == waiting["room_id"]]
+            self.assertEqual(room_sends, [])
+
+            admin = admin_client(staff)
+            await admin.connect()
+            await admin.send_json_to({"action": "subscribe_room", "room_id": waiting["room_id"]})
+            frames = [await admin.receive_json_from() for _ in range(4)]
+            self.assertEqual(sum(frame.get("status") == "observing" for frame in frames), 2)
+            await second.send_json_to({"message": "watched"})
+            self.assertEqual((await first.receive_json_from())["message"], "watched")
+            self.assertEqual((await admin.receive_json_from())["message"], "watched")
+            self.assertTrue(await second.receive_nothing())
+        await admin.disconnect()
+        await first.disconnect()
+        await second.disconnect()
+
+
+@override_settings(CHAT_MATCH_QUEUE="memory", CHAT_MATCH_BY_REGION=False)
+class ProtocolTests(ChatTestCase):
+    def setUp(self):
+        reset_chat_state()
+
+    @skipUnless(protocol.msgpack, "msgpack is not installed")
+    async def test_msgpack_client_talks_to_legacy_client(self):
+        codec = protocol.CODECS[protocol.MSGPACK_SUBPROTOCOL]
+        first, second = chat_client(), chat_client(["chat.v9.cbor", protocol.MSGPACK_SUBPROTOCOL])
+        self.assertEqual(await first.connect(), (True, None))
+        await first.receive_json_from()
+        self.assertEqual(await second.connect(), (True, protocol.MSGPACK_SUBPROTOCOL))
+        self.assertEqual(codec.decode(bytes_data=await second.receive_from())["message"], "You are now connected!")
+        await first.receive_json_from()
+
+        await second.send_to(**codec.encode({"message": "binary"}))
+        self.assertEqual(await first.receive_json_from(), {"message": "binary", "sender_name": "Anonymous"})
+        await first.send_json_to({"message": "text"})
+        self.assertEqual(codec.decode(bytes_data=await second.receive_from()), {"message": "text", "sender_name": "Anonymous"})
+
+        # Frames the negotiated codec cannot read are dropped
+        await second.send_to(text_data='{"message": "text"}')
+        await first.send_to(text_data="not json")
+        self.assertTrue(await first.receive_nothing())
+        self.assertTrue(await second.receive_nothing())
+        await first.disconnect()
+        await second.disconnect()
+
+    def test_json_codec_round_trip(self):
+        codec = protocol.negotiate([protocol.JSON_SUBPROTOCOL])
+        frame = {"type": "history", "messages": [{"content": "héllo"}], "before": None}
+        self.assertEqual(codec.decode(**codec.encode(frame)), frame)
+        with self.assertRaises(ValueError):
+            codec.decode(text_data="[1, 2]")
+
+
+@override_settings(
+    CHAT_MATCH_QUEUE="memory", CHAT_MATCH_BY_REGION=False, CHAT_RATE_LIMIT_BACKEND="memory",
+    CHAT_RATE_LIMITS={"message": (0.01, 2), "control": (0.01, 1)},
+    CHAT_IP_RATE_LIMITS={"message": (0.01, 3)}, CHAT_CLIENT_IP_HEADER="X-Forwarded-For",
+)
+class RateLimitTests(QueryBudgetMixin, ChatTestCase):
+    def setUp(self):
+        reset_chat_state()
+        ratelimit.reset_metrics()
+        ratelimit._limiters.clear()
+
+    async def test_connection_budget(self):
+        first, second = chat_client(), chat_client()
+        await first.connect()
+        await first.receive_json_from()
+        await second.connect()
+        await second.receive_json_from()
+        await first.receive_json_from()
+        # Only the first location update reaches the database
+        async with self.assertAsyncQueryBudget(2):
+            for n in range(4):
+                await first.send_json_to({"message": f"m{n}"})
+            await first.send_json_to({"type": "location", "location": "IN"})
+            await first.send_json_to({"type": "location", "location": "FR"})
+            self.assertEqual([(await second.receive_json_from())["message"] for _ in range(2)], ["m0", "m1"])
+            self.assertTrue(await second.receive_nothing())
+            notices = [await first.receive_json_from() for _ in range(2)]
+        self.assertEqual([(n["status"], n["kind"]) for n in notices], [("rate_limited", "message"), ("rate_limited", "control")])
+        self.assertTrue(await first.receive_nothing())
+        self.assertEqual(ratelimit.metrics()["rejected"], {"connection.message": 2, "connection.control": 1})
+        await first.disconnect()
+        await second.disconnect()
+
+    @override_settings(CHAT_HEARTBEAT_INTERVAL=0.05)
+    async def test_throttled_client_that_answers_pings_stays_connected(self):
+        client = chat_client()
+        await client.connect()
+        await client.receive_json_from()
+        self.assertEqual((await client.receive_json_from())["type"], "ping")
+        await client.send_json_to({"type": "pong"})
+        await client.send_json_to({"type": "location", "location": "IN"})
+        await client.send_json_to({"type": "location", "location": "FR"})
+        frame = await client.receive_json_from()
+        while frame.get("type") == "ping":
+            frame = await client.receive_json_from()
+        self.assertEqual(frame["status"], "rate_limited")
+        # Its control budget is spent for the next 100s, but pongs still count
+        for _ in range(6):
+            self.assertEqual((await client.receive_json_from())["type"], "ping")
+            await client.send_json_to({"type": "pong"})
+        self.assertEqual(ratelimit.metrics()["rejected"], {"connection.control": 1})
+        await client.disconnect()
+
+    def test_client_ip_is_the_one_our_proxies_saw(self):
+        # The client sent "1.2.3.4" itself; the proxy appended the address it saw
+        scope = {"headers": [(b"x-forwarded-for", b"1.2.3.4, 203.0.113.7")], "client": ("10.0.0.1", 5000)}
+        self.assertEqual(ratelimit.client_ip(scope), "203.0.113.7")
+        with override_settings(CHAT_TRUSTED_PROXY_HOPS=2):
+            scope["headers"].append((b"x-forwarded-for", b"10.0.0.2"))
+            self.assertEqual(ratelimit.client_ip(scope), "203.0.113.7")
+            # Fewer entries than proxies: the request did not come through them
+            self.assertEqual(ratelimit.client_ip({"headers": [(b"x-forwarded-for", b"1.2.3.4")],
+                                                  "client": ("10.0.0.1", 5000)}), "10.0.0.1")
+
+    async def test_ip_budget_is_shared_by_connections(self):
+        first, second = ratelimit.FrameLimiter("203.0.113.7"), ratelimit.FrameLimiter("203.0.113.7")
+        self.assertEqual([await first.check("message"), await first.check("message")], [0, 0])
+        self.assertEqual(await second.check("message"), 0)
+        self.assertGreater(await second.check("message"), 0)
+        self.assertEqual(await ratelimit.FrameLimiter("198.51.100.1").check("message"), 0)
+        self.assertEqual(ratelimit.metrics()["rejected"], {"ip.message": 1})
+
+
+@override_settings(
+    CHAT_MATCH_QUEUE="memory", CHAT_MATCH_BY_REGION=False, CHAT_HEARTBEAT_INTERVAL=0.05, CHAT_WAITING_TIMEOUT=0.2,
+)
+class HeartbeatTests(ChatTestCase):
+    def setUp(self):
+        reset_chat_state()
+
+    async def test_heartbeats_keep_waiting_entries_and_ghosts_are_reaped(self):
+        queue = matchmaking.get_match_queue()
+        client = chat_client()
+        await client.connect()
+        waiting = await client.receive_json_from()
+        ghost = {"room_id": "ghost", "channel": "gone", "user": "gone", "since": time.time() - 60}
+        queue._waiting["ghost"] = ghost
+        for _ in range(6):
+            self.assertEqual(await client.receive_json_from(), {"type": "ping"})
+            await client.send_json_to({"type": "pong"})
+        self.assertEqual(await matchmaking.reap_waiting(), 1)
+        self.assertEqual([entry["room_id"] for entry in await queue.waiting()], [waiting["room_id"]])
+        await client.disconnect()
+
+    async def test_client_that_stops_answering_is_closed(self):
+        client = chat_client()
+        await client.connect()
+        await client.receive_json_from()
+        self.assertEqual(await client.receive_json_from(), {"type": "ping"})
+        await client.send_json_to({"type": "pong"})
+        self.assertEqual(await client.receive_json_from(), {"type": "ping"})
+        self.assertEqual((await client.receive_output(timeout=1))["type"], "websocket.close")
+        await client.disconnect()
+
+    async def test_database_queue_skips_and_reaps_dead_rooms(self):
+        with override_settings(CHAT_MATCH_QUEUE="database"):
+            ghost = await ChatRoom.objects.acreate(user1="gone", user2=None, active=True)
+            await ChatRoom.objects.filter(pk=ghost.pk).aupdate(updated_at=timezone.now() - timedelta(minutes=5))
+            client = chat_client()
+            await client.connect()
+            self.assertEqual((await client.receive_json_from())["status"], "waiting")
+            self.assertEqual(await matchmaking.reap_waiting(), 1)
+            self.assertFalse((await ChatRoom.objects.aget(pk=ghost.pk)).active)
+            self.assertEqual(await ChatRoom.objects.waiting().acount(), 1)
+            await client.disconnect()
+
+
+@override_settings(
+    CHAT_MATCH_QUEUE="memory", CHAT_MATCH_BY_REGION=False, CHAT_RESUME_STORE="memory", CHAT_RESUME_GRACE=0.3,
+)
+class ResumeTests(ChatTestCase):
+    def setUp(self):
+        reset_chat_state()
+
+    async def pair(self):
+        first, second = chat_client(), chat_client()
+        await first.connect()
+        waiting = await first.receive_json_from()
+        await second.connect()
+        connected = await second.receive_json_from()
+        await first.receive_json_from()
+        await second.send_json_to({"type": "resumable", "token": connected["resume_token"]})
+        return waiting["room_id"], first, second, connected
+
+    async def test_dropped_partner_resumes_and_gets_missed_messages(self):
+        room_id, first, second, connected = await self.pair()
+        await second.disconnect(code=1006)
+        self.assertEqual((await first.receive_json_from())["status"], "partner_away")
+        await first.send_json_to({"message": "while you were away"})
+        self.assertTrue(await first.receive_nothing())
+
+        back = chat_client(query=f"?resume={connected['resume_token']}")
+        await back.connect()
+        resumed = await back.receive_json_from()
+        self.assertEqual((resumed["status"], resumed["room_id"]), ("resumed", room_id))
+        self.assertNotEqual(resumed["resume_token"], connected["resume_token"])
+        replayed = await back.receive_json_from()
+        self.assertEqual((replayed["message"], replayed["replayed"]), ("while you were away", True))
+        self.assertEqual((await first.receive_json_from())["status"], "partner_back")
+        await first.send_json_to({"message": "welcome back"})
+        self.assertEqual((await back.receive_json_from())["message"], "welcome back")
+        self.assertTrue(await ChatRoom.objects.filter(room_id=room_id, active=True).aexists())
+        await back.disconnect()
+        await first.disconnect()
+
+    async def test_room_ends_after_grace_and_clean_close_ends_it_at_once(self):
+        room_id, first, second, connected = await self.pair()
+        await second.disconnect(code=1006)
+        self.assertEqual((await first.receive_json_from())["status"], "partner_away")
+        self.assertEqual((await first.receive_json_from(timeout=1))["message"], "Stranger has disconnected.")
+        self.assertEqual((await first.receive_output(timeout=1))["type"], "websocket.close")
+        await first.disconnect()
+        self.assertFalse(await ChatRoom.objects.filter(room_id=room_id, active=True).aexists())
+
+        late = chat_client(query=f"?resume={connected['resume_token']}")
+        await late.connect()
+        self.assertEqual(await late.receive_json_from(), {"status": "resume_failed"})
+        self.assertEqual((await late.receive_json_from())["status"], "waiting")
+        await late.disconnect()
+
+        # Closing or leaving the page (1001) is as clean as a normal close
+        for code in (1000, 1001):
+            room_id, first, second, connected = await self.pair()
+            await second.disconnect(code=code)
+            self.assertEqual((await first.receive_json_from())["message"], "Stranger has disconnected.")
+            await first.disconnect()
+
+    async def test_rooms_are_only_held_for_clients_that_acknowledged_the_token(self):
+        first, second = chat_client(), chat_client()
+        await first.connect()
+        await first.receive_json_from()
+        await second.connect()
+        await second.receive_json_from()
+        await first.receive_json_from()
+        await second.send_json_to({"type": "resumable", "token": "not-the-token"})
+        await second.disconnect(code=1006)
+        self.assertEqual((await first.receive_json_from())["message"], "Stranger has disconnected.")
+        await first.disconnect()
+
+
+@override_settings(CHAT_MATCH_QUEUE="memory", CHAT_MATCH_BY_REGION=False)
+class NextPartnerTests(ChatTestCase):
+    def setUp(self):
+        reset_chat_state()
+
+    async def test_next_requeues_both_sockets_apart(self):
+        first, second = chat_client(), chat_client()
+        await first.connect()
+        waiting = await first.receive_json_from()
+        await second.connect()
+        await second.receive_json_from()
+        await first.receive_json_from()
+
+        await first.send_json_to({"type": "next"})
+        self.assertEqual((await second.receive_json_from())["message"], "Stranger has disconnected.")
+        # The two skip each other, so both wait for someone new
+        rooms = []
+        for client in (first, second):
+            frame = await client.receive_json_from()
+            self.assertEqual(frame["status"], "waiting")
+            rooms.append(frame["room_id"])
+        self.assertNotIn(waiting["room_id"], rooms)
+        self.assertFalse(await ChatRoom.objects.filter(room_id=waiting["room_id"], active=True).aexists())
+
+        newcomers = [chat_client(), chat_client()]
+        for client in newcomers:
+            await client.connect()
+            self.assertEqual((await client.receive_json_from())["message"], "You are now connected!")
+        for client in (first, second):
+            self.assertEqual((await client.receive_json_from())["message"], "You are now connected!")
+        self.assertEqual(await ChatRoom.objects.filter(active=True, user2__isnull=False).acount(), 2)
+        await newcomers[0].send_json_to({"message": "hello"})
+        # Exactly one of the two got the newcomer as its new partner
+        quiet = [await client.receive_nothing(timeout=0.2) for client in (first, second)]
+        self.assertEqual(sorted(quiet), [False, True])
+        for client in (first, second, *newcomers):
+            await client.disconnect()
+
+
+    @override_settings(CHAT_SKIP_TIMEOUT=0.1)
+    async def test_two_strangers_alone_meet_again_after_the_skip_timeout(self):
+        first, second = chat_client(), chat_client()
+        await first.connect()
+        waiting = await first.receive_json_from()
+        await second.connect()
+        await second.receive_json_from()
+        await first.receive_json_from()
+
+        await first.send_json_to({"type": "next"})
+        await second.receive_json_from()
+        for client in (first, second):
+            self.assertEqual((await client.receive_json_from())["status"], "waiting")
+        for client in (first, second):
+            self.assertEqual((await client.receive_json_from(timeout=1))["message"], "You are now connected!")
+        room = await ChatRoom.objects.aget(active=True, user2__isnull=False)
+        self.assertNotEqual(str(room.room_id), waiting["room_id"])
+        await first.send_json_to({"message": "hello again"})
+        self.assertEqual((await second.receive_json_from())["message"], "hello again")
+        await first.disconnect()
+        await second.disconnect()
+
+
+class DatabaseExecutorTests(ChatTestCase):
+    def setUp(self):
+        db.reset_metrics()
+
+    async def test_calls_run_on_the_sized_executor_and_are_measured(self):
+        release = threading.Event()
+
+        def blocking():
+            release.wait(1)
+            return threading.current_thread().name
+
+        with override_settings(DATABASE_THREADS=2):
+            calls = [asyncio.ensure_future(db.run(blocking)) for _ in range(3)]
+            await asyncio.sleep(0.05)
+            # Two calls hold both threads and the third waits for one of them
+            self.assertEqual(db.metrics()["in_flight"], 3)
+            release.set()
+            names = await asyncio.gather(*calls)
+        self.assertTrue(all(name.startswith("chat-db") for name in names))
+        metrics = db.metrics()
+        self.assertEqual((metrics["calls"], metrics["in_flight"], metrics["max_in_flight"]), (3, 0, 3))
+        self.assertGreater(metrics["max_wait_ms"], 0)
+
+
+GEOIP_ROWS = [
+    ["1.0.0.0", "1.0.0.255", "OC", "AU", "Queensland", "Brisbane", "-27.4679", "153.028"],
+    ["203.0.113.0", "203.0.113.127", "AS", "IN", "Maharashtra", "Mumbai", "19.0728", "72.8826"],
+    ["203.0.113.128", "203.0.113.255", "AS", "IN", "Maharashtra", "Mumbai", "19.0728", "72.8826"],
+    ["198.51.100.0", "198.51.100.255", "EU", "FR", "Ile-de-France", "Paris", "48.8566", "2.3522"],
+    ["2001:db8::", "2001:db8::ffff", "EU", "DE", "Berlin", "Berlin", "52.5244", "13.4105"],
+]
+
+
+class GeoIPTests(ChatTestCase):
+    def setUp(self):
+        reset_chat_state()
+        self.path = Path(tempfile.mkdtemp()) / "dbip-city-lite.csv.gz"
+        with gzip.open(self.path, "wt", newline="") as f:
+            csv.writer(f).writerows([["not", "a", "range", "", "", "", "", ""], *reversed(GEOIP_ROWS)])
+        self.addCleanup(geoip._databases.clear)
+
+    def test_lookup(self):
+        database = geoip.GeoIPDatabase.load(self.path, cache_size=2)
+        # Equal locations are stored once
+        self.assertEqual((len(database), len(database.locations)), (5, 4))
+        self.assertEqual(database.lookup("203.0.113.200")["city"], "Mumbai")
+        self.assertEqual(database.lookup("1.0.0.0")["country"], "AU")
+        self.assertEqual(database.lookup("2001:db8::42"), {
+            "continent": "EU", "country": "DE", "city": "Berlin",
+            "latitude": 52.5244, "longitude": 13.4105, "method": "ip_based",
+        })
+        for address in ("1.0.1.0", "0.0.0.1", "::1", "2001:db8::1:0", "unknown"):
+            self.assertIsNone(database.lookup(address))
+        self.assertEqual(list(database._cache), ["2001:db8::1:0", "unknown"])
+
+    @override_settings(CHAT_MATCH_QUEUE="memory", CHAT_MATCH_BY_REGION=True, CHAT_CLIENT_IP_HEADER="X-Forwarded-For")
+    async def test_connect_fills_the_location(self):
+        with override_settings(CHAT_GEOIP_DATABASE=str(self.path)):
+            # The forged leading entry is ignored for the one our proxy appended
+            first = chat_client(headers=[(b"x-forwarded-for", b"198.51.100.9, 203.0.113.7")])
+            second = chat_client(headers=[(b"x-forwarded-for", b"203.0.113.200")])
+            await first.connect()
+            waiting = await first.receive_json_from()
+            # Region matching needs no location frame
+            await second.connect()
+            await second.receive_json_from()
+            await first.receive_json_from()
+            # and the one a client sends does not replace the lookup
+            await first.send_json_to({"type": "location", "location": {"country": "US"}})
+            self.assertTrue(await first.receive_nothing())
+        room = await ChatRoom.objects.aget(room_id=waiting["room_id"])
+        self.assertEqual([room.user1_location["country"], room.user2_location["country"]], ["IN", "IN"])
+        self.assertEqual(room.user1_location["method"], "ip_based")
+        await first.disconnect()
+        await second.disconnect()
+
+    def test_asgi_startup_loads_the_database(self):
+        with override_settings(CHAT_GEOIP_DATABASE=str(self.path)):
+            importlib.reload(importlib.import_module("backend.asgi"))
+        self.assertEqual(len(geoip._databases[str(self.path)]), 5)
+
+    def test_web_client_locates_itself_only_without_a_database(self):
+        with override_settings(CHAT_GEOIP_DATABASE=""):
+            self.assertIn("const locateInBrowser = true;", self.client.get("/chat/", secure=True).content.decode())
+        with override_settings(CHAT_GEOIP_DATABASE=str(self.path)):
+            self.assertIn("const locateInBrowser = false;", self.client.get("/chat/", secure=True).content.decode())
+
+
+class OutboxTests(ChatTestCase):
+    def setUp(self):
+        outbox.reset_metrics()
+        self.sent = []
+        self.closed = []
+        self.unblocked = asyncio.Event()
+
+    async def send(self, text_data=None, bytes_data=None):
+        await self.unblocked.wait()
+        self.sent.append(json.loads(text_data))
+
+    async def close(self, code=None, reason=None):
+        self.closed.append(code)
+
+    async def slow_outbox(self, policy, codec=protocol.LEGACY):
+        box = outbox.Outbox(self.send, self.close, codec, max_size=3, policy=policy)
+        box.start()
+        # The first frame is taken off the queue and stuck in a slow send
+        box.put({"n": 0})
+        await asyncio.sleep(0)
+        return box
+
+    async def test_drop_oldest(self):
+        box = await self.slow_outbox("drop_oldest")
+        for n in range(1, 6):
+            box.put({"n": n})
+        self.assertEqual(outbox.metrics()["queued"], 3)
+        self.unblocked.set()
+        box.close()
+        await asyncio.wait_for(box._task, 1)
+        self.assertEqual(self.sent, [{"n": 0}, {"n": 3}, {"n": 4}, {"n": 5}])
+        self.assertEqual(self.closed, [None])
+        self.assertEqual((outbox.metrics()["dropped"], outbox.metrics()["max_queued"]), (2, 3))
+
+    async def test_disconnect_slow_client(self):
+        box = await self.slow_outbox("disconnect")
+        for n in range(1, 6):
+            box.put({"n": n})
+        self.unblocked.set()
+        await asyncio.wait_for(box._task, 1)
+        self.assertEqual(self.sent, [{"n": 0}])
+        self.assertEqual(self.closed, [outbox.SLOW_CLIENT_CLOSE_CODE])
+        self.assertEqual(outbox.metrics()["slow_disconnects"], 1)
+
+    def daphne_outbox(self, policy):
+        """An Outbox writing through daphne's send into a socket whose peer reads nothing yet."""
+        server = Server(application=None, endpoints=["tcp:port=0"])
+        socket = SlowSocket()
+        connection_protocol = DaphneProtocol(socket)
+        # What Server.run and the protocol factory set up for a live socket
+        server.connections = {connection_protocol: {}}
+        base_send = partial(server.handle_reply, connection_protocol)
+
+        async def send(text_data=None, bytes_data=None):
+            await base_send({"type": "websocket.send", "text": text_data})
+
+        box = outbox.Outbox(
+            send, self.close, protocol.LEGACY, max_size=3, policy=policy,
+            backlog=outbox.server_backlog(base_send), max_buffered=100,
+        )
+        box.start()
+        return box, socket, connection_protocol
+
+    async def put_slowly(self, box, count):
+        for n in range(count):
+            box.put({"n": n, "padding": "x" * 50})
+            await asyncio.sleep(0)
+
+    async def test_daphne_buffer_fills_the_queue(self):
+        box, socket, connection_protocol = self.daphne_outbox("drop_oldest")
+        await self.put_slowly(box, 10)
+        # daphne's send returned at once for the first two frames, then its
+        # buffer was over the limit and the rest waited here
+        self.assertEqual([frame["n"] for frame in connection_protocol.frames], [0, 1])
+        self.assertEqual(outbox.metrics()["queued"], 3)
+        self.assertEqual(outbox.metrics()["dropped"], 5)
+        socket.read(10_000)
+        box.close()
+        await asyncio.wait_for(box._task, 1)
+        self.assertEqual([frame["n"] for frame in connection_protocol.frames], [0, 1, 7, 8, 9])
+        # Writing stalled again before frame 9, which went out because we are closing
+        self.assertEqual(outbox.metrics()["stalls"], 2)
+
+    async def test_daphne_slow_client_is_disconnected(self):
+        box, socket, connection_protocol = self.daphne_outbox("disconnect")
+        await self.put_slowly(box, 10)
+        # Closing does not wait for a client that reads nothing
+        await asyncio.wait_for(box._task, 1)
+        self.assertEqual(len(connection_protocol.frames), 2)
+        self.assertEqual(self.closed, [outbox.SLOW_CLIENT_CLOSE_CODE])
+
+
+class SlowSocket(FileDescriptor):
+    """A Twisted socket transport whose peer reads only what ``read`` allows."""
+
+    def __init__(self):
+        super().__init__(reactor=MemoryReactor())
+        self.connected = True
+        self.readable = 0
+
+    def writeSomeData(self, data):
+        written = min(len(data), self.readable)
+        self.readable -= written
+        return written
+
+    def read(self, size):
+        self.readable += size
+        self.doWrite()
+
+
+class DaphneProtocol:
+    """daphne's WebSocketProtocol as far as replies go: frames are written to the transport."""
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.frames = []
+
+    def handle_reply(self, message):
+        self.frames.append(json.loads(message["text"]))
+        self.transport.write(message["text"].encode())
+
+
+class MessageWriterTests(ChatTestCase):
+    def flaky_bulk_create(self, failures):
+        """Patch Message.objects.bulk_create to raise OperationalError on its first ``failures`` calls."""
+        bulk_create = Message.objects.bulk_create
+        self.batches = []
+
+        def flaky(batch):
+            self.batches.append([message.content for message in batch])
+            if len(self.batches) <= failures:
+                raise OperationalError("server closed the connection unexpectedly")
+            return bulk_create(batch)
+
+        return mock.patch.object(Message.objects, "bulk_create", side_effect=flaky)
+
+    async def test_failed_batch_is_retried(self):
+        room = await ChatRoom.objects.acreate(user1="a", user2="b", active=True)
+        writer = MessageWriter(batch_size=10, flush_interval=0.01)
+        with self.flaky_bulk_create(failures=1), self.assertLogs("chat.persistence", "WARNING"):
+            writer.add(room.pk, "a", "first")
+            await writer.flush()
+            self.assertEqual(writer.pending, 1)
+            writer.add(room.pk, "b", "second")
+            # The backoff timer retries both, in send order
+            await asyncio.sleep(0.1)
+        self.assertEqual(self.batches, [["first"], ["first", "second"]])
+        self.assertEqual(writer.pending, 0)
+        contents = [m.content async for m in Message.objects.filter(room=room).order_by("pk")]
+        self.assertEqual(contents, ["first", "second"])
+
+    async def test_gives_up_after_max_retries(self):
+        room = await ChatRoom.objects.acreate(user1="a", user2="b", active=True)
+        writer = MessageWriter(batch_size=10, flush_interval=0.01, max_retries=2)
+        with self.flaky_bulk_create(failures=10), self.assertLogs("chat.persistence", "ERROR"):
+            writer.add(room.pk, "a", "lost")
+            await writer.flush()
+            await asyncio.sleep(0.2)
+        self.assertEqual(len(self.batches), 3)
+        self.assertEqual(writer.pending, 0)
+        self.assertFalse(await Message.objects.filter(room=room).aexists())
+
+
+@override_settings(CHAT_MATCH_QUEUE="memory", CHAT_MATCH_BY_REGION=False)
+class DashboardPushTests(ChatTestCase):
+    def setUp(self):
+        reset_chat_state()
+
+    async def test_snapshot_then_lifecycle_deltas(self):
+        staff = await User.objects.acreate(username="staff", is_staff=True)
+        admin = admin_client(staff)
+        await admin.connect()
+        await admin.send_json_to({"action": "subscribe_dashboard"})
+        snapshot = await admin.receive_json_from()
+        self.assertEqual(snapshot["type"], "dashboard_snapshot")
+        self.assertEqual((snapshot["total_rooms"], snapshot["active_rooms"], snapshot["waiting_count"]), (0, 0, 0))
+
+        first, second = chat_client(), chat_client()
+        await first.connect()
+        waiting = await admin.receive_json_from()
+        self.assertEqual(waiting["event"], "waiting")
+        self.assertEqual(waiting["counts"], {"total_rooms": 1, "active_rooms": 0, "waiting_count": 1})
+        await second.connect()
+        paired = await admin.receive_json_from()
+        self.assertEqual(paired["event"], "paired")
+        self.assertEqual(paired["room"]["room_id"], waiting["room"]["room_id"])
+        self.assertEqual(paired["counts"], {"total_rooms": 1, "active_rooms": 1, "waiting_count": 0})
+
+        await first.disconnect()
+        ended = await admin.receive_json_from()
+        self.assertEqual(ended["event"], "ended")
+        self.assertEqual(ended["counts"], {"total_rooms": 1, "active_rooms": 0, "waiting_count": 0})
+        await second.disconnect()
+        self.assertTrue(await admin.receive_nothing())
+        await admin.disconnect()
+
+
+@override_settings(CHAT_MATCH_QUEUE="memory", CHAT_MATCH_BY_REGION=False)
+class TeardownTests(ChatTestCase):
+    def setUp(self):
+        reset_chat_state()
+        rooms = ChatRoom.objects.bulk_create(ChatRoom(user1=f"a{n}", user2=f"b{n}") for n in range(30))
+        Message.objects.bulk_create(Message(room=room, sender="a", content="hi") for room in rooms for _ in range(3))
+
+    async def test_delete_all_broadcasts_once_and_deletes_in_background(self):
+        staff = await User.objects.acreate(username="staff", is_staff=True)
+        first, second = chat_client(), chat_client()
+        await first.connect()
+        await second.connect()
+        admin = admin_client(staff)
+        await admin.connect()
+        await admin.send_json_to({"action": "delete_all"})
+        for client in (first, second):
+            while (await client.receive_json_from()).get("message") != "All rooms are being deleted by admin.":
+                pass
+            self.assertEqual((await client.receive_output())["type"], "websocket.close")
+        statuses = []
+        while not statuses or statuses[-1]["status"] != "deleted_all":
+            statuses.append(await admin.receive_json_from())
+        self.assertEqual(statuses[-1]["rooms"], 31)
+        self.assertEqual(statuses[-1]["messages"], 90)
+        self.assertEqual(await ChatRoom.objects.acount(), 0)
+        self.assertEqual(await Message.objects.acount(), 0)
+        await admin.disconnect()
+
+
+class AdminSummaryQueryBudgetTests(QueryBudgetMixin, ChatTestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create(username="staff", is_staff=True))
+        for n in range(60):
+            ChatRoom.objects.create(user1=f"a{n}", user2=f"b{n}", active=True)
+        reset_chat_state()
+
+    def test_summary(self):
+        # Session and user lookups, then the recent list; counts come from the counters
+        with self.assertQueryBudget(3):
+            response = self.client.get("/staff/chat/summary/", secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["recent_active"]), 50)
+        self.assertEqual(response.json()["active_rooms"], 60)
+
+    def test_reconcile_corrects_drift(self):
+        ChatRoom.objects.filter(pk__in=ChatRoom.objects.values("pk")[:10]).delete()
+        self.assertEqual(async_to_sync(counters.read_counters)()["total_rooms"], 60)
+        async_to_sync(counters.reconcile)()
+        self.assertEqual(
+            async_to_sync(counters.read_counters)(),
+            {"total_rooms": 50, "active_rooms": 50, "waiting_count": 0},
+        )
+
+    def test_lost_counters_are_recounted(self):
+        cache.clear()
+        counts = async_to_sync(counters.apply_changes)({"total_rooms": 1})
+        self.assertEqual(counts["total_rooms"], 60)
+
+
+class MessageHistoryTests(QueryBudgetMixin, ChatTestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create(username="staff", is_staff=True))
+        self.room = ChatRoom.objects.create(user1="a", user2="b", active=True)
+        # Pairs of messages share a timestamp, so pages must break ties on id
+        now = timezone.now()
+        Message.objects.bulk_create(
+            Message(room=self.room, sender="a", content=str(n), timestamp=now + timedelta(seconds=n // 2))
+            for n in range(250)
+        )
+        self.url = f"/staff/chat/rooms/{self.room.room_id}/messages/"
+
+    def get(self, **params):
+        response = self.client.get(self.url, params, secure=True)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_scrolls_back_through_every_message(self):
+        contents, before = [], None
+        while True:
+            # Session and user, room, one page; never a COUNT
+            with self.assertQueryBudget(4) as queries:
+                page = self.get(limit=100, **({"before": before} if before else {}))
+            self.assertFalse(any("COUNT" in sql for sql in queries))
+            contents = [m["content"] for m in page["messages"]] + contents
+            before = page["before"]
+            if before is None:
+                break
+        self.assertEqual(contents, [str(n) for n in range(250)])
+
+    def test_after_cursor_returns_newer_messages(self):
+        first = self.get(limit=10, before=self.get(limit=100)["before"])
+        newer = self.get(limit=5, after=first["after"])
+        self.assertEqual([m["content"] for m in newer["messages"]], ["150", "151", "152", "153", "154"])
+
+    def test_buffered_page_cursors_keep_messages_sharing_the_boundary_timestamp(self):
+        self.addCleanup(reset_chat_state)
+        for message in Message.objects.filter(room=self.room).order_by("pk")[240:]:
+            async_to_sync(get_recent_messages().add)(str(self.room.room_id), message)
+        # Messages 246 and 247 share a timestamp; only 247 is on the buffered page
+        with self.assertQueryBudget(2):
+            page = self.get(limit=3)
+        self.assertEqual([m["content"] for m in page["messages"]], ["247", "248", "249"])
+        older = self.get(limit=3, before=page["before"])
+        self.assertEqual([m["content"] for m in older["messages"]], ["244", "245", "246"])
+        # A message sent later in the same instant as 249 is still newer than the page
+        last = Message.objects.get(room=self.room, content="249")
+        Message.objects.create(room=self.room, sender="b", content="250", timestamp=last.timestamp)
+        self.assertEqual([m["content"] for m in self.get(limit=3, after=page["after"])["messages"]], ["250"])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {"before": "nope"}, secure=True)
+        self.assertEqual(response.status_code, 400)
+
+
+class ExportTests(ChatTestCase):
+    def setUp(self):
+        self.staff = User.objects.create(username="staff", is_staff=True)
+        self.room = ChatRoom.objects.create(user1="a", user2="b", active=True)
+        other = ChatRoom.objects.create(user1="c", user2="d", active=True)
+        Message.objects.bulk_create(
+            [Message(room=self.room, sender="a" if n % 2 else "b", content=f"hi, {n}") for n in range(10)]
+            + [Message(room=other, sender="c", content="elsewhere")]
+        )
+
+    async def export(self, **params):
+        await self.async_client.aforce_login(self.staff)
+        response = await self.async_client.get("/staff/chat/export/", params, secure=True)
+        self.assertEqual(response.status_code, 200)
+        return b"".join([chunk async for chunk in response.streaming_content])
+
+    async def test_ndjson_filtered_by_room_and_sender(self):
+        body = await self.export(room=str(self.room.room_id), sender="a")
+        rows = [json.loads(line) for line in body.decode().splitlines()]
+        self.assertEqual([row["content"] for row in rows], [f"hi, {n}" for n in range(1, 10, 2)])
+        self.assertEqual(rows[0]["room_id"], str(self.room.room_id))
+
+    async def test_gzipped_csv(self):
+        body = gzip.decompress(await self.export(format="csv", gzip="1"))
+        rows = list(csv.reader(io.StringIO(body.decode())))
+        self.assertEqual(rows[0], ["room_id", "sender", "content", "timestamp"])
+        self.assertEqual(len(rows), 12)
+
+    async def test_rejects_bad_filters(self):
+        await self.async_client.aforce_login(self.staff)
+        response = await self.async_client.get("/staff/chat/export/", {"since": "yesterday"}, secure=True)
+        self.assertEqual(response.status_code, 400)
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "export.ndjson.gz"
+            call_command("export_chats", "--gzip", "--since", "2000-01-01T00:00:00Z",
+                         "--output", str(path), stderr=io.StringIO())
+            lines = gzip.decompress(path.read_bytes()).decode().splitlines()
+        self.assertEqual(len(lines), 11)
+
+
+class RecentMessagesTests(ChatTestCase):
+    async def check_short_buffers(self, buffer):
+        message = Message(sender="a", content="hi", timestamp=timezone.now())
+        await buffer.start("paired")
+        self.assertEqual(await buffer.get("paired", 50), [])
+        await buffer.add("paired", message)
+        self.assertEqual([m["content"] for m in await buffer.get("paired", 50)], ["hi"])
+        self.assertEqual(len(await buffer.since("paired", "2000-01-01")), 1)
+        # A buffer that did not see the room start may be missing older messages
+        await buffer.add("joined late", message)
+        self.assertIsNone(await buffer.get("joined late", 50))
+        self.assertIsNone(await buffer.since("joined late", "2000-01-01"))
+        self.assertEqual(len(await buffer.get("joined late", 1)), 1)
+        # and so is one that has started dropping them
+        for _ in range(3):
+            await buffer.add("paired", message)
+        self.assertIsNone(await buffer.get("paired", 50))
+        self.assertEqual(len(await buffer.get("paired", 3)), 3)
+
+    async def test_memory_buffer(self):
+        await self.check_short_buffers(recent.MemoryRecentMessages(size=3, max_rooms=10))
+
+    @skipUnless(fakeredis, "fakeredis is not installed")
+    async def test_redis_buffer(self):
+        client = fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True)
+        with mock.patch("chat.recent.get_redis", return_value=client):
+            await self.check_short_buffers(recent.RedisRecentMessages(size=3, ttl=60))
+
+
+class RetentionTests(ChatTestCase):
+    def setUp(self):
+        long_ago = timezone.now() - timedelta(days=40)
+        self.old = [ChatRoom.objects.create(user1=f"a{n}", user2=f"b{n}", active=False) for n in range(3)]
+        self.recent = ChatRoom.objects.create(user1="c", user2="d", active=False)
+        self.live = ChatRoom.objects.create(user1="e", user2="f", active=True)
+        for room in [*self.old, self.recent, self.live]:
+            Message.objects.bulk_create([Message(room=room, sender=room.user1, content=f"m{n}") for n in range(2)])
+        ChatRoom.objects.update(updated_at=long_ago)
+        # Ending a room stamps it, however long ago it was created
+        async_to_sync(rooms.deactivate_room)(str(self.live.room_id))
+        ChatRoom.objects.filter(pk=self.recent.pk).end()
+
+    def test_command_archives_then_deletes_each_chunk(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            call_command("archive_chats", "--days", "30", "--archive-dir", tmp, "--chunk-size", "2",
+                         stdout=io.StringIO())
+            files = sorted(Path(tmp).iterdir())
+            self.assertEqual([f.name.endswith(".jsonl.gz") for f in files], [True, True])
+            chunks = [[json.loads(line) for line in gzip.decompress(f.read_bytes()).splitlines()] for f in files]
+        self.assertEqual([[row["type"] for row in chunk] for chunk in chunks], [
+            ["room", "room", "message", "message", "message", "message"],
+            ["room", "message", "message"],
+        ])
+        archived = [row["room_id"] for chunk in chunks for row in chunk if row["type"] == "room"]
+        self.assertEqual(archived, [str(room.room_id) for room in self.old])
+        self.assertEqual(chunks[1][1]["content"], "m0")
+        self.assertEqual(
+            set(ChatRoom.objects.values_list("pk", flat=True)), {self.recent.pk, self.live.pk},
+        )
+        self.assertEqual(Message.objects.count(), 4)
+
+
+@skipUnless(connection.vendor == "postgresql", "EXPLAIN checks need Postgres")
+class HotPathPlanTests(ChatTestCase):
+    """With sequential scans priced out, every hot query must find an index."""
+
+    def assertNoSeqScan(self, queryset):
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+        plan = queryset.explain()
+        self.assertNotIn("Seq Scan", plan, plan)
+
+    def test_matching(self):
+        self.assertNoSeqScan(ChatRoom.objects.waiting().order_by("id")[:1])
+
+    def test_admin_summary(self):
+        self.assertNoSeqScan(ChatRoom.objects.filter(active=True, user2__isnull=False).order_by("-created_at")[:50])
+
+    def test_history(self):
+        room = ChatRoom.objects.create(user1="a", user2="b")
+        self.assertNoSeqScan(Message.objects.filter(room=room).order_by("-timestamp", "-pk")[:50])
@@ -1,9 +1,14 @@
+from django.conf import settings
 from django.shortcuts import render
-from django.http import JsonResponse, HttpResponseForbidden
+from django.http import JsonResponse, HttpResponseForbidden, StreamingHttpResponse
+from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.admin.views.decorators import staff_member_required
-from django.core.paginator import Paginator
+from asgiref.sync import async_to_sync
+from .export import TranscriptEncoder, astream_export, export_queryset, parse_filters
+from .history import MAX_PAGE_SIZE, latest_page, message_page
 from .models import ChatRoom, Message
+from .dashboard import rooms_summary
 
 # Create your views here.
 
@@ -18,7 +23,8 @@ def health_check(request):
 
 def public_chat(request):
     """Public chat page that connects to the websocket and matches strangers."""
-    return render(request, "chat/public_chat.html")
+    # Without a GeoIP database the page looks itself up and sends a location frame
+    return render(request, "chat/public_chat.html", {"locate_in_browser": not settings.CHAT_GEOIP_DATABASE})
 
 
 @staff_member_required
@@ -28,80 +34,67 @@ def admin_dashboard(request):
 
 @staff_member_required
 def admin_rooms_summary(request):
-    total_rooms = ChatRoom.objects.count()
-    active_qs = ChatRoom.objects.filter(active=True, user2__isnull=False).order_by("-created_at")
-    waiting_qs = ChatRoom.objects.filter(active=True, user2__isnull=True).order_by("-created_at")
-    active_rooms = active_qs.count()
-    waiting_count = waiting_qs.count()
-    
-    # Enhanced room data with location and user info
-    recent_active = []
-    for room in active_qs[:50]:
-        room_data = {
-            "id": room.id,
-            "room_id": str(room.room_id),
-            "user1": room.user1,
-            "user2": room.user2,
-            "user1_location": room.user1_location,
-            "user2_location": room.user2_location,
-            "active": room.active,
-            "created_at": room.created_at.isoformat(),
-            "updated_at": room.updated_at.isoformat()
-        }
-        recent_active.append(room_data)
-    
-    recent_waiting = []
-    for room in waiting_qs[:50]:
-        room_data = {
-            "id": room.id,
-            "room_id": str(room.room_id),
-            "user1": room.user1,
-            "user2": room.user2,
-            "user1_location": room.user1_location,
-            "user2_location": room.user2_location,
-            "active": room.active,
-            "created_at": room.created_at.isoformat(),
-            "updated_at": room.updated_at.isoformat()
-        }
-        recent_waiting.append(room_data)
-    
-    return JsonResponse({
-        "total_rooms": total_rooms,
-        "active_rooms": active_rooms,
-        "waiting_count": waiting_count,
-        "recent_active": recent_active,
-        "recent_waiting": recent_waiting,
-    })
+    """Polling fallback; the dashboard normally gets the same data pushed over its socket."""
+    return JsonResponse(async_to_sync(rooms_summary)())
 
 
 @staff_member_required
 def admin_room_messages(request, room_uuid):
-    try:
-        room = ChatRoom.objects.get(room_id=room_uuid)
-    except ChatRoom.DoesNotExist:
+    """
+    Room details with a page of its history. Pass the returned ``before``
+    (older) or ``after`` (newer) cursor back to page; ``limit`` caps at 100.
+    """
+    room = ChatRoom.objects.filter(room_id=room_uuid).values(
+        "pk", "room_id", "user1", "user2", "user1_location", "user2_location"
+    ).first()
+    if room is None:
         return JsonResponse({"error": "room not found"}, status=404)
     
-    qs = room.messages.order_by("-timestamp")
-    paginator = Paginator(qs, 100)
-    page = paginator.page(1)
-    messages = [
-        {
-            "sender": m.sender, 
-            "content": m.content, 
-            "timestamp": m.timestamp.isoformat(),
-            "sender_profile": m.sender_profile.is_anonymous if m.sender_profile else True
-        }
-        for m in page.object_list
-    ][::-1]
+    before, after = request.GET.get("before"), request.GET.get("after")
+    try:
+        limit = int(request.GET.get("limit", MAX_PAGE_SIZE))
+        # The latest page usually comes straight from the recent-message buffer
+        page = None if before or after else async_to_sync(latest_page)(str(room_uuid), limit)
+        if page is None:
+            page = message_page(Message.objects.filter(room_id=room["pk"]), before=before, after=after, limit=limit)
+    except ValueError:
+        return JsonResponse({"error": "invalid cursor or limit"}, status=400)
     
     # Add room location info
     room_data = {
-        "room_id": str(room.room_id),
-        "user1": room.user1,
-        "user2": room.user2,
-        "user1_location": room.user1_location,
-        "user2_location": room.user2_location,
-        "messages": messages
+        "room_id": str(room["room_id"]),
+        "user1": room["user1"],
+        "user2": room["user2"],
+        "user1_location": room["user1_location"],
+        "user2_location": room["user2_location"],
+        **page,
     }
     
     return JsonResponse(room_data)
+
+
+@staff_member_required
+async def admin_export_messages(request):
+    """
+    Stream transcripts as NDJSON or CSV (``format``), gzipped with
+    ``gzip=1``, filtered by ``room``, ``sender`` and a ``since``/``until``
+    range. Rows are read in chunks, so memory does not grow with the export.
+    """
+    try:
+        filters = parse_filters(
+            room=request.GET.get("room"),
+            sender=request.GET.get("sender"),
+            since=request.GET.get("since"),
+            until=request.GET.get("until"),
+        )
+        encoder = TranscriptEncoder(request.GET.get("format", "ndjson"), compress=request.GET.get("gzip") == "1")
+    except ValueError as exc:
+        return JsonResponse({"error": str(exc)}, status=400)
+    
+    response = StreamingHttpResponse(
+        astream_export(export_queryset(**filters), encoder),
+        content_type=encoder.content_type,
+    )
+    filename = f"chat-export-{timezone.now():%Y%m%d-%H%M%S}.{encoder.extension}"
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
@@ -46,6 +46,8 @@ class _ChatPageState extends State<ChatPage> {
   int _retry = 0;
   Timer? _reconnectTimer;
   bool _manuallyClosed = false;
+  // Reconnecting with this rejoins the same stranger after a network drop
+  String? _resumeToken;
 
   String _status = 'Connecting…'; // waiting | connected | disconnected
 
@@ -60,7 +62,13 @@ class _ChatPageState extends State<ChatPage> {
     setState(() => _status = 'Connecting…');
 
     try {
-      _channel = WebSocketChannel.connect(Uri.parse(WS_URL));
+      // Versioned JSON frames; the server also speaks chat.v1.msgpack
+      final uri = Uri.parse(WS_URL);
+      final token = _resumeToken;
+      _channel = WebSocketChannel.connect(
+        token == null ? uri : uri.replace(queryParameters: {'resume': token}),
+        protocols: ['chat.v1.json'],
+      );
       _sub = _channel!.stream.listen(
             (event) {
           _onMessage(event);
@@ -87,6 +95,18 @@ class _ChatPageState extends State<ChatPage> {
     // Expecting JSON from backend like {"message":"..."} or {"status":"waiting"}
     try {
       final data = jsonDecode(raw as String);
+      if (data is Map && data['type'] == 'ping') {
+        // Heartbeat: answering keeps our waiting spot alive
+        _channel?.sink.add(jsonEncode({"type": "pong"}));
+        return;
+      }
+      if (data is Map && data.containsKey('resume_token')) {
+        _resumeToken = data['resume_token']?.toString();
+        // Tells the server we will come back with it, so it holds the room
+        _channel?.sink.add(jsonEncode({"type": "resumable", "token": _resumeToken}));
+      } else if (data is Map && (data['status'] == 'resume_failed' || data['message'] == 'Stranger has disconnected.')) {
+        _resumeToken = null;
+      }
       if (data is Map && data.containsKey('status')) {
         final s = data['status']?.toString() ?? '';
         setState(() => _status = s == 'waiting' ? 'Waiting for a stranger…' : s);
@@ -131,6 +151,14 @@ class _ChatPageState extends State<ChatPage> {
     } catch (_) {}
   }
 
+  void _next() {
+    // Skips to the next stranger on the same socket
+    if (_channel == null) return;
+    _resumeToken = null;
+    _channel!.sink.add(jsonEncode({"type": "next"}));
+    setState(() => _items.clear());
+  }
+
   void _leave() {
     _manuallyClosed = true;
     _reconnectTimer?.cancel();
@@ -152,6 +180,11 @@ class _ChatPageState extends State<ChatPage> {
       appBar: AppBar(
         title: const Text('Stranger Chat'),
         actions: [
+          IconButton(
+            tooltip: 'Next stranger',
+            onPressed: _next,
+            icon: const Icon(Icons.skip_next),
+          ),
           IconButton(
             tooltip: 'Leave',
             onPressed: _leave,